@@ -187,6 +187,10 @@ model = dict(
     pts_bbox_head=dict(
         type='SparseFusionHead2D_Deform',
         run_mode="test",
+        # collect calibration scores, CalibrationTableHook dumps them to work_dir/calib_table.pkl;
+        # pass that file as calib_table to use the p-values at inference
+        calibrated_fusion=True,
+        calib_collect=True,
         num_views=num_views,
         in_channels_img=256,
         out_size_factor_img=4,
@@ -328,6 +332,7 @@ load_from = '/home/minkycho/SparseFusion/work_dirs/sparsefusion_nusc_voxel_LC_r5
 # load_from = 'checkpoints/sparsefusion_voxel0075_R50_initial.pth'
 resume_from = None
 workflow = [('train', 1)]
+custom_hooks = [dict(type='CalibrationTableHook', out_file='calib_table.pkl')]
 gpu_ids = range(0, 8)
 
 freeze_lidar_components = True  # freeze the LiDAR backbone
@@ -1,5 +1,8 @@
 from mmdet.core.bbox import AssignResult, BaseAssigner, MaxIoUAssigner
-from .hungarian_assigner import HungarianAssigner3D, HeuristicAssigner3D, HungarianAssignerView2D, HungarianAssignerViewProj2D, HungarianAssignerCameraBox
+from .hungarian_assigner import (batch_linear_assignment, linear_assignment, start_batch_linear_assignment,
+                                 PendingAssignment, HungarianAssigner3D, HeuristicAssigner3D, HungarianAssignerView2D, HungarianAssignerViewProj2D, HungarianAssignerCameraBox)
 
 __all__ = ['BaseAssigner', 'MaxIoUAssigner', 'AssignResult', 'HungarianAssigner3D', 'HeuristicAssigner',
-           'HungarianAssignerView2D', 'HungarianAssignerViewProj2D', 'HungarianAssignerCameraBox']
+           'HungarianAssignerView2D', 'HungarianAssignerViewProj2D', 'HungarianAssignerCameraBox',
+           'batch_linear_assignment', 'linear_assignment', 'start_batch_linear_assignment',
+           'PendingAssignment']
@@ -5,13 +5,232 @@ from mmdet.core.bbox.match_costs.builder import MATCH_COST
 from mmdet.core.bbox.iou_calculators import build_iou_calculator
 from mmdet.core.bbox.assigners import HungarianAssigner
 from mmdet.core.bbox.transforms import bbox_cxcywh_to_xyxy
+import numpy as np
 import torch
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from scipy.optimize import linear_sum_assignment
 except ImportError:
     linear_sum_assignment = None
 
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+except ImportError:
+    min_weight_full_bipartite_matching = None
+
+_MATCHING_POOLS = dict()
+
+
+def _solve_dense(cost):
+    """Solve a cost matrix whose infeasible pairs are ``inf``.
+
+    Infeasible pairs are only matched when every complete matching needs
+    them, and are left unmatched afterwards.
+    """
+    feasible = np.isfinite(cost)
+    if not feasible.all():
+        if not feasible.any():
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        finite_cost = cost[feasible]
+        high, low = finite_cost.max(), finite_cost.min()
+        # worse than any matching with less infeasible pairs
+        cost = np.where(feasible, cost,
+                        high + (high - low + 1) * min(cost.shape))
+    matched_row_inds, matched_col_inds = linear_sum_assignment(cost)
+    keep = feasible[matched_row_inds, matched_col_inds]
+    return matched_row_inds[keep], matched_col_inds[keep]
+
+
+def _solve_sparse(cost):
+    """Solve a cost matrix on the graph of its feasible pairs.
+
+    Faster than :func:`_solve_dense` for many predictions when most pairs are
+    infeasible, e.g. above ``max_cost``. Falls back to it when the feasible
+    pairs have no matching covering the smaller side.
+    """
+    if min_weight_full_bipartite_matching is None:
+        raise ImportError('The sparse solver requires scipy>=1.6.')
+    row_inds, col_inds = np.nonzero(np.isfinite(cost))
+    if len(row_inds) == 0:
+        return row_inds, col_inds
+    weights = cost[row_inds, col_inds]
+    # every full matching has the same size, so shifting the weights keeps
+    # the optimum and avoids zero weights, which are no edges of the graph
+    graph = csr_matrix((weights - weights.min() + 1, (row_inds, col_inds)),
+                       shape=cost.shape)
+    try:
+        return min_weight_full_bipartite_matching(graph)
+    except ValueError:
+        return _solve_dense(cost)
+
+
+MATCHING_SOLVERS = dict(dense=_solve_dense, sparse=_solve_sparse)
+
+
+def _get_matching_pool(num_workers):
+    if num_workers not in _MATCHING_POOLS:
+        _MATCHING_POOLS[num_workers] = ThreadPoolExecutor(
+            num_workers, thread_name_prefix='hungarian')
+    return _MATCHING_POOLS[num_workers]
+
+
+class PendingAssignment(object):
+    """Hungarian matching of a batch started by
+    :func:`start_batch_linear_assignment`.
+
+    The cost matrices are copied to the host without blocking, then solved
+    on the thread pool, or in :meth:`result` without one.
+    """
+
+    def __init__(self, cost, num_gts, query_groups, num_workers, solver):
+        batch_size, num_bboxes = cost.shape[:2]
+        self.device = cost.device
+        self.solver = MATCHING_SOLVERS[solver]
+        self.assigned_gt_inds = np.full((batch_size, num_bboxes),
+                                        -1,
+                                        dtype=np.int64)
+        self.cost = None
+        self.event = None
+        self.jobs = []
+        if max(num_gts, default=0) == 0:
+            return
+
+        cost = cost.detach()
+        if cost.is_cuda:
+            # pinned memory is copied by DMA without blocking the host
+            host_cost = torch.empty(
+                cost.shape, dtype=cost.dtype, pin_memory=True)
+            host_cost.copy_(cost, non_blocking=True)
+            self.event = torch.cuda.Event()
+            self.event.record(torch.cuda.current_stream(cost.device))
+            self.cost = host_cost.numpy()
+        else:
+            self.cost = cost.numpy()
+
+        for batch_id, num_gt in enumerate(num_gts):
+            if num_gt == 0:
+                continue
+            start = 0
+            for group_size in query_groups:
+                self.jobs.append((batch_id, start, group_size, num_gt))
+                start += group_size
+        if num_workers > 0:
+            pool = _get_matching_pool(num_workers)
+            self.jobs = [pool.submit(self._solve, *job) for job in self.jobs]
+
+    def _solve(self, batch_id, start, group_size, num_gt):
+        if self.event is not None:
+            self.event.synchronize()
+        matched_row_inds, matched_col_inds = self.solver(
+            self.cost[batch_id, start:start + group_size, :num_gt])
+        self.assigned_gt_inds[batch_id,
+                              start + matched_row_inds] = matched_col_inds
+
+    def result(self):
+        """Wait for the matching.
+
+        Returns:
+            torch.Tensor: Index of the ground truth matched to each
+                prediction, -1 for unmatched ones, with the shape of
+                [B, num_bboxes].
+        """
+        for job in self.jobs:
+            if isinstance(job, tuple):
+                self._solve(*job)
+            else:
+                job.result()
+        self.jobs = []
+        return torch.from_numpy(self.assigned_gt_inds).to(self.device)
+
+
+def start_batch_linear_assignment(cost,
+                                  num_gts,
+                                  query_groups=None,
+                                  num_workers=0,
+                                  solver='dense',
+                                  max_cost=None):
+    """Start the Hungarian matching of a batch with one host transfer.
+
+    Infeasible pairs, whose cost is not finite or above ``max_cost``, are
+    masked on the device before the transfer. They are only matched when a
+    complete matching needs them, and the prediction is then left unmatched.
+
+    Args:
+        cost (torch.Tensor): Cost matrices of the batch padded to the same
+            number of ground truths with the shape of [B, num_bboxes,
+            max_num_gts].
+        num_gts (list[int]): Number of ground truths of each sample.
+        query_groups (list[int], optional): Sizes of the groups of
+            predictions which are matched separately, e.g. the proposals of
+            each decoder layer. Defaults to None, a single group.
+        num_workers (int): Number of threads solving the cost matrices
+            concurrently. Defaults to 0, solving them in
+            :meth:`PendingAssignment.result`.
+        solver (str): ``dense`` for ``linear_sum_assignment`` of scipy or
+            ``sparse`` for ``min_weight_full_bipartite_matching`` on the
+            feasible pairs. Defaults to ``dense``.
+        max_cost (float, optional): Pairs with a higher cost are infeasible.
+            Defaults to None.
+
+    Returns:
+        :obj:`PendingAssignment`: The started matching.
+    """
+    if linear_sum_assignment is None:
+        raise ImportError('Please run "pip install scipy" '
+                          'to install scipy first.')
+    if query_groups is None:
+        query_groups = [cost.shape[1]]
+    feasible = torch.isfinite(cost)
+    if max_cost is not None:
+        feasible &= cost <= max_cost
+    cost = cost.masked_fill(~feasible, float('inf'))
+    return PendingAssignment(cost, num_gts, query_groups, num_workers,
+                             solver)
+
+
+def batch_linear_assignment(cost, num_gts, query_groups=None, **kwargs):
+    """Solve the Hungarian matching of a batch with one host transfer.
+
+    Args:
+        cost (torch.Tensor): Cost matrices of the batch padded to the same
+            number of ground truths with the shape of [B, num_bboxes,
+            max_num_gts].
+        num_gts (list[int]): Number of ground truths of each sample.
+        query_groups (list[int], optional): Sizes of the groups of
+            predictions which are matched separately, e.g. the proposals of
+            each decoder layer. Defaults to None, a single group.
+        **kwargs: Options of the matcher, see
+            :func:`start_batch_linear_assignment`.
+
+    Returns:
+        torch.Tensor: Index of the ground truth matched to each prediction,
+            -1 for unmatched ones, with the shape of [B, num_bboxes].
+    """
+    return start_batch_linear_assignment(cost, num_gts, query_groups,
+                                         **kwargs).result()
+
+
+def linear_assignment(cost, **kwargs):
+    """Solve the Hungarian matching of a single cost matrix.
+
+    Args:
+        cost (torch.Tensor): Cost matrix with the shape of [num_bboxes,
+            num_gts].
+        **kwargs: Options of the matcher, see
+            :func:`start_batch_linear_assignment`.
+
+    Returns:
+        tuple[torch.Tensor]: Matched rows and their matched columns on the
+            device of ``cost``.
+    """
+    assigned_gt_inds = batch_linear_assignment(cost[None], [cost.shape[1]],
+                                               **kwargs)[0]
+    matched_row_inds = torch.nonzero(
+        assigned_gt_inds >= 0, as_tuple=False).squeeze(1)
+    return matched_row_inds, assigned_gt_inds[matched_row_inds]
+
 
 @MATCH_COST.register_module()
 class BBox3DL1Cost(object):
@@ -97,12 +316,32 @@ class HungarianAssigner3D(BaseAssigner):
                  cls_cost=dict(type='ClassificationCost', weight=1.),
                  reg_cost=dict(type='BBoxBEVL1Cost', weight=1.0),
                  iou_cost=dict(type='IoU3DCost', weight=1.0),
-                 iou_calculator=dict(type='BboxOverlaps3D')
+                 iou_calculator=dict(type='BboxOverlaps3D'),
+                 matcher=dict()
                  ):
         self.cls_cost = build_match_cost(cls_cost)
         self.reg_cost = build_match_cost(reg_cost)
         self.iou_cost = build_match_cost(iou_cost)
         self.iou_calculator = build_iou_calculator(iou_calculator)
+        # options of start_batch_linear_assignment
+        self.matcher = matcher
+
+    def get_cost(self, bboxes, gt_bboxes, gt_labels, cls_pred, train_cfg):
+        """Compute the matching cost between predictions and ground truths.
+
+        Returns:
+            tuple[torch.Tensor]: Weighted cost and IoU of every pair with the
+                shape of [num_bboxes, num_gts].
+        """
+        # see mmdetection/mmdet/core/bbox/match_costs/match_cost.py
+        cls_cost = self.cls_cost(cls_pred[0].T, gt_labels)
+        reg_cost = self.reg_cost(bboxes, gt_bboxes, train_cfg)
+        iou = self.iou_calculator(bboxes, gt_bboxes)
+        iou_cost = self.iou_cost(iou)
+
+        # weighted sum of above three costs
+        cost = cls_cost + reg_cost + iou_cost
+        return cost, iou
 
     def assign(self, bboxes, gt_bboxes, gt_labels, cls_pred, train_cfg):
         num_gts, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
@@ -125,23 +364,12 @@ class HungarianAssigner3D(BaseAssigner):
             #     num_gts, assigned_gt_inds, None, labels=assigned_labels)
  
         # 2. compute the weighted costs
-        # see mmdetection/mmdet/core/bbox/match_costs/match_cost.py
-        cls_cost = self.cls_cost(cls_pred[0].T, gt_labels)
-        reg_cost = self.reg_cost(bboxes, gt_bboxes, train_cfg)
-        iou = self.iou_calculator(bboxes, gt_bboxes)
-        iou_cost = self.iou_cost(iou)
-
-        # weighted sum of above three costs
-        cost = cls_cost + reg_cost + iou_cost
+        cost, iou = self.get_cost(bboxes, gt_bboxes, gt_labels, cls_pred,
+                                  train_cfg)
 
         # 3. do Hungarian matching on CPU using linear_sum_assignment
-        cost = cost.detach().cpu()
-        if linear_sum_assignment is None:
-            raise ImportError('Please run "pip install scipy" '
-                              'to install scipy first.')
-        matched_row_inds, matched_col_inds = linear_sum_assignment(cost)
-        matched_row_inds = torch.from_numpy(matched_row_inds).to(bboxes.device)
-        matched_col_inds = torch.from_numpy(matched_col_inds).to(bboxes.device)
+        matched_row_inds, matched_col_inds = linear_assignment(
+            cost, **self.matcher)
 
         # 4. assign backgrounds and foregrounds
         # assign all indices to backgrounds first
@@ -162,9 +390,12 @@ class HungarianAssignerView2D(HungarianAssigner):
     def __init__(self,
                  cls_cost=dict(type='ClassificationCost', weight=1.),
                  reg_cost=dict(type='BBoxL1Cost', weight=1.0),
-                 iou_cost=dict(type='IoUCost', iou_mode='giou', weight=1.0)):
+                 iou_cost=dict(type='IoUCost', iou_mode='giou', weight=1.0),
+                 matcher=dict()):
         super(HungarianAssignerView2D, self).__init__(cls_cost, reg_cost, iou_cost)
         self.view_cost = ViewCost()
+        # options of start_batch_linear_assignment
+        self.matcher = matcher
 
     def assign(self,
                bbox_pred,
@@ -248,15 +479,8 @@ class HungarianAssignerView2D(HungarianAssigner):
         cost = cls_cost + reg_cost + iou_cost + view_cost
 
         # 3. do Hungarian matching on CPU using linear_sum_assignment
-        cost = cost.detach().cpu()
-        if linear_sum_assignment is None:
-            raise ImportError('Please run "pip install scipy" '
-                              'to install scipy first.')
-        matched_row_inds, matched_col_inds = linear_sum_assignment(cost)
-        matched_row_inds = torch.from_numpy(matched_row_inds).to(
-            bbox_pred.device)
-        matched_col_inds = torch.from_numpy(matched_col_inds).to(
-            bbox_pred.device)
+        matched_row_inds, matched_col_inds = linear_assignment(
+            cost, **self.matcher)
 
         # 4. assign backgrounds and foregrounds
         # assign all indices to backgrounds first
@@ -274,9 +498,12 @@ class HungarianAssignerViewProj2D(HungarianAssigner):
     def __init__(self,
                  cls_cost=dict(type='ClassificationCost', weight=1.),
                  reg_cost=dict(type='BBoxL1Cost', weight=1.0),
-                 iou_cost=dict(type='IoUCost', iou_mode='giou', weight=1.0)):
+                 iou_cost=dict(type='IoUCost', iou_mode='giou', weight=1.0),
+                 matcher=dict()):
         super(HungarianAssignerViewProj2D, self).__init__(cls_cost, reg_cost, iou_cost)
         self.view_cost = ViewCost()
+        # options of start_batch_linear_assignment
+        self.matcher = matcher
 
     def assign(self,
                bbox_pred,
@@ -371,15 +598,8 @@ class HungarianAssignerViewProj2D(HungarianAssigner):
         cost = cls_cost + reg_cost + iou_cost + view_cost
 
         # 3. do Hungarian matching on CPU using linear_sum_assignment
-        cost = cost.detach().cpu()
-        if linear_sum_assignment is None:
-            raise ImportError('Please run "pip install scipy" '
-                              'to install scipy first.')
-        matched_row_inds, matched_col_inds = linear_sum_assignment(cost)
-        matched_row_inds = torch.from_numpy(matched_row_inds).to(
-            bbox_pred.device)
-        matched_col_inds = torch.from_numpy(matched_col_inds).to(
-            bbox_pred.device)
+        matched_row_inds, matched_col_inds = linear_assignment(
+            cost, **self.matcher)
 
         # 4. assign backgrounds and foregrounds
         # assign all indices to backgrounds first
@@ -411,14 +631,40 @@ class HungarianAssignerCameraBox(BaseAssigner):
                  cls_cost=dict(type='ClassificationCost', weight=1.),
                  reg_cost=dict(type='BBoxBEVL1Cost', weight=1.0),
                  iou_cost=dict(type='IoU3DCost', weight=1.0),
-                 iou_calculator=dict(type='BboxOverlaps3D')
+                 iou_calculator=dict(type='BboxOverlaps3D'),
+                 matcher=dict()
                  ):
         self.cls_cost = build_match_cost(cls_cost)
         self.reg_cost = build_match_cost(reg_cost)
         self.iou_cost = build_match_cost(iou_cost)
         self.iou_calculator = build_iou_calculator(iou_calculator)
+        # options of start_batch_linear_assignment
+        self.matcher = matcher
         self.view_cost = ViewCost()
 
+    def get_cost(self, bboxes, gt_bboxes, gt_labels, cls_pred, view,
+                 train_cfg):
+        """Compute the matching cost between predictions and ground truths.
+
+        Returns:
+            tuple[torch.Tensor]: Weighted cost and IoU of every pair with the
+                shape of [num_bboxes, num_gts].
+        """
+        # see mmdetection/mmdet/core/bbox/match_costs/match_cost.py
+        gt_views = gt_labels[..., 1]
+        gt_labels = gt_labels[..., 0]
+
+        cls_cost = self.cls_cost(cls_pred[0].T, gt_labels)
+
+        reg_cost = self.reg_cost(bboxes, gt_bboxes, train_cfg)
+        iou = self.iou_calculator(bboxes, gt_bboxes)
+        iou_cost = self.iou_cost(iou)
+        view_cost = self.view_cost(view, gt_views)
+
+        # weighted sum of above three costs
+        cost = cls_cost + reg_cost + iou_cost + view_cost
+        return cost, iou
+
     def assign(self, bboxes, gt_bboxes, gt_labels, cls_pred, view, train_cfg):
         num_gts, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
 
@@ -439,29 +685,13 @@ class HungarianAssignerCameraBox(BaseAssigner):
                 num_gts, assigned_gt_inds, torch.zeros(assigned_gt_inds.shape[0]).to(assigned_gt_inds.device), labels=assigned_labels)
 
         # 2. compute the weighted costs
-        # see mmdetection/mmdet/core/bbox/match_costs/match_cost.py
-
-        gt_views = gt_labels[..., 1]
+        cost, iou = self.get_cost(bboxes, gt_bboxes, gt_labels, cls_pred,
+                                  view, train_cfg)
         gt_labels = gt_labels[..., 0]
 
-        cls_cost = self.cls_cost(cls_pred[0].T, gt_labels)
-
-        reg_cost = self.reg_cost(bboxes, gt_bboxes, train_cfg)
-        iou = self.iou_calculator(bboxes, gt_bboxes)
-        iou_cost = self.iou_cost(iou)
-        view_cost = self.view_cost(view, gt_views)
-
-        # weighted sum of above three costs
-        cost = cls_cost + reg_cost + iou_cost + view_cost
-
         # 3. do Hungarian matching on CPU using linear_sum_assignment
-        cost = cost.detach().cpu()
-        if linear_sum_assignment is None:
-            raise ImportError('Please run "pip install scipy" '
-                              'to install scipy first.')
-        matched_row_inds, matched_col_inds = linear_sum_assignment(cost)
-        matched_row_inds = torch.from_numpy(matched_row_inds).to(bboxes.device)
-        matched_col_inds = torch.from_numpy(matched_col_inds).to(bboxes.device)
+        matched_row_inds, matched_col_inds = linear_assignment(
+            cost, **self.matcher)
 
         # 4. assign backgrounds and foregrounds
         # assign all indices to backgrounds first
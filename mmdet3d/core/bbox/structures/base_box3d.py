@@ -417,13 +417,18 @@ class BaseInstance3DBoxes(object):
 
         # bev overlap
         overlaps_bev = boxes1_bev.new_zeros(
-            (boxes1_bev.shape[0], boxes2_bev.shape[0])).cuda()  # (N, M)
-        iou3d_cuda.boxes_overlap_bev_gpu(boxes1_bev.contiguous().cuda(),
-                                         boxes2_bev.contiguous().cuda(),
-                                         overlaps_bev)
+            (boxes1_bev.shape[0], boxes2_bev.shape[0]))  # (N, M)
+        if boxes1_bev.is_cuda:
+            iou3d_cuda.boxes_overlap_bev_gpu(boxes1_bev.contiguous(),
+                                             boxes2_bev.contiguous(),
+                                             overlaps_bev)
+        else:
+            iou3d_cuda.boxes_overlap_bev_cpu(boxes1_bev.contiguous(),
+                                             boxes2_bev.contiguous(),
+                                             overlaps_bev)
 
         # 3d overlaps
-        overlaps_3d = overlaps_bev.to(boxes1.device) * overlaps_h
+        overlaps_3d = overlaps_bev * overlaps_h
 
         volume1 = boxes1.volume.view(-1, 1)
         volume2 = boxes2.volume.view(1, -1)
@@ -0,0 +1,368 @@
+import mmcv
+import numpy as np
+import torch
+from mmcv.runner import HOOKS, Hook, _load_checkpoint, get_dist_info
+from os import path as osp
+from torch import distributed as dist
+
+
+class CalibrationTable(object):
+    """Sorted per-class calibration scores of both modalities.
+
+    The table of each modality is a [num_classes, L] array whose rows hold
+    the sorted scores of one class, padded with ``inf``. A raw score is
+    turned into a p-value, i.e. the fraction of calibration scores of its
+    class that are strictly larger, with a single ``searchsorted``.
+
+    Args:
+        tables (dict[str, torch.Tensor]): Padded sorted scores of each
+            modality ('cam' and 'lidar').
+        lengths (dict[str, torch.Tensor]): Number of valid scores of each
+            class with shape [num_classes].
+    """
+
+    def __init__(self, tables, lengths):
+        self.tables = tables
+        self.lengths = lengths
+
+    @classmethod
+    def from_scores(cls, scores, labels, num_classes, num_quantiles=None):
+        """Build the table from raw calibration scores.
+
+        Args:
+            scores (dict[str, np.ndarray]): Scores of each modality.
+            labels (dict[str, np.ndarray]): Class of each score.
+            num_classes (int): Number of classes.
+            num_quantiles (int, optional): If set, every class is summarized
+                by this many evenly spaced quantiles instead of keeping all
+                of its scores. Defaults to None.
+
+        Returns:
+            :obj:`CalibrationTable`: The calibration table.
+        """
+        tables, lengths = {}, {}
+        for modality in scores:
+            rows = []
+            for cls_id in range(num_classes):
+                row = np.sort(scores[modality][labels[modality] == cls_id])
+                if num_quantiles is not None and len(row) > 0:
+                    row = np.quantile(row, np.linspace(0, 1, num_quantiles))
+                rows.append(row.astype(np.float32))
+            max_len = max(max(len(row) for row in rows), 1)
+            table = np.full((num_classes, max_len), np.inf, dtype=np.float32)
+            for cls_id, row in enumerate(rows):
+                table[cls_id, :len(row)] = row
+            tables[modality] = torch.from_numpy(table)
+            lengths[modality] = torch.tensor([len(row) for row in rows])
+        return cls(tables, lengths)
+
+    @classmethod
+    def load(cls, filename, device='cpu'):
+        """Load a table written by :meth:`dump`."""
+        data = mmcv.load(filename)
+        tables = {
+            modality: torch.from_numpy(table)
+            for modality, table in data['tables'].items()
+        }
+        lengths = {
+            modality: torch.from_numpy(length)
+            for modality, length in data['lengths'].items()
+        }
+        return cls(tables, lengths).to(device)
+
+    def dump(self, filename):
+        """Write the table as a pickle of numpy arrays."""
+        mmcv.dump(
+            dict(
+                tables={k: v.cpu().numpy()
+                        for k, v in self.tables.items()},
+                lengths={k: v.cpu().numpy()
+                         for k, v in self.lengths.items()}), filename)
+
+    def to(self, device):
+        """Move the table to a device."""
+        self.tables = {k: v.to(device) for k, v in self.tables.items()}
+        self.lengths = {k: v.to(device) for k, v in self.lengths.items()}
+        return self
+
+    def p_value(self, modality, scores, labels):
+        """Convert raw scores into calibrated p-values.
+
+        Args:
+            modality (str): 'cam' or 'lidar'.
+            scores (torch.Tensor): Raw scores with arbitrary shape.
+            labels (torch.Tensor): Class of each score, same shape.
+
+        Returns:
+            torch.Tensor: Fraction of the calibration scores of the same
+                class that are larger than each score.
+        """
+        table = self.tables[modality].to(scores.device)
+        lengths = self.lengths[modality].to(scores.device)
+        flat_scores = scores.reshape(1, -1).float()
+        flat_labels = labels.reshape(1, -1).long()
+        # search every score in every class row, then keep its own class
+        num_le = torch.searchsorted(
+            table,
+            flat_scores.expand(table.shape[0], -1).contiguous(),
+            right=True)
+        num_le = num_le.gather(0, flat_labels)[0]
+        length = lengths[flat_labels[0]]
+        p_value = (length - num_le).float() / length.clamp(min=1).float()
+        return p_value.view(scores.shape)
+
+
+class CalibrationState(object):
+    """Feature aligner and class centers used to score fused queries.
+
+    The state does not own any weights: it keeps references to the
+    ``FeatureAligner`` and ``CrossModalCenterLoss`` registered in the
+    detection head. It therefore lives on the same device as the model and
+    is refreshed in place whenever the head is loaded with
+    ``load_checkpoint``, so nothing has to be read from disk at inference.
+
+    Args:
+        feature_aligner (:obj:`FeatureAligner`): Aligner of the head.
+        center_loss (:obj:`CrossModalCenterLoss`): Center loss of the head,
+            which holds the class centers.
+        topk (int): Number of nearest centers returned for each query.
+            Defaults to 10.
+        fp16 (bool): Whether to compute the distances in half precision.
+            Defaults to False.
+        debug (bool): Whether to check the distances against a float64
+            reference on every call. Defaults to False.
+        table (:obj:`CalibrationTable`, optional): Lookup table used to
+            turn scores into p-values. Defaults to None.
+        collect (bool): Whether to keep the scores of labelled queries to
+            build a :obj:`CalibrationTable` (calibration run).
+            Defaults to False.
+    """
+
+    def __init__(self, feature_aligner, center_loss, topk=10, fp16=False,
+                 debug=False, table=None, collect=False):
+        self.feature_aligner = feature_aligner
+        self.center_loss = center_loss
+        self.topk = topk
+        self.fp16 = fp16
+        self.debug = debug
+        self.table = table
+        self.collect = collect
+        self.collected = dict(cam=([], []), lidar=([], []))
+        # (filename, layer_id, prefix) -> (aligner state, centers)
+        self._loaded = {}
+
+    @property
+    def centers(self):
+        """torch.Tensor: Class centers with shape [num_classes, feat_dim]."""
+        return self.center_loss.centers
+
+    @property
+    def device(self):
+        """torch.device: Device of the calibration weights."""
+        return self.centers.device
+
+    def align(self, feats):
+        """Project query features into the space of the class centers.
+
+        Args:
+            feats (torch.Tensor): Query features with shape [..., C].
+
+        Returns:
+            torch.Tensor: Aligned features with shape [..., feat_dim].
+        """
+        return self.feature_aligner(feats)
+
+    @torch.no_grad()
+    def nearest_centers(self, feats, k=1):
+        """Find the k nearest class centers of aligned features.
+
+        Squared distances are expanded as ``|x|^2 - 2 x.c + |c|^2`` so the
+        whole batch is handled by a single batched matmul.
+
+        Args:
+            feats (torch.Tensor): Aligned features with shape [B, N, C].
+            k (int): Number of nearest centers. Defaults to 1.
+
+        Returns:
+            tuple[torch.Tensor]: Distances and indices of the nearest
+                centers, both with shape [B, N, k] and sorted by distance.
+        """
+        dtype = torch.half if self.fp16 else torch.float32
+        feats = feats.to(dtype)
+        centers = self.centers.to(dtype)
+
+        sq_dists = torch.baddbmm(
+            feats.pow(2).sum(-1, keepdim=True) +
+            centers.pow(2).sum(-1)[None, None],
+            feats,
+            centers.t()[None].expand(feats.shape[0], -1, -1),
+            alpha=-2)
+        dists = sq_dists.clamp_(min=0).sqrt_()
+        k = min(k, centers.shape[0])
+        topk_dists, topk_inds = dists.topk(k, dim=-1, largest=False)
+
+        if self.debug:
+            ref_dists = torch.cdist(feats.double(), centers.double()[None])
+            tol = 1e-2 if self.fp16 else 1e-4
+            assert torch.allclose(
+                topk_dists.double(),
+                ref_dists.gather(-1, topk_inds),
+                rtol=tol,
+                atol=tol)
+            assert torch.allclose(
+                topk_dists[..., 0].double(),
+                ref_dists.min(-1)[0],
+                rtol=tol,
+                atol=tol)
+        return topk_dists, topk_inds
+
+    @torch.no_grad()
+    def score(self, img_feats, pts_feats):
+        """Compute the nearest-center consistency scores of both modalities.
+
+        Queries of both modalities go through the aligner and the distance
+        computation together.
+
+        Args:
+            img_feats (torch.Tensor): Camera query features [B, Nq, C].
+            pts_feats (torch.Tensor): LiDAR query features [B, Nq, C].
+
+        Returns:
+            tuple[torch.Tensor]: Camera and LiDAR scores (distance to the
+                nearest center) and nearest center indices with shape
+                [B, Nq], followed by the top-k distances and center indices
+                of the camera and of the LiDAR queries with shape
+                [B, Nq, topk].
+        """
+        split = [img_feats.shape[1], pts_feats.shape[1]]
+        feats = torch.cat([img_feats, pts_feats], dim=1)
+        feats_aligned = self.align(feats.to(self.centers.dtype))
+        topk_dists, topk_inds = self.nearest_centers(feats_aligned, self.topk)
+
+        img_dists, pts_dists = topk_dists.split(split, dim=1)
+        img_inds, pts_inds = topk_inds.split(split, dim=1)
+        return (img_dists[..., 0], pts_dists[..., 0], img_inds[..., 0],
+                pts_inds[..., 0], img_dists, img_inds, pts_dists, pts_inds)
+
+    def p_values(self, img_scores, img_labels, pts_scores, pts_labels):
+        """Calibrated p-values of both modalities, None without a table."""
+        if self.table is None:
+            return None, None
+        return (self.table.p_value('cam', img_scores, img_labels),
+                self.table.p_value('lidar', pts_scores, pts_labels))
+
+    @torch.no_grad()
+    def collect_scores(self, modality, feats_aligned, labels):
+        """Keep the scores of the queries assigned to a ground truth.
+
+        Args:
+            modality (str): 'cam' or 'lidar'.
+            feats_aligned (torch.Tensor): Aligned features [B, Nq, C].
+            labels (torch.Tensor): Target labels [B, Nq], the background
+                label being ``num_classes``.
+        """
+        num_classes = self.centers.shape[0]
+        mask = labels < num_classes
+        labels = labels[mask]
+        scores = torch.norm(
+            feats_aligned[mask] - self.centers[labels], p=2, dim=-1)
+        self.collected[modality][0].append(scores.float())
+        self.collected[modality][1].append(labels)
+
+    def build_table(self, num_quantiles=None):
+        """Build a :obj:`CalibrationTable` from the collected scores."""
+        scores, labels = {}, {}
+        for modality, (mod_scores, mod_labels) in self.collected.items():
+            scores[modality] = torch.cat(
+                mod_scores).cpu().numpy() if mod_scores else np.zeros(0)
+            labels[modality] = torch.cat(
+                mod_labels).cpu().numpy() if mod_labels else np.zeros(0)
+        return CalibrationTable.from_scores(
+            scores, labels, self.centers.shape[0], num_quantiles)
+
+    @torch.no_grad()
+    def load_from_checkpoint(self, filename, layer_id='',
+                             prefix='pts_bbox_head.', map_location='cpu'):
+        """Load the aligner and the class centers from a checkpoint once.
+
+        Weights are copied into the referenced modules, so they keep their
+        current device and dtype. Only the aligner and the centers are kept
+        from the checkpoint, and later calls with the same arguments (e.g.
+        when the head re-initializes its weights) reuse them without reading
+        the file again.
+
+        Args:
+            filename (str): Path of the checkpoint.
+            layer_id (int | str): Suffix of the decoder layer the weights
+                were trained for, e.g. ``feature_aligner5`` and
+                ``center_loss.centers5``. Defaults to ''.
+            prefix (str): Prefix of the head in the checkpoint.
+                Defaults to 'pts_bbox_head.'.
+            map_location (str): Same as :func:`torch.load`.
+                Defaults to 'cpu'.
+        """
+        cache_key = (filename, str(layer_id), prefix)
+        if cache_key not in self._loaded:
+            checkpoint = _load_checkpoint(filename, map_location=map_location)
+            state_dict = checkpoint.get('state_dict', checkpoint)
+
+            aligner_prefix = f'{prefix}feature_aligner{layer_id}.'
+            aligner_state = {
+                key[len(aligner_prefix):]: value
+                for key, value in state_dict.items()
+                if key.startswith(aligner_prefix)
+            }
+            centers_key = f'{prefix}center_loss.centers{layer_id}'
+            if centers_key not in state_dict:
+                raise KeyError(f'{centers_key} is not found in {filename}')
+            self._loaded[cache_key] = (aligner_state, state_dict[centers_key])
+
+        aligner_state, centers = self._loaded[cache_key]
+        self.feature_aligner.load_state_dict(aligner_state)
+        self.centers.copy_(centers)
+
+
+@HOOKS.register_module()
+class CalibrationTableHook(Hook):
+    """Write the calibration table at the end of a calibration run.
+
+    The scores collected by the head on every rank are gathered and the
+    resulting :obj:`CalibrationTable` is dumped into the work directory.
+
+    Args:
+        out_file (str): File name of the table. Defaults to
+            'calib_table.pkl'.
+        num_quantiles (int, optional): See
+            :meth:`CalibrationTable.from_scores`. Defaults to None.
+    """
+
+    def __init__(self, out_file='calib_table.pkl', num_quantiles=None):
+        self.out_file = out_file
+        self.num_quantiles = num_quantiles
+
+    def after_run(self, runner):
+        model = runner.model
+        if hasattr(model, 'module'):
+            model = model.module
+        calibration = model.pts_bbox_head.calibration
+        assert calibration is not None and calibration.collect, \
+            'set calibrated_fusion=True and calib_collect=True in the head'
+
+        rank, world_size = get_dist_info()
+        if world_size > 1:
+            collected = {
+                modality: [torch.cat(values).cpu() if values else None
+                           for values in pair]
+                for modality, pair in calibration.collected.items()
+            }
+            gathered = [None] * world_size
+            dist.all_gather_object(gathered, collected)
+            for modality in calibration.collected:
+                calibration.collected[modality] = tuple(
+                    [part[modality][i] for part in gathered
+                     if part[modality][i] is not None] for i in range(2))
+        if rank == 0:
+            table = calibration.build_table(self.num_quantiles)
+            out_file = osp.join(runner.work_dir, self.out_file)
+            table.dump(out_file)
+            runner.logger.info(f'calibration table saved to {out_file}')
@@ -1,11 +1,13 @@
 from mmdet.core.post_processing import (merge_aug_bboxes, merge_aug_masks,
                                         merge_aug_proposals, merge_aug_scores,
                                         multiclass_nms)
-from .box3d_nms import aligned_3d_nms, box3d_multiclass_nms, circle_nms
+from .box3d_nms import (aligned_3d_nms, batched_circle_nms,
+                        box3d_multiclass_nms, circle_nms)
 from .merge_augs import merge_aug_bboxes_3d
 
 __all__ = [
     'multiclass_nms', 'merge_aug_proposals', 'merge_aug_bboxes',
     'merge_aug_scores', 'merge_aug_masks', 'box3d_multiclass_nms',
-    'aligned_3d_nms', 'merge_aug_bboxes_3d', 'circle_nms'
+    'aligned_3d_nms', 'merge_aug_bboxes_3d', 'circle_nms',
+    'batched_circle_nms'
 ]
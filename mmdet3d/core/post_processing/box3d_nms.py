@@ -179,3 +179,94 @@ def circle_nms(dets, thresh, socre_thre=0, post_max_size=83):
             if dist <= thresh and scores[i] - scores[j] > socre_thre:
                 suppressed[j] = 1
     return keep[:post_max_size]
+
+
+def batched_circle_nms(centers,
+                       scores,
+                       labels,
+                       class_thresh,
+                       batch_ids=None,
+                       post_max_size=83):
+    """Class-aware circular NMS of several samples in one call.
+
+    Gives the same result as running :func:`circle_nms` on every
+    (sample, class) group, but all groups are processed together with
+    tensor operations on the device of the inputs, without copying the
+    boxes to the host. Only the pairs of boxes in the same group are
+    compared, in blocks padded to the size of the largest group.
+
+    Args:
+        centers (torch.Tensor): BEV centers with the shape of [N, 2].
+        scores (torch.Tensor): Scores with the shape of [N].
+        labels (torch.Tensor): Class labels with the shape of [N].
+        class_thresh (torch.Tensor | list[float]): Squared distance threshold
+            of each class. Boxes of classes with a non-positive threshold
+            are all kept.
+        batch_ids (torch.Tensor, optional): Sample index of each box with
+            the shape of [N]. Defaults to None (single sample).
+        post_max_size (int): Max number of boxes kept in each group after
+            NMS. Defaults to 83.
+
+    Returns:
+        torch.Tensor: Boolean mask of the kept boxes with the shape of [N].
+    """
+    num_boxes = scores.shape[0]
+    if num_boxes == 0:
+        return scores.new_zeros((0, ), dtype=torch.bool)
+    labels = labels.long()
+    if batch_ids is None:
+        batch_ids = labels.new_zeros(num_boxes)
+    class_thresh = torch.as_tensor(
+        class_thresh, dtype=centers.dtype, device=centers.device)
+
+    # boxes sorted by group, then by descending score inside each group
+    order = torch.argsort(scores, descending=True)
+    group_keys = (batch_ids.long() * len(class_thresh) + labels)[order]
+    # unique sort keys keep the score order inside a group without
+    # torch.sort(stable=True), which needs torch>=1.9
+    inds = torch.argsort(group_keys * num_boxes +
+                         torch.arange(num_boxes, device=scores.device))
+    group_keys, order = group_keys[inds], order[inds]
+    _, group_ids, group_sizes = torch.unique_consecutive(
+        group_keys, return_inverse=True, return_counts=True)
+    group_starts = group_sizes.cumsum(0) - group_sizes
+    positions = torch.arange(
+        num_boxes, device=scores.device) - group_starts[group_ids]
+    # the only sync: the number and the size of the groups
+    num_groups, max_size = len(group_sizes), int(group_sizes.max())
+
+    # the pairs of each group in a [G, M, M] block, padded to M boxes
+    valid = scores.new_zeros((num_groups, max_size), dtype=torch.bool)
+    valid[group_ids, positions] = True
+    group_centers = centers.new_zeros((num_groups, max_size, 2))
+    group_centers[group_ids, positions] = centers[order]
+    group_scores = scores.new_zeros((num_groups, max_size))
+    group_scores[group_ids, positions] = scores[order]
+    group_thresh = class_thresh.new_zeros(num_groups)
+    group_thresh[group_ids] = class_thresh[labels[order]]
+
+    # box i can suppress box j of its group if it comes first in the
+    # descending score order, is strictly more confident and close enough
+    dist = ((group_centers[:, :, None] - group_centers[:, None])**2).sum(-1)
+    suppress = (dist <= group_thresh[:, None, None]) & (
+        group_scores[:, :, None] > group_scores[:, None]) & torch.triu(
+            valid.new_ones((max_size, max_size)), diagonal=1)
+    suppress &= valid[:, :, None] & valid[:, None] & \
+        (group_thresh > 0)[:, None, None]
+
+    # greedy NMS is the fixed point of "kept if no kept box suppresses it",
+    # reached after at most as many rounds as the largest group. The
+    # convergence is only checked every few rounds to limit the syncs.
+    keep = valid.clone()
+    for i in range(max_size):
+        new_keep = valid & ~(suppress & keep[:, :, None]).any(dim=1)
+        if (i + 1) % 16 == 0 and torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+
+    # post_max_size is applied in each group by descending score
+    keep &= (keep.cumsum(dim=1) <= post_max_size) | \
+        (group_thresh <= 0)[:, None]
+    keep_mask = valid.new_zeros(num_boxes)
+    keep_mask[order] = keep[group_ids, positions]
+    return keep_mask
@@ -1,3 +1,10 @@
-from .gaussian import draw_heatmap_gaussian, gaussian_2d, gaussian_radius
+from .batch_augment import sample_global_transforms, transform_points_batch
+from .gaussian import (draw_heatmap_gaussian, draw_heatmap_gaussian_batch,
+                       gaussian_2d, gaussian_radius)
+from .sparse_depth import rasterize_sparse_depth, sparse_depth_calib
 
-__all__ = ['gaussian_2d', 'gaussian_radius', 'draw_heatmap_gaussian']
+__all__ = [
+    'gaussian_2d', 'gaussian_radius', 'draw_heatmap_gaussian',
+    'draw_heatmap_gaussian_batch', 'rasterize_sparse_depth',
+    'sparse_depth_calib', 'sample_global_transforms', 'transform_points_batch'
+]
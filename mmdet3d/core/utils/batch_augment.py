@@ -0,0 +1,111 @@
+import numpy as np
+import torch
+
+
+def sample_global_transforms(batch_size,
+                             rot_range,
+                             scale_ratio_range,
+                             translation_std,
+                             flip_ratio_bev_horizontal=0.0,
+                             flip_ratio_bev_vertical=0.0,
+                             device='cpu'):
+    """Draw a global rotation, scaling, translation and flip per sample.
+
+    The draws follow ``OurGlobalRotScaleTrans`` followed by
+    ``OurRandomFlip3D`` and are composed into one transform per sample.
+
+    Args:
+        batch_size (int): Number of samples.
+        rot_range (list[float] | float): Range of rotation angle.
+        scale_ratio_range (list[float]): Range of scale ratio.
+        translation_std (list[float] | float): Standard deviation of the
+            translation noise.
+        flip_ratio_bev_horizontal (float): The flipping probability in
+            horizontal direction. Defaults to 0.0.
+        flip_ratio_bev_vertical (float): The flipping probability in vertical
+            direction. Defaults to 0.0.
+        device (str | torch.device): Device of the draws. Defaults to 'cpu'.
+
+    Returns:
+        dict[str, torch.Tensor]: The rotation angle, scale factor,
+            translation and flags of horizontal and vertical flip of each
+            sample, and ``transform``, the composed transforms of the LiDAR
+            coordinates with the shape of [B, 4, 4].
+    """
+    if not isinstance(rot_range, (list, tuple)):
+        rot_range = [-rot_range, rot_range]
+    if not isinstance(translation_std, (list, tuple)):
+        translation_std = [translation_std] * 3
+
+    rotation = torch.empty(batch_size, device=device).uniform_(*rot_range)
+    scale = torch.empty(batch_size, device=device).uniform_(
+        *scale_ratio_range)
+    translation = torch.randn(batch_size, 3, device=device) * \
+        torch.tensor(translation_std, device=device)
+    horizontal_flip = torch.rand(batch_size, device=device) < \
+        flip_ratio_bev_horizontal
+    vertical_flip = torch.rand(batch_size, device=device) < \
+        flip_ratio_bev_vertical
+
+    # same rotation as the boxes, points are multiplied by its transpose
+    rot_sin, rot_cos = torch.sin(rotation), torch.cos(rotation)
+    linear = torch.zeros(batch_size, 3, 3, device=device)
+    linear[:, 0, 0] = rot_cos
+    linear[:, 0, 1] = rot_sin
+    linear[:, 1, 0] = -rot_sin
+    linear[:, 1, 1] = rot_cos
+    linear[:, 2, 2] = 1
+    linear = linear * scale[:, None, None]
+
+    flip = torch.ones(batch_size, 3, device=device)
+    flip[:, 1] = 1 - 2 * horizontal_flip.float()
+    flip[:, 0] = 1 - 2 * vertical_flip.float()
+    transform = torch.zeros(batch_size, 4, 4, device=device)
+    transform[:, :3, :3] = flip[:, :, None] * linear
+    transform[:, :3, 3] = flip * translation
+    transform[:, 3, 3] = 1
+    return dict(
+        rotation=rotation,
+        scale=scale,
+        translation=translation,
+        horizontal_flip=horizontal_flip,
+        vertical_flip=vertical_flip,
+        transform=transform)
+
+
+def transform_points_batch(points, transforms, point_cloud_range=None):
+    """Transform and filter the points of a batch in one pass.
+
+    Args:
+        points (list[torch.Tensor]): Points of each sample with the shape of
+            [N_i, C], the first 3 channels are the coordinates.
+        transforms (torch.Tensor): Transforms of the coordinates of each
+            sample with the shape of [B, 4, 4].
+        point_cloud_range (list[float], optional): Range to keep the points
+            in after the transform. Defaults to None, no filtering.
+
+    Returns:
+        list[torch.Tensor]: Transformed points of each sample.
+    """
+    counts = [len(pts) for pts in points]
+    points = torch.cat(points)
+    transforms = transforms.to(points.dtype)
+    # the segments are views of the batch, each is transformed in place
+    # without gathering a transform per point
+    for pts, transform in zip(points.split(counts), transforms):
+        pts[:, :3] = torch.addmm(transform[:3, 3], pts[:, :3],
+                                 transform[:3, :3].t())
+    if point_cloud_range is None:
+        return list(points.split(counts))
+
+    batch_ids = torch.repeat_interleave(
+        torch.arange(len(counts), device=points.device),
+        torch.tensor(counts, device=points.device))
+    point_cloud_range = np.asarray(point_cloud_range)
+    xyz = points[:, :3]
+    mask = ((xyz > xyz.new_tensor(point_cloud_range[:3])) &
+            (xyz < xyz.new_tensor(point_cloud_range[3:]))).all(1)
+    counts = torch.zeros(
+        len(counts), dtype=torch.long, device=mask.device).index_add_(
+            0, batch_ids, mask.long())
+    return list(points[mask].split(counts.tolist()))
@@ -54,11 +54,61 @@ def draw_heatmap_gaussian(heatmap, center, radius, k=1):
     return heatmap
 
 
+def draw_heatmap_gaussian_batch(heatmap, map_ids, centers, radii, k=1):
+    """Draw the gaussians of many objects at once.
+
+    It gives the same heatmap as calling :func:`draw_heatmap_gaussian` for
+    every object, overlapping gaussians are merged by maximum.
+
+    Args:
+        heatmap (torch.Tensor): Heatmaps to draw on with the shape of
+            [N, H, W], modified in place.
+        map_ids (torch.Tensor): Index of the heatmap of each object.
+        centers (torch.Tensor): Integer center coords (x, y) of each object.
+        radii (torch.Tensor): Integer gaussian radius of each object.
+        k (int): Multiple of masked_gaussian. Defaults to 1.
+
+    Returns:
+        torch.Tensor: Masked heatmap.
+    """
+    if len(map_ids) == 0:
+        return heatmap
+    height, width = heatmap.shape[-2:]
+    radii = radii.long()[:, None]
+    max_radius = int(radii.max())
+    offsets = torch.arange(
+        -max_radius, max_radius + 1, device=heatmap.device)
+    dy = offsets.repeat_interleave(len(offsets))[None]
+    dx = offsets.repeat(len(offsets))[None]
+    x = centers[:, 0:1].long() + dx
+    y = centers[:, 1:2].long() + dy
+
+    sigma = (2 * radii + 1).double() / 6
+    gaussian = torch.exp(-(dx * dx + dy * dy).double() /
+                         (2 * sigma * sigma))
+    inside = ((dx.abs() <= radii) & (dy.abs() <= radii) & (x >= 0) &
+              (x < width) & (y >= 0) & (y < height) &
+              (gaussian >= np.finfo(np.float64).eps))
+    values = gaussian.to(heatmap.dtype)[inside] * k
+    index = ((map_ids.long()[:, None] * height + y) * width + x)[inside]
+
+    flat_heatmap = heatmap.view(-1)
+    if hasattr(torch.Tensor, 'scatter_reduce_'):
+        flat_heatmap.scatter_reduce_(0, index, values, reduce='amax')
+    else:
+        # torch<1.12, write the values from low to high so the maximum wins
+        order = values.argsort()
+        index, values = index[order], values[order]
+        flat_heatmap[index] = torch.maximum(flat_heatmap[index], values)
+    return heatmap
+
+
 def gaussian_radius(det_size, min_overlap=0.5):
     """Get radius of gaussian.
 
     Args:
-        det_size (tuple[torch.Tensor]): Size of the detection result.
+        det_size (tuple[torch.Tensor]): Size of the detection result, the
+            radius is computed elementwise for tensors of many objects.
         min_overlap (float): Gaussian_overlap. Defaults to 0.5.
 
     Returns:
@@ -83,4 +133,4 @@ def gaussian_radius(det_size, min_overlap=0.5):
     c3 = (min_overlap - 1) * width * height
     sq3 = torch.sqrt(b3**2 - 4 * a3 * c3)
     r3 = (b3 + sq3) / 2
-    return min(r1, r2, r3)
+    return torch.min(torch.min(r1, r2), r3)
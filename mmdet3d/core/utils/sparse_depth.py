@@ -0,0 +1,125 @@
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+
+def sparse_depth_calib(meta, cam_scale=1.0):
+    """Projection matrices and valid image sizes of the views of a sample.
+
+    Args:
+        meta (dict): Results of the pipeline or meta information of a sample
+            with ``lidar2cam_r``, ``lidar2cam_t``, ``cam_intrinsic`` and
+            ``pad_shape``, and ``valid_shape`` if the views are not valid up
+            to the padding.
+        cam_scale (float): Scale of the camera coordinates, i.e. of the depth.
+            Defaults to 1.0.
+
+    Returns:
+        tuple[np.ndarray]: Projection matrices from LiDAR to image coordinates
+            with the shape of [V, 4, 4], and width and height of the valid
+            image region of each view with the shape of [V, 2].
+    """
+    num_views = len(meta['lidar2cam_r'])
+    cam_ext = np.tile(np.eye(4), (num_views, 1, 1))
+    cam_int = np.tile(np.eye(4), (num_views, 1, 1))
+    cam_ext[:, :3, :3] = np.stack(meta['lidar2cam_r'])
+    cam_ext[:, :3, 3] = np.stack(meta['lidar2cam_t'])
+    cam_ext[:, :3] *= cam_scale
+    cam_int[:, :3, :3] = np.stack(meta['cam_intrinsic'])
+    lidar2img = cam_int @ cam_ext
+
+    if 'valid_shape' in meta:
+        valid_shapes = np.asarray(meta['valid_shape']).astype(np.int64)
+    else:
+        pad_shape = meta['pad_shape']
+        valid_shapes = np.array([[pad_shape[1], pad_shape[0]]] * num_views,
+                                dtype=np.int64)
+    return lidar2img, valid_shapes
+
+
+def rasterize_sparse_depth(points,
+                           lidar2img,
+                           valid_shapes,
+                           feat_shape,
+                           scale_factors,
+                           exp_time=0):
+    """Rasterize point clouds into multi-scale sparse depth maps.
+
+    The points of each sample are projected once against all of its views,
+    the nearest depth of every pixel is kept with a scatter-min and all scales
+    come out of the same pass. Empty pixels are optionally filled by
+    ``exp_time`` rounds of a 4-neighbour min-pool.
+
+    Args:
+        points (list[torch.Tensor]): Points of each sample in LiDAR
+            coordinates with the shape of [N_i, 3].
+        lidar2img (torch.Tensor): Projection matrices from LiDAR to image
+            coordinates with the shape of [B, V, 4, 4].
+        valid_shapes (torch.Tensor): Width and height of the valid image
+            region of each view with the shape of [B, V, 2].
+        feat_shape (tuple[int]): Height and width of the depth maps.
+        scale_factors (list[int]): Downsampling factor of each scale.
+        exp_time (int): Rounds of dilation of the depth maps. Defaults to 0.
+
+    Returns:
+        tuple[torch.Tensor]: Depth maps and their valid masks, both with the
+            shape of [B, V, S, H, W]. Empty pixels have a depth of 0.
+    """
+    batch_size, num_views = lidar2img.shape[:2]
+    num_scales = len(scale_factors)
+    height, width = feat_shape
+    lidar2img = lidar2img.float()
+    valid_shapes = valid_shapes.float()
+    scales = lidar2img.new_tensor([1.0 / scale for scale in scale_factors])
+
+    pixel_ids, pixel_depths = [], []
+    for batch_id in range(batch_size):
+        points_3d = points[batch_id][:, :3].float()
+        points_4d = torch.cat([points_3d, torch.ones_like(points_3d[:, :1])],
+                              dim=1)
+        # [V, N, 4]
+        points_img = points_4d @ lidar2img[batch_id].transpose(1, 2)
+        depth = points_img[..., 2].clamp(min=1e-4)
+        u = points_img[..., 0] / depth
+        v = points_img[..., 1] / depth
+
+        w_shape = valid_shapes[batch_id, :, 0:1]
+        h_shape = valid_shapes[batch_id, :, 1:2]
+        valid_mask = (u > 0) & (u < w_shape - 1) & (v > 0) & (v < h_shape - 1)
+        view_ids = valid_mask.nonzero(as_tuple=False)[:, 0]
+        u, v, depth = u[valid_mask], v[valid_mask], depth[valid_mask]
+
+        cx = (u[:, None] * scales).long()  # [M, S]
+        cy = (v[:, None] * scales).long()
+        in_grid = (cx < width) & (cy < height)
+        scale_ids = torch.arange(num_scales, device=cx.device).expand_as(cx)
+        map_ids = (batch_id * num_views +
+                   view_ids[:, None]) * num_scales + scale_ids
+        pixel_ids.append(((map_ids * height + cy) * width + cx)[in_grid])
+        pixel_depths.append(depth[:, None].expand_as(cx)[in_grid])
+    pixel_ids = torch.cat(pixel_ids)
+    pixel_depths = torch.cat(pixel_depths)
+
+    num_pixels = batch_size * num_views * num_scales * height * width
+    depth_map = lidar2img.new_full((num_pixels, ), float('inf'))
+    if hasattr(torch.Tensor, 'scatter_reduce_'):
+        depth_map.scatter_reduce_(0, pixel_ids, pixel_depths, reduce='amin')
+    else:
+        # torch<1.12, write the points from far to near so the nearest wins
+        order = pixel_depths.argsort(descending=True)
+        depth_map[pixel_ids[order]] = pixel_depths[order]
+    depth_map = depth_map.view(-1, 1, height, width)
+
+    for _ in range(exp_time):
+        # the vertical and horizontal 3-windows together cover the 4 neighbours
+        neighbour_depth = torch.minimum(
+            -F.max_pool2d(-depth_map, (3, 1), stride=1, padding=(1, 0)),
+            -F.max_pool2d(-depth_map, (1, 3), stride=1, padding=(0, 1)))
+        depth_map = torch.where(
+            torch.isinf(depth_map), neighbour_depth, depth_map)
+
+    depth_map = depth_map.view(batch_size, num_views, num_scales, height,
+                               width)
+    valid_mask = torch.isfinite(depth_map)
+    depth_map = depth_map.masked_fill(~valid_mask, 0)
+    return depth_map, valid_mask
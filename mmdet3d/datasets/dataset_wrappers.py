@@ -1,4 +1,9 @@
+import hashlib
+import mmcv
 import numpy as np
+import os
+from mmcv.runner import HOOKS, Hook
+from os import path as osp
 
 from .builder import DATASETS
 
@@ -11,51 +16,117 @@ class CBGSDataset(object):
 
     Balance the number of scenes under different classes.
 
+    The scenes of each class are found once, with
+    ``dataset.get_cat_masks()`` if the dataset has it, and can be cached in
+    ``cache_dir``. The scenes are then resampled by :meth:`set_epoch`
+    without scanning the dataset again.
+
     Args:
         dataset (:obj:`CustomDataset`): The dataset to be class sampled.
+        seed (int, optional): Seed of the resampling, which draws from
+            ``seed + epoch``. Defaults to None, the global numpy random state.
+        cache_dir (str, optional): Directory to cache the scenes of each
+            class in, keyed by the hash of the annotation file and the
+            classes. Defaults to None, no cache.
     """
 
-    def __init__(self, dataset):
+    def __init__(self, dataset, seed=None, cache_dir=None):
         self.dataset = dataset
         self.CLASSES = dataset.CLASSES
         self.cat2id = {name: i for i, name in enumerate(self.CLASSES)}
-        self.sample_indices = self._get_sample_indices()
-        # self.dataset.data_infos = self.data_infos
-        if hasattr(self.dataset, 'flag'):
-            self.flag = np.array(
-                [self.dataset.flag[ind] for ind in self.sample_indices],
-                dtype=np.uint8)
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.class_sample_idxs = self._get_class_sample_idxs()
+        self.set_epoch(0)
+
+    def _cache_file(self):
+        """Get the cache file of the scenes of each class."""
+        ann_file = self.dataset.ann_file
+        if osp.isdir(ann_file):
+            files = [
+                osp.join(ann_file, name)
+                for name in sorted(os.listdir(ann_file))
+            ]
+        else:
+            files = [ann_file]
+        sha1 = hashlib.sha1()
+        for filename in files:
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 24), b''):
+                    sha1.update(chunk)
+        sha1.update(
+            repr((type(self.dataset).__name__, tuple(self.CLASSES),
+                  getattr(self.dataset, 'load_interval', 1),
+                  getattr(self.dataset, 'use_valid_flag', False))).encode())
+        return osp.join(self.cache_dir, f'cbgs_{sha1.hexdigest()}.npy')
+
+    def _get_class_sample_idxs(self):
+        """Find the scenes containing each class.
+
+        Returns:
+            list[np.ndarray]: Indices of the scenes of each class.
+        """
+        cache_file = None
+        cat_masks = None
+        if self.cache_dir is not None:
+            cache_file = self._cache_file()
+            if osp.exists(cache_file):
+                cat_masks = np.load(cache_file)
+
+        if cat_masks is None:
+            if hasattr(self.dataset, 'get_cat_masks'):
+                cat_masks = self.dataset.get_cat_masks()
+            else:
+                cat_masks = np.zeros((len(self.dataset), len(self.CLASSES)),
+                                     dtype=bool)
+                for idx in range(len(self.dataset)):
+                    cat_masks[idx, self.dataset.get_cat_ids(idx)] = True
+            if cache_file is not None:
+                mmcv.mkdir_or_exist(self.cache_dir)
+                # ranks may write at the same time, rename is atomic
+                tmp_file = f'{cache_file[:-4]}.{os.getpid()}.npy'
+                np.save(tmp_file, cat_masks)
+                os.replace(tmp_file, cache_file)
+
+        return [np.flatnonzero(cat_mask) for cat_mask in cat_masks.T]
 
-    def _get_sample_indices(self):
-        """Load annotations from ann_file.
+    def _get_sample_indices(self, rng):
+        """Draw the class balanced scenes.
 
         Args:
-            ann_file (str): Path of the annotation file.
+            rng (np.random.RandomState | module): Random state of the
+                sampling, or :mod:`np.random` for the global one.
 
         Returns:
-            list[dict]: List of annotations after class sampling.
+            np.ndarray: Indices of the scenes after class sampling.
         """
-        class_sample_idxs = {cat_id: [] for cat_id in self.cat2id.values()}
-        for idx in range(len(self.dataset)):
-            sample_cat_ids = self.dataset.get_cat_ids(idx)
-            for cat_id in sample_cat_ids:
-                class_sample_idxs[cat_id].append(idx)
         duplicated_samples = sum(
-            [len(v) for _, v in class_sample_idxs.items()])
-        class_distribution = {
-            k: len(v) / duplicated_samples
-            for k, v in class_sample_idxs.items()
-        }
+            len(cls_inds) for cls_inds in self.class_sample_idxs)
+        frac = 1.0 / len(self.CLASSES)
 
         sample_indices = []
+        for cls_inds in self.class_sample_idxs:
+            if len(cls_inds) == 0:
+                continue
+            ratio = frac / (len(cls_inds) / duplicated_samples)
+            sample_indices.append(
+                rng.choice(cls_inds, int(len(cls_inds) * ratio)))
+        return np.concatenate(sample_indices)
 
-        frac = 1.0 / len(self.CLASSES)
-        ratios = [frac / v for v in class_distribution.values()]
-        for cls_inds, ratio in zip(list(class_sample_idxs.values()), ratios):
-            sample_indices += np.random.choice(cls_inds,
-                                               int(len(cls_inds) *
-                                                   ratio)).tolist()
-        return sample_indices
+    def set_epoch(self, epoch):
+        """Redraw the class balanced scenes for an epoch.
+
+        Args:
+            epoch (int): Index of the epoch.
+        """
+        if self.seed is None:
+            rng = np.random
+        else:
+            rng = np.random.RandomState(self.seed + epoch)
+        self.sample_indices = self._get_sample_indices(rng)
+        if hasattr(self.dataset, 'flag'):
+            self.flag = self.dataset.flag[self.sample_indices].astype(
+                np.uint8)
 
     def __getitem__(self, idx):
         """Get item from infos according to the given index.
@@ -73,3 +144,13 @@ class CBGSDataset(object):
             int: Length of data infos.
         """
         return len(self.sample_indices)
+
+
+@HOOKS.register_module()
+class CBGSResampleHook(Hook):
+    """Redraw the scenes of a :obj:`CBGSDataset` before every epoch."""
+
+    def before_train_epoch(self, runner):
+        dataset = runner.data_loader.dataset
+        if isinstance(dataset, CBGSDataset):
+            dataset.set_epoch(runner.epoch)
@@ -0,0 +1,265 @@
+import mmcv
+import numpy as np
+from os import path as osp
+
+# per-box and per-view annotation arrays, stored as ragged columns
+BOX_KEYS = ('gt_boxes', 'gt_names', 'gt_velocity', 'gt_visible',
+            'num_lidar_pts', 'num_radar_pts', 'valid_flag')
+VIEW_KEYS = ('gt_bboxes2d_view', 'gt_names2d_view', 'gt_viewsIDs',
+             'gt_bboxes_cam_view', 'gt_velocity_cam_view',
+             'gt_bboxes_lidar_view', 'gt_velocity_lidar_view',
+             'gt_pts_centers_view', 'gt_img_centers_view')
+# class names are encoded as integer ids into the vocabulary of the store
+NAME_KEYS = ('gt_names', 'gt_names2d_view')
+
+
+def _to_column(values):
+    """Stack the values of one key into a fixed-dtype array."""
+    if len(values) > 0 and isinstance(values[0], str):
+        return np.array([value.encode() for value in values])
+    column = np.stack([np.asarray(value) for value in values])
+    if column.dtype == object:
+        raise TypeError('cannot store object arrays in an info store')
+    return column
+
+
+def _to_value(value):
+    """Convert an element of a column back to the type of the info."""
+    if isinstance(value, bytes):
+        return value.decode()
+    if value.ndim == 0:
+        return value.item()
+    return value
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def pack_infos(data, out_dir, classes=()):
+    """Pack the infos of a pkl annotation file into an info store.
+
+    Every key becomes a fixed-dtype ``.npy`` file under ``out_dir``. Per-box
+    and per-view annotations are concatenated over the samples and indexed by
+    offsets, and class names are encoded as ids into a vocabulary that starts
+    with ``classes``.
+
+    Args:
+        data (dict): Content of the annotation file with ``infos`` and
+            ``metadata``.
+        out_dir (str): Directory of the info store.
+        classes (Sequence[str]): Class names placed first in the vocabulary.
+    """
+    infos = data['infos']
+    assert len(infos) > 0, 'cannot pack an empty annotation file'
+    mmcv.mkdir_or_exist(out_dir)
+    columns = dict()
+    first = infos[0]
+
+    names = list(classes)
+    name_keys = [key for key in NAME_KEYS if key in first]
+    for name in sorted(
+            set(name for info in infos for key in name_keys
+                for name in info[key]) - set(names)):
+        names.append(name)
+    name2id = {name: i for i, name in enumerate(names)}
+
+    ragged_keys = BOX_KEYS + VIEW_KEYS
+    columns['sample'] = [
+        key for key in first
+        if key not in ('cams', 'sweeps') and key not in ragged_keys
+    ]
+    for key in columns['sample']:
+        np.save(
+            osp.join(out_dir, f'sample.{key}.npy'),
+            _to_column([info[key] for info in infos]))
+
+    cam_orders = list(first.get('cams', dict()))
+    columns['cams'] = list(first['cams'][cam_orders[0]]) if cam_orders else []
+    for key in columns['cams']:
+        column = _to_column([
+            info['cams'][cam][key] for info in infos for cam in cam_orders
+        ])
+        np.save(
+            osp.join(out_dir, f'cams.{key}.npy'),
+            column.reshape(len(infos), len(cam_orders), *column.shape[1:]))
+
+    sweeps = [sweep for info in infos for sweep in info.get('sweeps', [])]
+    columns['sweeps'] = list(sweeps[0]) if sweeps else []
+    np.save(
+        osp.join(out_dir, 'sweeps.offsets.npy'),
+        _offsets([len(info.get('sweeps', [])) for info in infos]))
+    for key in columns['sweeps']:
+        np.save(
+            osp.join(out_dir, f'sweeps.{key}.npy'),
+            _to_column([sweep[key] for sweep in sweeps]))
+
+    for group, keys, length_key in (('box', BOX_KEYS, 'gt_boxes'),
+                                    ('view', VIEW_KEYS, 'gt_viewsIDs')):
+        columns[group] = [key for key in keys if key in first]
+        if not columns[group]:
+            continue
+        np.save(
+            osp.join(out_dir, f'{group}.offsets.npy'),
+            _offsets([len(info[length_key]) for info in infos]))
+        for key in columns[group]:
+            if key in NAME_KEYS:
+                column = np.array(
+                    [name2id[name] for info in infos for name in info[key]],
+                    dtype=np.int32)
+            else:
+                column = np.concatenate([info[key] for info in infos])
+            np.save(osp.join(out_dir, f'{group}.{key}.npy'), column)
+
+    mmcv.dump(
+        dict(
+            metadata=data['metadata'],
+            num_samples=len(infos),
+            names=names,
+            cam_orders=cam_orders,
+            columns=columns), osp.join(out_dir, 'meta.json'))
+
+
+class InfoStore(object):
+    """Columnar and memory-mapped infos written by :func:`pack_infos`.
+
+    The columns are memory-mapped on first access, so the dataloader workers
+    share the pages of the store instead of unpickling private copies of the
+    infos. Indexing the store gives the same info dicts as the pkl file,
+    while :meth:`get_sample` and :meth:`get_annos` give the parts of them
+    needed to load a sample with annotations as slices of the columns.
+
+    Args:
+        path (str): Directory of the info store.
+        indices (np.ndarray, optional): Indices of the samples in the store
+            to expose. Defaults to None, all samples.
+    """
+
+    def __init__(self, path, indices=None):
+        self.path = path
+        meta = mmcv.load(osp.join(path, 'meta.json'))
+        self.metadata = meta['metadata']
+        self.names = np.array(meta['names'])
+        self.cam_orders = meta['cam_orders']
+        self.columns = meta['columns']
+        if indices is None:
+            indices = np.arange(meta['num_samples'])
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self._arrays = dict()
+
+    def __getstate__(self):
+        # memory maps are reopened by each process instead of pickled
+        state = self.__dict__.copy()
+        state['_arrays'] = dict()
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        info = self.get_sample(idx)
+        info.update(self.get_annos(idx))
+        for key in NAME_KEYS:
+            if key in info:
+                info[key] = self.names[info[key]]
+        return info
+
+    def select(self, indices):
+        """Get a store exposing a subset of the samples.
+
+        Args:
+            indices (np.ndarray): Indices into the current samples.
+
+        Returns:
+            :obj:`InfoStore`: Store sharing the columns of this one.
+        """
+        store = self.__new__(self.__class__)
+        store.__dict__.update(self.__dict__)
+        store.indices = self.indices[indices]
+        return store
+
+    def column(self, group, key):
+        """Get a memory-mapped column of the store.
+
+        Args:
+            group (str): Group of the column, one of ``sample``, ``cams``,
+                ``sweeps``, ``box`` and ``view``.
+            key (str): Key of the column in the infos or ``offsets``.
+
+        Returns:
+            np.ndarray: The column over all samples of the store.
+        """
+        name = f'{group}.{key}'
+        if name not in self._arrays:
+            self._arrays[name] = np.load(
+                osp.join(self.path, f'{name}.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    def label_map(self, classes):
+        """Map the name ids of the store to the labels of ``classes``.
+
+        Args:
+            classes (Sequence[str]): Class names of the dataset.
+
+        Returns:
+            np.ndarray: Label of each name id, -1 for the other names.
+        """
+        cat2id = {name: i for i, name in enumerate(classes)}
+        return np.array([cat2id.get(name, -1) for name in self.names],
+                        dtype=np.int64)
+
+    def _rows(self, group, sample_id):
+        offsets = self.column(group, 'offsets')
+        return slice(offsets[sample_id], offsets[sample_id + 1])
+
+    def get_sample(self, idx):
+        """Get the sensor infos of a sample.
+
+        Args:
+            idx (int): Index of the sample.
+
+        Returns:
+            dict: Info of the sample without the annotations.
+        """
+        sample_id = self.indices[idx]
+        info = {
+            key: _to_value(self.column('sample', key)[sample_id])
+            for key in self.columns['sample']
+        }
+        info['cams'] = {cam: dict() for cam in self.cam_orders}
+        for key in self.columns['cams']:
+            values = self.column('cams', key)[sample_id]
+            for cam, value in zip(self.cam_orders, values):
+                info['cams'][cam][key] = _to_value(value)
+        rows = self._rows('sweeps', sample_id)
+        values = [self.column('sweeps', key)[rows]
+                  for key in self.columns['sweeps']]
+        info['sweeps'] = [{
+            key: _to_value(value[i])
+            for key, value in zip(self.columns['sweeps'], values)
+        } for i in range(rows.stop - rows.start)]
+        return info
+
+    def get_annos(self, idx):
+        """Get the annotations of a sample.
+
+        The arrays are read-only slices of the columns and the names are
+        given as ids into :attr:`names`.
+
+        Args:
+            idx (int): Index of the sample.
+
+        Returns:
+            dict: Per-box and per-view annotations of the sample.
+        """
+        sample_id = self.indices[idx]
+        annos = dict()
+        for group in ('box', 'view'):
+            if not self.columns[group]:
+                continue
+            rows = self._rows(group, sample_id)
+            for key in self.columns[group]:
+                annos[key] = self.column(group, key)[rows]
+        return annos
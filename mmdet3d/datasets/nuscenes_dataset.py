@@ -9,6 +9,7 @@ from mmdet.datasets import DATASETS
 from ..core import show_result
 from ..core.bbox import Box3DMode, Coord3DMode, LiDARInstance3DBoxes
 from .custom_3d import Custom3DDataset
+from .info_store import InfoStore
 
 
 @DATASETS.register_module()
@@ -21,7 +22,8 @@ class NuScenesDataset(Custom3DDataset):
     for data downloading.
 
     Args:
-        ann_file (str): Path of annotation file.
+        ann_file (str): Path of annotation file or directory of an info
+            store packed from it.
         pipeline (list[dict], optional): Pipeline used for data processing.
             Defaults to None.
         data_root (str): Path of dataset root.
@@ -153,6 +155,15 @@ class NuScenesDataset(Custom3DDataset):
                 contains such boxes, store a list containing idx,
                 otherwise, store empty list.
         """
+        if self.info_store is not None:
+            info = self.info_store.get_annos(idx)
+            if self.use_valid_flag:
+                name_ids = info['gt_names'][info['valid_flag']]
+            else:
+                name_ids = info['gt_names']
+            labels = self.store_label_map[np.unique(name_ids)]
+            return labels[labels >= 0].tolist()
+
         info = self.data_infos[idx]
         if self.use_valid_flag:
             mask = info['valid_flag']
@@ -166,15 +177,69 @@ class NuScenesDataset(Custom3DDataset):
                 cat_ids.append(self.cat2id[name])
         return cat_ids
 
+    def get_cat_masks(self):
+        """Get category distribution of all scenes at once.
+
+        Returns:
+            np.ndarray: Whether each scene contains boxes of each category
+                with the shape of [num_scenes, num_classes].
+        """
+        if self.info_store is not None:
+            store = self.info_store
+            offsets = store.column('box', 'offsets')
+            starts = offsets[store.indices]
+            lengths = offsets[store.indices + 1] - starts
+            # rows of the boxes of the selected scenes in the box columns
+            rows = np.arange(lengths.sum()) + np.repeat(
+                starts - (np.cumsum(lengths) - lengths), lengths)
+            labels = self.store_label_map[store.column('box',
+                                                       'gt_names')[rows]]
+            if self.use_valid_flag:
+                labels[~store.column('box', 'valid_flag')[rows]] = -1
+        else:
+            lengths = np.array(
+                [len(info['gt_names']) for info in self.data_infos],
+                dtype=np.int64)
+            names = np.concatenate(
+                [info['gt_names'] for info in self.data_infos])
+            unique_names, name_ids = np.unique(names, return_inverse=True)
+            labels = np.array(
+                [self.cat2id.get(name, -1) for name in unique_names],
+                dtype=np.int64)[name_ids]
+            if self.use_valid_flag:
+                valid_flag = np.concatenate(
+                    [info['valid_flag'] for info in self.data_infos])
+                labels[~valid_flag] = -1
+
+        scene_ids = np.repeat(np.arange(len(lengths)), lengths)
+        keep = labels >= 0
+        cat_masks = np.zeros((len(lengths), len(self.CLASSES)), dtype=bool)
+        cat_masks[scene_ids[keep], labels[keep]] = True
+        return cat_masks
+
     def load_annotations(self, ann_file):
         """Load annotations from ann_file.
 
         Args:
             ann_file (str): Path of the annotation file.
 
+        If ``ann_file`` is the directory of an info store packed by
+        :func:`pack_infos`, the infos are memory-mapped instead of loaded.
+
         Returns:
-            list[dict]: List of annotations sorted by timestamps.
+            list[dict] | :obj:`InfoStore`: Annotations sorted by timestamps.
         """
+        if osp.isdir(ann_file):
+            info_store = InfoStore(ann_file)
+            order = np.argsort(
+                info_store.column('sample', 'timestamp'), kind='stable')
+            self.info_store = info_store.select(order[::self.load_interval])
+            self.store_label_map = info_store.label_map(self.CLASSES)
+            self.metadata = info_store.metadata
+            self.version = self.metadata['version']
+            return self.info_store
+
+        self.info_store = None
         data = mmcv.load(ann_file)
         data_infos = list(sorted(data['infos'], key=lambda e: e['timestamp']))
         data_infos = data_infos[::self.load_interval]
@@ -201,7 +266,10 @@ class NuScenesDataset(Custom3DDataset):
                     from lidar to different cameras.
                 - ann_info (dict): Annotation info.
         """
-        info = self.data_infos[index]
+        if self.info_store is not None:
+            info = self.info_store.get_sample(index)
+        else:
+            info = self.data_infos[index]
         # standard protocal modified from SECOND.Pytorch
         input_dict = dict(
             sample_idx=info['token'],
@@ -267,21 +335,30 @@ class NuScenesDataset(Custom3DDataset):
                 - gt_labels_3d (np.ndarray): Labels of ground truths.
                 - gt_names (list[str]): Class names of ground truths.
         """
-        info = self.data_infos[index]
+        if self.info_store is not None:
+            info = self.info_store.get_annos(index)
+        else:
+            info = self.data_infos[index]
         # filter out bbox containing no points
         if self.use_valid_flag:
             mask = info['valid_flag']
         else:
             mask = info['num_lidar_pts'] > 0
         gt_bboxes_3d = info['gt_boxes'][mask]
-        gt_names_3d = info['gt_names'][mask]
-        gt_labels_3d = []
-        for cat in gt_names_3d:
-            if cat in self.CLASSES:
-                gt_labels_3d.append(self.CLASSES.index(cat))
-            else:
-                gt_labels_3d.append(-1)
-        gt_labels_3d = np.array(gt_labels_3d)
+        if self.info_store is not None:
+            # names are pre-encoded in the info store
+            name_ids = info['gt_names'][mask]
+            gt_names_3d = self.info_store.names[name_ids]
+            gt_labels_3d = self.store_label_map[name_ids]
+        else:
+            gt_names_3d = info['gt_names'][mask]
+            gt_labels_3d = []
+            for cat in gt_names_3d:
+                if cat in self.CLASSES:
+                    gt_labels_3d.append(self.CLASSES.index(cat))
+                else:
+                    gt_labels_3d.append(-1)
+            gt_labels_3d = np.array(gt_labels_3d)
 
         if self.with_velocity:
             gt_velocity = info['gt_velocity'][mask]
@@ -26,7 +26,10 @@ class NuScenesDataset_ViewInfo(NuScenesDataset):
         Returns:
             dict: Annotation information consists of the following keys:
         """
-        info = self.data_infos[index]
+        if self.info_store is not None:
+            info = self.info_store.get_annos(index)
+        else:
+            info = self.data_infos[index]
         # filter out bbox containing no points
         if self.use_valid_flag:
             mask = info['valid_flag']
@@ -34,7 +37,6 @@ class NuScenesDataset_ViewInfo(NuScenesDataset):
             mask = info['num_lidar_pts'] > 0
 
         gt_bboxes_3d = info['gt_boxes'][mask]
-        gt_names_3d = info['gt_names'][mask]
         gt_visible_3d = info['gt_visible'][mask]
 
         # .copy() cannot be missed!
@@ -43,23 +45,30 @@ class NuScenesDataset_ViewInfo(NuScenesDataset):
 
         gt_bboxes_lidar_view = info['gt_bboxes_lidar_view'].copy()
 
-        gt_names2d_view = info['gt_names2d_view']
         gt_viewsIDs = info['gt_viewsIDs']
-        gt_labels_3d = []
-        for cat in gt_names_3d:
-            if cat in self.CLASSES:
-                gt_labels_3d.append(self.CLASSES.index(cat))
-            else:
-                gt_labels_3d.append(-1)
-        gt_labels_3d = np.array(gt_labels_3d)
-
-        gt_labels2d_view = []
-        for cat in gt_names2d_view:
-            if cat in self.CLASSES:
-                gt_labels2d_view.append(self.CLASSES.index(cat))
-            else:
-                gt_labels2d_view.append(-1)
-        gt_labels2d_view = np.array(gt_labels2d_view)
+        if self.info_store is not None:
+            # names are pre-encoded in the info store
+            name_ids = info['gt_names'][mask]
+            gt_names_3d = self.info_store.names[name_ids]
+            gt_labels_3d = self.store_label_map[name_ids]
+            gt_labels2d_view = self.store_label_map[info['gt_names2d_view']]
+        else:
+            gt_names_3d = info['gt_names'][mask]
+            gt_labels_3d = []
+            for cat in gt_names_3d:
+                if cat in self.CLASSES:
+                    gt_labels_3d.append(self.CLASSES.index(cat))
+                else:
+                    gt_labels_3d.append(-1)
+            gt_labels_3d = np.array(gt_labels_3d)
+
+            gt_labels2d_view = []
+            for cat in info['gt_names2d_view']:
+                if cat in self.CLASSES:
+                    gt_labels2d_view.append(self.CLASSES.index(cat))
+                else:
+                    gt_labels2d_view.append(-1)
+            gt_labels2d_view = np.array(gt_labels2d_view)
         gt_labels2d_view = np.stack([gt_labels2d_view, gt_viewsIDs], axis=-1)
 
         gt_bboxes_cam_view = info['gt_bboxes_cam_view'].copy()
@@ -148,7 +157,10 @@ class NuScenesDataset_ViewInfo(NuScenesDataset):
                     from lidar to different cameras.
                 - ann_info (dict): Annotation info.
         """
-        info = self.data_infos[index]
+        if self.info_store is not None:
+            info = self.info_store.get_sample(index)
+        else:
+            info = self.data_infos[index]
         # standard protocal modified from SECOND.Pytorch
 
         input_dict = dict(
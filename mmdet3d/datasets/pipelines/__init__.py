@@ -6,12 +6,14 @@ from .loading import (LoadAnnotations3D, LoadMultiViewImageFromFiles,
                       NormalizePointsColor, PointSegClassMapping,
                       MyLoadAnnotations3D)
 from .test_time_aug import MultiScaleFlipAug3D
-from .transforms_3d import (BackgroundPointsFilter, GlobalRotScaleTrans,
+from .transforms_3d import (ApplyPointsTransform, BackgroundPointsFilter,
+                            GlobalRotScaleTrans,
                             IndoorPointSample, ObjectNoise, ObjectRangeFilter,
                             ObjectSample, PointShuffle, PointsRangeFilter,
                             RandomFlip3D, VoxelBasedPointSampler, OurRandomFlip3D,
                             OurGlobalRotScaleTrans, OurObjectRangeFilter)
-from .transforms_2d import OurRandomAffine, PhotoMetricDistortionMultiViewImage
+from .transforms_2d import (FusedMultiViewImageTransform, OurRandomAffine,
+                            PhotoMetricDistortionMultiViewImage)
 
 __all__ = [
     'ObjectSample', 'RandomFlip3D', 'ObjectNoise', 'GlobalRotScaleTrans',
@@ -22,5 +24,6 @@ __all__ = [
     'PointSegClassMapping', 'MultiScaleFlipAug3D', 'LoadPointsFromMultiSweeps',
     'BackgroundPointsFilter', 'VoxelBasedPointSampler', 'MyLoadAnnotations3D',
     'OurRandomFlip3D', 'OurGlobalRotScaleTrans', 'OurRandomAffine',
-    'PhotoMetricDistortionMultiViewImage', 'OurObjectRangeFilter'
+    'PhotoMetricDistortionMultiViewImage', 'OurObjectRangeFilter',
+    'FusedMultiViewImageTransform', 'ApplyPointsTransform'
 ]
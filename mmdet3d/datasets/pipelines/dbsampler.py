@@ -1,9 +1,9 @@
-import copy
 import mmcv
 import numpy as np
 import os
 
 from mmdet3d.core.bbox import box_np_ops
+from mmdet3d.core.points import get_points_type
 from mmdet3d.datasets.pipelines import data_augment_utils
 from mmdet.datasets import PIPELINES
 from ..registry import OBJECTSAMPLERS
@@ -89,6 +89,12 @@ class DataBaseSampler(object):
         classes (list[str]): List of classes. Default: None.
         points_loader(dict): Config of points loader. Default: dict(
             type='LoadPointsFromFile', load_dim=4, use_dim=[0,1,2,3])
+
+    Note:
+        The points of the database infos with a ``points_offset`` are rows
+        of one packed file written by ``create_groundtruth_database`` with
+        ``packed=True``. The packed file is memory-mapped once per process
+        and the points of the sampled objects are sliced from it.
     """
 
     def __init__(self,
@@ -112,6 +118,7 @@ class DataBaseSampler(object):
         self.cat2label = {name: i for i, name in enumerate(classes)}
         self.label2cat = {i: name for i, name in enumerate(classes)}
         self.points_loader = mmcv.build_from_cfg(points_loader, PIPELINES)
+        self._packed_points = dict()
 
         db_infos = mmcv.load(info_path)
 
@@ -146,6 +153,12 @@ class DataBaseSampler(object):
             self.sampler_dict[k] = BatchSampler(v, k, shuffle=True)
         # TODO: No group_sampling currently
 
+    def __getstate__(self):
+        # memory maps are reopened by each process instead of pickled
+        state = self.__dict__.copy()
+        state['_packed_points'] = dict()
+        return state
+
     @staticmethod
     def filter_by_difficulty(db_infos, removed_difficulty):
         """Filter ground truths by difficulties.
@@ -217,48 +230,31 @@ class DataBaseSampler(object):
             sampled_num_dict[class_name] = sampled_num
             sample_num_per_class.append(sampled_num)
 
-        sampled = []
-        sampled_gt_bboxes = []
-        avoid_coll_boxes = gt_bboxes
-
+        sampled_per_class = []
         for class_name, sampled_num in zip(self.sample_classes,
                                            sample_num_per_class):
             if sampled_num > 0:
-                sampled_cls = self.sample_class_v2(class_name, sampled_num,
-                                                   avoid_coll_boxes)
-
-                sampled += sampled_cls
-                if len(sampled_cls) > 0:
-                    if len(sampled_cls) == 1:
-                        sampled_gt_box = sampled_cls[0]['box3d_lidar'][
-                            np.newaxis, ...]
-                    else:
-                        sampled_gt_box = np.stack(
-                            [s['box3d_lidar'] for s in sampled_cls], axis=0)
-
-                    sampled_gt_bboxes += [sampled_gt_box]
-                    avoid_coll_boxes = np.concatenate(
-                        [avoid_coll_boxes, sampled_gt_box], axis=0)
+                sampled_per_class.append(
+                    self.sampler_dict[class_name].sample(sampled_num))
+        sampled = self.collision_filter(gt_bboxes, sampled_per_class)
 
         ret = None
         if len(sampled) > 0:
-            sampled_gt_bboxes = np.concatenate(sampled_gt_bboxes, axis=0)
-            # center = sampled_gt_bboxes[:, 0:3]
-
-            # num_sampled = len(sampled)
-            s_points_list = []
-            count = 0
-            for info in sampled:
-                file_path = os.path.join(
-                    self.data_root,
-                    info['path']) if self.data_root else info['path']
-                results = dict(pts_filename=file_path)
-                s_points = self.points_loader(results)['points']
-                s_points.translate(info['box3d_lidar'][:3])
-
-                count += 1
-
-                s_points_list.append(s_points)
+            sampled_gt_bboxes = np.stack([s['box3d_lidar'] for s in sampled],
+                                         axis=0)
+            if all('points_offset' in info for info in sampled):
+                s_points = self._sample_packed_points(sampled)
+            else:
+                s_points_list = []
+                for info in sampled:
+                    file_path = os.path.join(
+                        self.data_root,
+                        info['path']) if self.data_root else info['path']
+                    results = dict(pts_filename=file_path)
+                    s_points = self.points_loader(results)['points']
+                    s_points.translate(info['box3d_lidar'][:3])
+                    s_points_list.append(s_points)
+                s_points = s_points_list[0].cat(s_points_list)
 
             gt_labels = np.array([self.cat2label[s['name']] for s in sampled],
                                  dtype=np.long)
@@ -268,7 +264,7 @@ class DataBaseSampler(object):
                 'gt_bboxes_3d':
                 sampled_gt_bboxes,
                 'points':
-                s_points_list[0].cat(s_points_list),
+                s_points,
                 'group_ids':
                 np.arange(gt_bboxes.shape[0],
                           gt_bboxes.shape[0] + len(sampled))
@@ -276,6 +272,92 @@ class DataBaseSampler(object):
 
         return ret
 
+    def _get_packed_points(self, path):
+        """Get the points of a packed database file.
+
+        Args:
+            path (str): Path of the packed file in the database infos.
+
+        Returns:
+            np.ndarray: Points of all objects in the packed file.
+        """
+        if path not in self._packed_points:
+            file_path = os.path.join(self.data_root,
+                                     path) if self.data_root else path
+            if self.points_loader.file_client_args.get('backend') == 'disk':
+                points = np.memmap(file_path, dtype=np.float32, mode='r')
+            else:
+                points = self.points_loader._load_points(file_path)
+            self._packed_points[path] = points.reshape(
+                -1, self.points_loader.load_dim)
+        return self._packed_points[path]
+
+    def _sample_packed_points(self, sampled):
+        """Slice the points of sampled objects from the packed database.
+
+        Args:
+            sampled (list[dict]): Infos of the sampled objects.
+
+        Returns:
+            :obj:`BasePoints`: Points of the sampled objects moved to their
+                boxes.
+        """
+        assert not self.points_loader.shift_height, \
+            'shift_height is not supported by the packed database'
+        s_points = np.concatenate([
+            self._get_packed_points(info['path'])[
+                info['points_offset']:info['points_offset'] +
+                info['num_points_in_gt']] for info in sampled
+        ])[:, self.points_loader.use_dim]
+        s_points[:, :3] += np.repeat(
+            np.stack([info['box3d_lidar'][:3] for info in sampled]),
+            [info['num_points_in_gt'] for info in sampled],
+            axis=0)
+        points_class = get_points_type(self.points_loader.coord_type)
+        return points_class(s_points, points_dim=s_points.shape[-1])
+
+    def collision_filter(self, gt_bboxes, sampled_per_class):
+        """Drop the sampled objects colliding with other objects.
+
+        The collisions of all sampled classes are tested together. A sampled
+        object is kept if it collides neither with the ground truths nor
+        with the kept objects of the earlier classes nor with the other
+        objects of its class, as calling :meth:`sample_class_v2` class by
+        class.
+
+        Args:
+            gt_bboxes (np.ndarray): Ground truth boxes.
+            sampled_per_class (list[list[dict]]): Sampled objects of each
+                class.
+
+        Returns:
+            list[dict]: Valid samples after collision test.
+        """
+        sampled = [info for sampled_cls in sampled_per_class
+                   for info in sampled_cls]
+        if len(sampled) == 0:
+            return []
+        num_gt = gt_bboxes.shape[0]
+        sp_boxes = np.stack([info['box3d_lidar'] for info in sampled], axis=0)
+        boxes = np.concatenate([gt_bboxes, sp_boxes], axis=0)
+        total_bv = box_np_ops.center_to_corner_box2d(
+            boxes[:, 0:2], boxes[:, 3:5], boxes[:, 6])
+        coll_mat = data_augment_utils.box_collision_test(total_bv, total_bv)
+        diag = np.arange(total_bv.shape[0])
+        coll_mat[diag, diag] = False
+
+        # the objects of the later classes are not sampled yet for a class
+        class_nums = [len(sampled_cls) for sampled_cls in sampled_per_class]
+        class_ends = np.repeat(num_gt + np.cumsum(class_nums), class_nums)
+        valid_samples = []
+        for i in range(num_gt, num_gt + len(sampled)):
+            if coll_mat[i, :class_ends[i - num_gt]].any():
+                coll_mat[i] = False
+                coll_mat[:, i] = False
+            else:
+                valid_samples.append(sampled[i - num_gt])
+        return valid_samples
+
     def sample_class_v2(self, name, num, gt_bboxes):
         """Sampling specific categories of bounding boxes.
 
@@ -288,7 +370,6 @@ class DataBaseSampler(object):
             list[dict]: Valid samples after collision test.
         """
         sampled = self.sampler_dict[name].sample(num)
-        sampled = copy.deepcopy(sampled)
         num_gt = gt_bboxes.shape[0]
         num_sampled = len(sampled)
         gt_bboxes_bv = box_np_ops.center_to_corner_box2d(
@@ -9,6 +9,7 @@ import numpy as np
 from numpy import random
 
 from mmdet.datasets.builder import PIPELINES
+from .loading import MyNormalize, MyPad, MyResize
 
 
 @PIPELINES.register_module()
@@ -193,14 +194,17 @@ class OurRandomAffine:
             results['cam_intrinsic'][id] = intrinsic
         return results
 
-    def __call__(self, results):
-        translate_mats = []
-        scale_mats = []
+    def _get_warp_params(self, results):
+        """Randomly draw the flip and the warp matrix of each view.
+
+        Returns:
+            tuple: Flips, warp matrices, scaling ratios and valid shapes of
+                the views, and the width and height of the warped images.
+        """
         warp_mats = []
         flips = []
         scaling_ratios = []
         valid_shapes = []
-        results['image_flip'] = []
 
         flip_3d = False
         if 'pcd_horizontal_flip' in results and results['pcd_horizontal_flip'] == True:
@@ -220,13 +224,7 @@ class OurRandomAffine:
                 flip = flip_3d
             else:
                 flip = True if np.random.random() < self.flip_ratio else False
-
             flips.append(flip)
-            if flip:
-                results['image_flip'].append(True)
-                img = cv2.flip(img, 1)
-            else:
-                results['image_flip'].append(False)
 
             # Scaling
             if not self.scaling_sync_view:
@@ -253,27 +251,38 @@ class OurRandomAffine:
             translate_matrix = self._get_translation_matrix(trans_x, trans_y)
 
             warp_matrix = translate_matrix  @ scaling_matrix
+            warp_mats.append(warp_matrix)
+
+        return flips, warp_mats, scaling_ratios, valid_shapes, width, height
+
+    def _transform_annotations(self, results, flips, warp_mats, scaling_ratios, valid_shapes, width, height):
+        """Warp the 2D annotations and the cameras like the images."""
+        results['image_flip'] = list(flips)
+        results['valid_shape'] = np.array(valid_shapes)
+        results['img_scale_ratios'] = np.array(scaling_ratios)
+        if 'gt_bboxes' in results:
+            results = self._transform_bbox(results, warp_mats, flips, width, height)
+        results = self._transform_camera(results, warp_mats, flips, width)
+        return results
 
+    def __call__(self, results):
+        warp_params = self._get_warp_params(results)
+        flips, warp_mats, _, _, width, height = warp_params
+
+        for view_id in range(len(results['img'])):
+            img = results['img'][view_id]
+            if flips[view_id]:
+                img = cv2.flip(img, 1)
             img = cv2.warpPerspective(
                 img,
-                warp_matrix,
+                warp_mats[view_id],
                 dsize=(width, height),
                 borderValue=self.border_val
             )
-
             results['img'][view_id] = img
-            translate_mats.append(translate_matrix)
-            scale_mats.append(scaling_matrix)
-            warp_mats.append(warp_matrix)
             # results['img_shape'] = img.shape
 
-        results['valid_shape'] = np.array(valid_shapes)
-        results['img_scale_ratios'] = np.array(scaling_ratios)
-        if 'gt_bboxes' in results:
-            results = self._transform_bbox(results, warp_mats, flips, width, height)
-        results = self._transform_camera(results, warp_mats, flips, width)
-
-        return results
+        return self._transform_annotations(results, *warp_params)
 
     def __repr__(self):
         repr_str = self.__class__.__name__
@@ -310,6 +319,149 @@ class OurRandomAffine:
         return flip_matrix
 
 
+@PIPELINES.register_module()
+class FusedMultiViewImageTransform:
+    """Random affine, resize, normalize and pad the multi-view images in one
+    pass.
+
+    Equivalent to running ``OurRandomAffine``, ``MyResize``, ``MyNormalize``
+    and ``MyPad`` one after another, except that the flip, the affine warp
+    and the resizing of each view are multiplied into a single matrix and the
+    view is sampled once with ``cv2.warpPerspective``. The views are written
+    into one preallocated buffer which is already padded, normalized on the
+    way when ``normalize`` is given. The random draws and the updates of
+    ``cam_intrinsic``, ``lidar2img``, ``valid_shape``, the 2D boxes and the
+    centers are done by the separate transforms, so they are the same as
+    running them in sequence.
+
+    Args:
+        affine (dict, optional): Arguments of ``OurRandomAffine``.
+            Defaults to None, no affine transform.
+        resize (dict): Arguments of ``MyResize``. Only the ``cv2`` backend
+            is supported.
+        normalize (dict, optional): Arguments of ``MyNormalize``. Defaults
+            to None, the images keep their dtype, e.g. uint8. They also keep
+            it with ``on_device=True``, to be normalized by the detector.
+        pad (dict): Arguments of ``MyPad``.
+    """
+
+    def __init__(self, resize, pad, affine=None, normalize=None):
+        self.affine = None if affine is None else OurRandomAffine(**affine)
+        self.resize = MyResize(**resize)
+        self.normalize = None if normalize is None else MyNormalize(**normalize)
+        self.normalize_on_host = self.normalize is not None and not self.normalize.on_device
+        self.pad = MyPad(**pad)
+        assert self.resize.backend == 'cv2', \
+            'FusedMultiViewImageTransform only supports the cv2 backend'
+
+    def _get_pad_shape(self, height, width):
+        if self.pad.size is not None:
+            pad_height, pad_width = self.pad.size
+            assert pad_height >= height and pad_width >= width
+        else:
+            divisor = self.pad.size_divisor
+            pad_height = int(np.ceil(height / divisor)) * divisor
+            pad_width = int(np.ceil(width / divisor)) * divisor
+        return pad_height, pad_width
+
+    def _write_view(self, img, warp_matrix, dst, border_mode, border_val, buffer):
+        """Sample a view into ``dst``, normalizing it through ``buffer``."""
+        height, width = dst.shape[:2]
+        out = buffer if self.normalize_on_host else dst
+        warped = cv2.warpPerspective(
+            img,
+            warp_matrix,
+            dsize=(width, height),
+            dst=out,
+            flags=cv2.INTER_LINEAR,
+            borderMode=border_mode,
+            borderValue=border_val)
+        if warped is not out:
+            # the array could not be written in place
+            out[...] = warped.reshape(out.shape)
+        if self.normalize_on_host:
+            if self.normalize.to_rgb:
+                out = out[..., ::-1]
+            np.subtract(out, self.normalize.mean, out=dst, dtype=np.float32)
+            np.multiply(dst, 1 / self.normalize.std, out=dst)
+
+    def __call__(self, results):
+        """Call function to transform the multi-view images.
+
+        Args:
+            results (dict): Result dict from loading pipeline.
+
+        Returns:
+            dict: Result dict with the transformed images and annotations.
+        """
+        imgs = results['img']
+        img_height, img_width = imgs[0].shape[:2]
+        channel_shape = imgs[0].shape[2:]
+
+        # the warps of all views in the coordinates of the pixel centers
+        # of cv2.flip, cv2.warpPerspective and cv2.resize
+        warp_mats = [np.eye(3) for _ in imgs]
+        if self.affine is not None:
+            warp_params = self.affine._get_warp_params(results)
+            flips, affine_mats, _, _, width, height = warp_params
+            for view_id, flip in enumerate(flips):
+                if flip:
+                    warp_mats[view_id][0] = [-1, 0, img_width - 1]
+                warp_mats[view_id] = affine_mats[view_id] @ warp_mats[view_id]
+            border_mode = cv2.BORDER_CONSTANT
+            border_val = self.affine.border_val
+        else:
+            width, height = img_width, img_height
+            border_mode = cv2.BORDER_REPLICATE
+            border_val = 0
+
+        self.resize._set_scale(results)
+        new_width, new_height = self.resize._get_img_size(results, width, height)
+        w_scale = new_width / width
+        h_scale = new_height / height
+        resize_matrix = np.array([[w_scale, 0, 0.5 * w_scale - 0.5],
+                                  [0, h_scale, 0.5 * h_scale - 0.5],
+                                  [0, 0, 1]])
+
+        pad_height, pad_width = self._get_pad_shape(new_height, new_width)
+        dtype = np.float32 if self.normalize_on_host else imgs[0].dtype
+        padded_imgs = np.empty((len(imgs), pad_height, pad_width) + channel_shape, dtype=dtype)
+        padded_imgs[:, new_height:] = self.pad.pad_val
+        padded_imgs[:, :new_height, new_width:] = self.pad.pad_val
+        buffer = None
+        if self.normalize_on_host:
+            buffer = np.empty((new_height, new_width) + channel_shape, dtype=imgs[0].dtype)
+        for view_id, img in enumerate(imgs):
+            self._write_view(img, resize_matrix @ warp_mats[view_id],
+                             padded_imgs[view_id, :new_height, :new_width],
+                             border_mode, border_val, buffer)
+        results['img'] = list(padded_imgs)
+
+        if self.affine is not None:
+            results = self.affine._transform_annotations(results, *warp_params)
+        self.resize._set_scale_factor(results, (new_height, new_width) + channel_shape, w_scale, h_scale)
+        self.resize._resize_annotations(results)
+        if self.normalize is not None:
+            results['img_norm_cfg'] = dict(
+                mean=self.normalize.mean, std=self.normalize.std, to_rgb=self.normalize.to_rgb)
+            if self.normalize.on_device:
+                results['img_norm_cfg']['on_device'] = True
+        results['pad_shape'] = padded_imgs.shape[1:]
+        results['pad_fixed_size'] = self.pad.size
+        results['pad_size_divisor'] = self.pad.size_divisor
+        self.pad._pad_masks(results)
+        self.pad._pad_seg(results)
+        return results
+
+    def __repr__(self):
+        repr_str = self.__class__.__name__
+        repr_str += f'(affine={self.affine}, '
+        repr_str += f'resize={self.resize}, '
+        repr_str += f'normalize={self.normalize}, '
+        repr_str += f'pad={self.pad})'
+        return repr_str
+
+
 @PIPELINES.register_module()
 class PhotoMetricDistortionMultiViewImage:
     """Apply photometric distortion to image sequentially, every transformation
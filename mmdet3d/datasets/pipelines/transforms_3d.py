@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 from mmcv import is_tuple_of
 from mmcv.utils import build_from_cfg
 
@@ -10,6 +11,21 @@ from ..registry import OBJECTSAMPLERS
 from .data_augment_utils import noise_per_object_v3_
 
 
+def _defer_points_transform(input_dict, matrix):
+    """Compose an affine transform into the deferred transform of the points.
+
+    The points and the camera extrinsics are left untouched and the composed
+    transform is applied once by :class:`ApplyPointsTransform`.
+
+    Args:
+        input_dict (dict): Result dict from loading pipeline.
+        matrix (np.ndarray): Transform of the LiDAR coordinates in the shape
+            of [4, 4], applied after the deferred ones.
+    """
+    transform = input_dict.get('pcd_transform', np.eye(4))
+    input_dict['pcd_transform'] = matrix @ transform
+
+
 @PIPELINES.register_module()
 class RandomFlip3D(RandomFlip):
     """Flip the points & bbox.
@@ -132,16 +148,21 @@ class OurRandomFlip3D(object):
             in horizontal direction. Defaults to 0.0.
         flip_ratio_bev_vertical (float, optional): The flipping probability
             in vertical direction. Defaults to 0.0.
+        defer (bool, optional): Whether to defer the flip of the points and
+            the camera extrinsics to :class:`ApplyPointsTransform`.
+            Defaults to False.
     """
 
     def __init__(self,
                  sync_2d=True,
                  flip_ratio_bev_horizontal=0.0,
                  flip_ratio_bev_vertical=0.0,
+                 defer=False,
                  **kwargs):
         # super(OurRandomFlip3D, self).__init__(
         #     flip_ratio=flip_ratio_bev_horizontal, **kwargs)
         self.sync_2d = sync_2d
+        self.defer = defer
         self.flip_ratio = flip_ratio_bev_horizontal
         self.flip_ratio_bev_vertical = flip_ratio_bev_vertical
         if flip_ratio_bev_horizontal is not None:
@@ -170,9 +191,6 @@ class OurRandomFlip3D(object):
             input_dict['empty_box3d'] = input_dict['box_type_3d'](
                 np.array([], dtype=np.float32))
         assert len(input_dict['bbox3d_fields']) == 1
-        for key in input_dict['bbox3d_fields']:
-            input_dict['points'] = input_dict[key].flip(
-                direction, points=input_dict['points'])
 
         if direction == 'horizontal':
             diag = np.ones(3)
@@ -182,8 +200,16 @@ class OurRandomFlip3D(object):
             diag[0] = -1
 
         matrix = np.diag(diag)
-        for id in range(len(input_dict['lidar2cam_r'])):
-            input_dict['lidar2cam_r'][id] = input_dict['lidar2cam_r'][id] @ matrix
+        if self.defer:
+            for key in input_dict['bbox3d_fields']:
+                input_dict[key].flip(direction)
+            _defer_points_transform(input_dict, np.diag([*diag, 1]))
+        else:
+            for key in input_dict['bbox3d_fields']:
+                input_dict['points'] = input_dict[key].flip(
+                    direction, points=input_dict['points'])
+            for id in range(len(input_dict['lidar2cam_r'])):
+                input_dict['lidar2cam_r'][id] = input_dict['lidar2cam_r'][id] @ matrix
 
         if 'gt_pts_centers_view' in input_dict and input_dict['gt_pts_centers_view'].shape[0] > 0:
             input_dict['gt_pts_centers_view'] = input_dict['gt_pts_centers_view'] @ matrix
@@ -234,8 +260,9 @@ class OurRandomFlip3D(object):
         """str: Return a string that describes the module."""
         repr_str = self.__class__.__name__
         repr_str += '(sync_2d={},'.format(self.sync_2d)
-        repr_str += 'flip_ratio_bev_vertical={})'.format(
+        repr_str += 'flip_ratio_bev_vertical={},'.format(
             self.flip_ratio_bev_vertical)
+        repr_str += 'defer={})'.format(self.defer)
         return repr_str
 
 
@@ -572,17 +599,24 @@ class OurGlobalRotScaleTrans(object):
         shift_height (bool): Whether to shift height.
             (the fourth dimension of indoor points) when scaling.
             Defaults to False.
+        defer (bool): Whether to defer the transform of the points and the
+            camera extrinsics to :class:`ApplyPointsTransform`, which applies
+            all the deferred transforms in one pass. Defaults to False.
     """
 
     def __init__(self,
                  rot_range=[-0.78539816, 0.78539816],
                  scale_ratio_range=[0.95, 1.05],
                  translation_std=[0, 0, 0],
-                 shift_height=False):
+                 shift_height=False,
+                 defer=False):
         self.rot_range = rot_range
         self.scale_ratio_range = scale_ratio_range
         self.translation_std = translation_std
         self.shift_height = shift_height
+        self.defer = defer
+        assert not (shift_height and defer), \
+            'the height of the points cannot be deferred'
 
     def _trans_bbox_points(self, input_dict):
         """Private function to translate bounding boxes and points.
@@ -605,13 +639,18 @@ class OurGlobalRotScaleTrans(object):
         translation_std = np.array(translation_std, dtype=np.float32)
         trans_factor = np.random.normal(scale=translation_std, size=3).T
 
-        input_dict['points'].translate(trans_factor)
         input_dict['pcd_trans'] = trans_factor
         for key in input_dict['bbox3d_fields']:
             input_dict[key].translate(trans_factor)
 
-        for id in range(len(input_dict['lidar2cam_t'])):
-            input_dict['lidar2cam_t'][id] = input_dict['lidar2cam_t'][id] - input_dict['lidar2cam_r'][id] @ trans_factor
+        if self.defer:
+            matrix = np.eye(4)
+            matrix[:3, 3] = trans_factor
+            _defer_points_transform(input_dict, matrix)
+        else:
+            input_dict['points'].translate(trans_factor)
+            for id in range(len(input_dict['lidar2cam_t'])):
+                input_dict['lidar2cam_t'][id] = input_dict['lidar2cam_t'][id] - input_dict['lidar2cam_r'][id] @ trans_factor
 
         if 'gt_pts_centers_view' in input_dict:
             input_dict['gt_pts_centers_view'] = input_dict['gt_pts_centers_view'] + trans_factor
@@ -634,15 +673,28 @@ class OurGlobalRotScaleTrans(object):
         rot_mat_T = None
         for key in input_dict['bbox3d_fields']:
             if len(input_dict[key].tensor) != 0:
-                points, rot_mat_T = input_dict[key].rotate(
-                    noise_rotation, input_dict['points'])
-                input_dict['points'] = points
+                if self.defer:
+                    input_dict[key].rotate(noise_rotation)
+                    rot_sin = np.sin(noise_rotation)
+                    rot_cos = np.cos(noise_rotation)
+                    rot_mat_T = input_dict[key].tensor.new_tensor(
+                        [[rot_cos, -rot_sin, 0], [rot_sin, rot_cos, 0],
+                         [0, 0, 1]])
+                else:
+                    points, rot_mat_T = input_dict[key].rotate(
+                        noise_rotation, input_dict['points'])
+                    input_dict['points'] = points
                 input_dict['pcd_rotation'] = rot_mat_T
 
         if rot_mat_T is not None:
             rot_mat_T_np = rot_mat_T.numpy()
-            for id in range(len(input_dict['lidar2cam_r'])):
-                input_dict['lidar2cam_r'][id] = input_dict['lidar2cam_r'][id] @ rot_mat_T_np
+            if self.defer:
+                matrix = np.eye(4)
+                matrix[:3, :3] = rot_mat_T_np.T
+                _defer_points_transform(input_dict, matrix)
+            else:
+                for id in range(len(input_dict['lidar2cam_r'])):
+                    input_dict['lidar2cam_r'][id] = input_dict['lidar2cam_r'][id] @ rot_mat_T_np
 
             if input_dict['gt_pts_centers_view'].shape[0] > 0:
                 input_dict['gt_pts_centers_view'] = input_dict['gt_pts_centers_view'] @ rot_mat_T_np
@@ -661,12 +713,18 @@ class OurGlobalRotScaleTrans(object):
                 input_dict['bbox3d_fields'] are updated in the result dict.
         """
         scale = input_dict['pcd_scale_factor']
-        points = input_dict['points']
-        points.scale(scale)
-        if self.shift_height:
-            assert 'height' in points.attribute_dims.keys()
-            points.tensor[:, points.attribute_dims['height']] *= scale
-        input_dict['points'] = points
+        if self.defer:
+            _defer_points_transform(input_dict, np.diag([scale] * 3 + [1]))
+        else:
+            points = input_dict['points']
+            points.scale(scale)
+            if self.shift_height:
+                assert 'height' in points.attribute_dims.keys()
+                points.tensor[:, points.attribute_dims['height']] *= scale
+            input_dict['points'] = points
+
+            for id in range(len(input_dict['lidar2cam_t'])):
+                input_dict['lidar2cam_t'][id] = input_dict['lidar2cam_t'][id] * scale
 
         for key in input_dict['bbox3d_fields']:
             input_dict[key].scale(scale)
@@ -674,9 +732,6 @@ class OurGlobalRotScaleTrans(object):
         if 'gt_img_centers_view' in input_dict and input_dict['gt_img_centers_view'].shape[0] > 0:
             input_dict['gt_img_centers_view'][:, 2] *= scale
 
-        for id in range(len(input_dict['lidar2cam_t'])):
-            input_dict['lidar2cam_t'][id] = input_dict['lidar2cam_t'][id] * scale
-
         if 'gt_pts_centers_view' in input_dict and input_dict['gt_pts_centers_view'].shape[0] > 0:
             input_dict['gt_pts_centers_view'] = input_dict['gt_pts_centers_view'] * scale
 
@@ -741,6 +796,95 @@ class OurGlobalRotScaleTrans(object):
         repr_str += ' scale_ratio_range={},'.format(self.scale_ratio_range)
         repr_str += ' translation_std={})'.format(self.translation_std)
         repr_str += ' shift_height={})'.format(self.shift_height)
+        repr_str += ' defer={})'.format(self.defer)
+        return repr_str
+
+
+@PIPELINES.register_module()
+class ApplyPointsTransform(object):
+    """Apply the deferred transforms to the points and filter them.
+
+    The transforms deferred by ``OurGlobalRotScaleTrans`` and
+    ``OurRandomFlip3D`` with ``defer=True`` are composed into one matrix in
+    ``pcd_transform``, which is applied to the points in place with a single
+    matmul and to the extrinsics of all the cameras at once. The points are
+    then filtered by the range and shuffled with one gather, which replaces
+    ``PointsRangeFilter`` and ``PointShuffle``.
+
+    Args:
+        point_cloud_range (list[float], optional): Point cloud range.
+            Defaults to None, no filtering.
+        shuffle (bool, optional): Whether to shuffle the points.
+            Defaults to False.
+    """
+
+    def __init__(self, point_cloud_range=None, shuffle=False):
+        if point_cloud_range is not None:
+            point_cloud_range = np.array(point_cloud_range, dtype=np.float32)
+        self.pcd_range = point_cloud_range
+        self.shuffle = shuffle
+
+    def _transform_points(self, input_dict, transform):
+        """Private function to transform the points and the extrinsics.
+
+        Args:
+            input_dict (dict): Result dict from loading pipeline.
+            transform (np.ndarray): Composed transform in the shape of
+                [4, 4], a rotation and flip scaled by one factor followed by
+                a translation.
+        """
+        scale = np.linalg.norm(transform[:3, 0])
+        rotation = transform[:3, :3] / scale
+        translation = transform[:3, 3]
+
+        xyz = input_dict['points'].tensor[:, :3]
+        xyz.copy_(
+            torch.addmm(
+                xyz.new_tensor(translation), xyz,
+                xyz.new_tensor(transform[:3, :3].T)))
+
+        # the extrinsics keep their rotation and scale the camera coordinates
+        if len(input_dict.get('lidar2cam_r', [])) > 0:
+            lidar2cam_r = np.stack(input_dict['lidar2cam_r']) @ rotation.T
+            lidar2cam_t = scale * np.stack(input_dict['lidar2cam_t']) - \
+                lidar2cam_r @ translation
+            input_dict['lidar2cam_r'] = list(lidar2cam_r)
+            input_dict['lidar2cam_t'] = list(lidar2cam_t)
+
+    def __call__(self, input_dict):
+        """Call function to transform, filter and shuffle the points.
+
+        Args:
+            input_dict (dict): Result dict from loading pipeline.
+
+        Returns:
+            dict: Results after transforming, 'points', 'lidar2cam_r' and \
+                'lidar2cam_t' keys are updated in the result dict.
+        """
+        transform = input_dict.pop('pcd_transform', None)
+        if transform is not None:
+            self._transform_points(input_dict, transform)
+
+        points = input_dict['points']
+        if self.pcd_range is None and not self.shuffle:
+            return input_dict
+        if self.pcd_range is not None:
+            inds = points.in_range_3d(self.pcd_range).nonzero(
+                as_tuple=False).squeeze(1)
+            if self.shuffle:
+                inds = inds[torch.randperm(len(inds), device=inds.device)]
+        else:
+            inds = torch.randperm(len(points), device=points.tensor.device)
+        input_dict['points'] = points[inds]
+        return input_dict
+
+    def __repr__(self):
+        """str: Return a string that describes the module."""
+        repr_str = self.__class__.__name__
+        point_cloud_range = None if self.pcd_range is None \
+            else self.pcd_range.tolist()
+        repr_str += '(point_cloud_range={},'.format(point_cloud_range)
+        repr_str += ' shuffle={})'.format(self.shuffle)
         return repr_str
 
 
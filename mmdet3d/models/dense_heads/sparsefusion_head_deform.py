@@ -9,12 +9,13 @@ from mmcv.runner import force_fp32
 from torch import nn
 import torch.nn.functional as F
 import time
+from collections import OrderedDict
 
-from mmdet3d.core import (circle_nms, draw_heatmap_gaussian, gaussian_radius,
+from mmdet3d.core import (batched_circle_nms, draw_heatmap_gaussian, draw_heatmap_gaussian_batch, gaussian_radius,
                           xywhr2xyxyr, limit_period, PseudoSampler, BboxOverlaps3D)
 from mmdet3d.models.builder import HEADS, build_loss
 from mmdet3d.ops.iou3d.iou3d_utils import nms_gpu
-from mmdet3d.models.utils import clip_sigmoid, inverse_sigmoid
+from mmdet3d.models.utils import clip_sigmoid, inverse_sigmoid, topk_indices
 from mmdet3d.models.fusion_layers import apply_3d_transformation
 from mmdet.core import build_bbox_coder, multi_apply, build_assigner, build_sampler, AssignResult
 
@@ -27,6 +28,8 @@ from mmdet3d.models.utils.deformable_decoder import DeformableTransformerDecoder
 
 from mmdet3d.core.feature_aligner.aligner import FeatureAligner
 from mmdet3d.core.feature_aligner.center_loss import CrossModalCenterLoss
+from mmdet3d.core.feature_aligner.calibration import CalibrationState, CalibrationTable
+from mmdet3d.core.bbox.assigners import start_batch_linear_assignment
 import wandb
 
 
@@ -82,6 +85,16 @@ class SparseFusionHead2D_Deform(nn.Module):
                  geometric_transfer=True,
                  view_transform=True,
                  depth_input_channel=2,
+                 calibrated_fusion=False,
+                 calib_checkpoint=None,
+                 calib_layer_id='',
+                 calib_topk=10,
+                 calib_fp16=False,
+                 calib_debug=False,
+                 calib_table=None,
+                 calib_collect=False,
+                 projection_cache=False,
+                 projection_cache_size=16,
                  ):
         super(SparseFusionHead2D_Deform, self).__init__()
         self.num_proposals = num_proposals
@@ -135,6 +148,18 @@ class SparseFusionHead2D_Deform(nn.Module):
         )
         
         self.run_mode = run_mode
+
+        # aligner and class centers used to score the fused queries, resident on the model device
+        self.calibration = None
+        self.calib_checkpoint = calib_checkpoint
+        self.calib_layer_id = calib_layer_id
+        if calibrated_fusion:
+            # calib_table is written by CalibrationTableHook during a run with calib_collect=True
+            table = CalibrationTable.load(calib_table) if calib_table is not None else None
+            self.calibration = CalibrationState(
+                self.feature_aligner, self.center_loss, topk=calib_topk, fp16=calib_fp16, debug=calib_debug,
+                table=table, collect=calib_collect
+            )
         ####################
         
         heads3d = copy.deepcopy(common_heads)
@@ -197,7 +222,7 @@ class SparseFusionHead2D_Deform(nn.Module):
             prediction_heads=fusion_prediction_heads, ffn_channel=ffn_channel, dropout=dropout,
             activation=activation, test_cfg=test_cfg, query_pos=fusion_query_pos_embed, key_pos=fusion_query_pos_embed,
             pts_projection=fuse_pts_projection, img_projection=fuse_img_projection,
-            num_proposals=num_proposals
+            num_proposals=num_proposals, calibration=self.calibration
         )
 
         if self.initialize_by_heatmap and self.semantic_transfer:
@@ -255,6 +280,10 @@ class SparseFusionHead2D_Deform(nn.Module):
         y_size = self.test_cfg['grid_size'][1] // self.test_cfg['out_size_factor']
         self.bev_pos = self.create_2D_grid(x_size, y_size)
 
+        # projections of the BEV grid by a fixed camera rig, keyed by the host-side calibration (opt-in)
+        self.projection_cache = OrderedDict() if projection_cache else None
+        self.projection_cache_size = projection_cache_size
+
         if self.initialize_by_heatmap:
             self.heatmap_head = self.build_heatmap(hidden_channel, bias, num_classes)
             self.img_heatmap_head = nn.ModuleList()
@@ -312,6 +341,10 @@ class SparseFusionHead2D_Deform(nn.Module):
         self.level_pos = nn.Parameter(level_pos, requires_grad=True)
         torch.nn.init.normal_(self.level_pos)
 
+        # restore the calibration weights overwritten by the initialization above
+        if self.calibration is not None and self.calib_checkpoint is not None:
+            self.calibration.load_from_checkpoint(self.calib_checkpoint, layer_id=self.calib_layer_id)
+
     def _init_assigner_sampler(self):
         """Initialize the target assigner and sampler of the head."""
         if self.train_cfg is None:
@@ -676,16 +709,19 @@ class SparseFusionHead2D_Deform(nn.Module):
         # lidar_feat = self.heatmap_pts_proj(lidar_feat)
 
         lidar_feat_flatten = lidar_feat.reshape(batch_size, self.hidden_channel, H*W)  # [bs, C, H*W]
-        lidar_feat_output = torch.zeros(batch_size, self.hidden_channel, H*W).to(lidar_feat.device)
-        lidar_feat_count = torch.zeros(batch_size, 1, H*W).to(lidar_feat.device)
 
-        bev_pos = self.bev_pos.repeat(batch_size, 1, 1).to(lidar_feat.device)
-        query_pos_realmetric = bev_pos.permute(0, 2, 1) * self.test_cfg['out_size_factor'] * \
-                               self.test_cfg['voxel_size'][0] + self.test_cfg['pc_range'][0]  # (bs, 2, H*W)
+        if self.projection_cache is None:
+            bev_pos = self.bev_pos.repeat(batch_size, 1, 1).to(lidar_feat.device)
+            query_pos_realmetric = bev_pos.permute(0, 2, 1) * self.test_cfg['out_size_factor'] * \
+                                   self.test_cfg['voxel_size'][0] + self.test_cfg['pc_range'][0]  # (bs, 2, H*W)
 
-        query_pos_3d = torch.cat([query_pos_realmetric, voxel_height[:, None]], dim=1) # (bs, 3, H*W)
-        points_4d = torch.cat([query_pos_3d, torch.ones_like(query_pos_3d[:, :1])], dim=1).permute(0, 2, 1)  # (bs, H*W, 4)
-        points_2d = torch.matmul(points_4d[:, None], lidar2img_rt.transpose(-1, -2))  # (bs, num_view, H*W, 4)
+            query_pos_3d = torch.cat([query_pos_realmetric, voxel_height[:, None]], dim=1) # (bs, 3, H*W)
+            points_4d = torch.cat([query_pos_3d, torch.ones_like(query_pos_3d[:, :1])], dim=1).permute(0, 2, 1)  # (bs, H*W, 4)
+            points_2d = torch.matmul(points_4d[:, None], lidar2img_rt.transpose(-1, -2))  # (bs, num_view, H*W, 4)
+        else:
+            # only the height term depends on the frame: P @ [x, y, z, 1] = P @ [x, y, 0, 1] + z * P[:, 2]
+            points_2d = self.project_static_bev(lidar2img_rt, img_metas, H, W) + \
+                voxel_height[:, None, :, None] * lidar2img_rt[:, :, None, :, 2]  # (bs, num_view, H*W, 4)
         points_2d[..., 2] = torch.clamp(points_2d[..., 2], min=1e-5)
         points_2d[..., :2] = points_2d[..., :2] / points_2d[..., 2:3] / self.out_size_factor_img
 
@@ -713,87 +749,75 @@ class SparseFusionHead2D_Deform(nn.Module):
         depth = points_2d[..., 2]   # [bs, num_view, H*W]
         depth = torch.log(depth)
 
-        for sample_idx in range(batch_size):
-            on_the_image_sample = on_the_image[sample_idx]  # [num_view, H*W]
-            bincount = torch.sum(on_the_image_sample, dim=1)
-            max_len = torch.max(bincount)
-            sample_query_feature = torch.zeros([self.num_views, self.hidden_channel, max_len], device=points_2d.device)
-            sample_query_pos = torch.zeros([self.num_views, max_len, 3], device=points_2d.device)
-            sample_reference_points = torch.zeros([self.num_views, max_len, 2], device=points_2d.device)
-            sample_padding_mask = torch.zeros([self.num_views, max_len], device=points_2d.device, dtype=torch.bool)
-
-            for view_idx in range(self.num_views):
-                on_the_image_view = on_the_image_sample[view_idx]
-                center_xs_view = center_xs[sample_idx, view_idx, on_the_image_view]  # [N, ]
-                center_ys_view = center_ys[sample_idx, view_idx, on_the_image_view]  # [N, ]
-                reference_points = torch.stack([center_xs_view / img_w, center_ys_view / img_h], dim=-1)  # [N, 2]
-
-                view_count = bincount[view_idx]
-                sample_reference_points[view_idx, :view_count] = reference_points
-                sample_query_feature[view_idx, :, :view_count] = lidar_feat_flatten[sample_idx, :, on_the_image_view]
-                sample_query_pos[view_idx, :view_count, 2] = depth[sample_idx, view_idx, on_the_image_view]
-                sample_padding_mask[view_idx, view_count:] = True
-
-            sample_centers_normal = sample_reference_points * 2 - 1
-            sample_query_img_feat = []
-            for lvl in range(self.level_num):
-                img_feat_lvl = img_feat[lvl][sample_idx]
-                img_feat_lvl = F.grid_sample(img_feat_lvl, sample_centers_normal[:, None], mode='bilinear', padding_mode="border", align_corners=False)
-                img_feat_lvl = img_feat_lvl[:, :, 0]
-                sample_query_img_feat.append(img_feat_lvl)
-            sample_query_img_feat = torch.stack(sample_query_img_feat, dim=0)
-            sample_query_img_feat = torch.max(sample_query_img_feat, dim=0)[0]  # [num_view, C, max_len]
-
-            sample_query_feature = sample_query_feature + sample_query_img_feat
-            sample_query_pos[..., :2] = inverse_sigmoid(sample_reference_points)
-
-            sample_reference_points = sample_reference_points[:, :, None].repeat(1, 1, self.level_num, 1)
-
-            if batch_size == 1: # whether it is doing evaluation or training
-                if input_padding_mask is None:
-                    sample_input_padding_mask = None
-                else:
-                    sample_input_padding_mask = input_padding_mask[sample_idx:sample_idx+1]
-                output = self.cross_heatmap_decoder(
-                    sample_query_feature, img_feats_stack[sample_idx],
-                    sample_query_pos, normal_img_feats_pos_stack.repeat(self.num_views, 1, 1),
-                    reference_points=sample_reference_points, level_start_index=level_start_index, spatial_shapes=spatial_shapes,
-                    query_padding_mask=sample_padding_mask, input_padding_mask=sample_input_padding_mask
-                )
-            else:
-                output = []
-                for view_idx in range(self.num_views):
-                    view_query_feature = sample_query_feature[view_idx, :, torch.logical_not(sample_padding_mask[view_idx])]
-                    view_query_pos = sample_query_pos[view_idx, torch.logical_not(sample_padding_mask[view_idx])]
-                    view_reference_points = sample_reference_points[view_idx, torch.logical_not(sample_padding_mask[view_idx])]
-
-                    if input_padding_mask is None:
-                        view_input_padding_mask = None
-                    else:
-                        view_input_padding_mask = input_padding_mask[sample_idx, view_idx, None]
-
-                    output_item = self.cross_heatmap_decoder(
-                        view_query_feature[None], img_feats_stack[sample_idx, view_idx, None],
-                        view_query_pos[None], normal_img_feats_pos_stack,
-                        reference_points=view_reference_points[None], level_start_index=level_start_index, spatial_shapes=spatial_shapes,
-                        input_padding_mask=view_input_padding_mask
-                    )
-                    output_item_pad = torch.zeros([output_item.shape[1], sample_padding_mask.shape[1]]).type_as(output_item)
-                    output_item_pad[:, torch.logical_not(sample_padding_mask[view_idx])] = output_item[0]
-                    output.append(output_item_pad)
-                output = torch.stack(output, dim=0)
-
-            for view_idx in range(self.num_views):
-                view_count = bincount[view_idx]
-                on_the_image_view = on_the_image_sample[view_idx]
-                overlap_mask = lidar_feat_count[sample_idx, 0, on_the_image_view] > 0
-                output_view = output[view_idx, :, :view_count]
-                nonoverlap_mask = torch.logical_not(overlap_mask)
-                lidar_feat_output_view = lidar_feat_output[sample_idx, :, on_the_image_view]
-                lidar_feat_output_view[:, overlap_mask] = torch.maximum(lidar_feat_output_view[:, overlap_mask], output_view[:, overlap_mask])
-                lidar_feat_output_view[:, nonoverlap_mask] = output_view[:, nonoverlap_mask]
-                lidar_feat_output[sample_idx, :, on_the_image_view] = lidar_feat_output_view
-                lidar_feat_count[sample_idx, :, on_the_image_view] += 1
+        # pack the projected BEV cells of all (sample, view) pairs into one padded batch
+        num_views = self.num_views
+        on_the_image = on_the_image.view(batch_size * num_views, H*W)
+        bincount = torch.sum(on_the_image, dim=1)  # [bs*num_view, ]
+        max_len = int(torch.max(bincount))
+        view_ids, cell_ids = torch.nonzero(on_the_image, as_tuple=True)  # [N, ]
+        slot_ids = torch.arange(view_ids.shape[0], device=points_2d.device) - (torch.cumsum(bincount, dim=0) - bincount)[view_ids]
+        sample_ids = view_ids // num_views
+
+        query_feature = torch.zeros([batch_size * num_views, self.hidden_channel, max_len], device=points_2d.device)
+        query_pos = torch.zeros([batch_size * num_views, max_len, 3], device=points_2d.device)
+        reference_points = torch.zeros([batch_size * num_views, max_len, 2], device=points_2d.device)
+        query_padding_mask = torch.ones([batch_size * num_views, max_len], device=points_2d.device, dtype=torch.bool)
+
+        center_xs = center_xs.reshape(batch_size * num_views, H*W)[view_ids, cell_ids]  # [N, ]
+        center_ys = center_ys.reshape(batch_size * num_views, H*W)[view_ids, cell_ids]  # [N, ]
+        reference_points[view_ids, slot_ids] = torch.stack([center_xs / img_w, center_ys / img_h], dim=-1)
+        query_feature[view_ids, :, slot_ids] = lidar_feat_flatten[sample_ids, :, cell_ids]
+        query_pos[view_ids, slot_ids, 2] = depth.reshape(batch_size * num_views, H*W)[view_ids, cell_ids]
+        query_padding_mask[view_ids, slot_ids] = False
+
+        centers_normal = reference_points * 2 - 1
+        query_img_feat = []
+        for lvl in range(self.level_num):
+            img_feat_lvl = img_feat[lvl].view(batch_size * num_views, self.hidden_channel, *img_feat[lvl].shape[-2:])
+            img_feat_lvl = F.grid_sample(img_feat_lvl, centers_normal[:, None], mode='bilinear', padding_mode="border", align_corners=False)
+            query_img_feat.append(img_feat_lvl[:, :, 0])
+        query_img_feat = torch.stack(query_img_feat, dim=0)
+        query_img_feat = torch.max(query_img_feat, dim=0)[0]  # [bs*num_view, C, max_len]
+
+        query_feature = query_feature + query_img_feat
+        query_pos[..., :2] = inverse_sigmoid(reference_points)
+        reference_points = reference_points[:, :, None].repeat(1, 1, self.level_num, 1)
+
+        if input_padding_mask is not None:
+            input_padding_mask = input_padding_mask.view(batch_size * num_views, -1)
+        output = self.cross_heatmap_decoder(
+            query_feature, img_feats_stack.view(batch_size * num_views, self.hidden_channel, -1),
+            query_pos, normal_img_feats_pos_stack.repeat(batch_size * num_views, 1, 1),
+            reference_points=reference_points, level_start_index=level_start_index, spatial_shapes=spatial_shapes,
+            query_padding_mask=query_padding_mask, input_padding_mask=input_padding_mask
+        )  # [bs*num_view, C, max_len]
+
+        # cells seen by several views keep the element-wise max over those views
+        output = output[view_ids, :, slot_ids]  # [N, C]
+        bev_ids = sample_ids * H*W + cell_ids
+        lidar_feat_count = torch.bincount(bev_ids, minlength=batch_size * H*W).view(batch_size, 1, H*W).float()
+        if hasattr(torch.Tensor, 'scatter_reduce'):
+            lidar_feat_output = output.new_zeros([batch_size * H*W, self.hidden_channel]).scatter_reduce(
+                0, bev_ids[:, None].expand_as(output), output, reduce='amax', include_self=False)
+        else:
+            # a cell is seen by at most num_view views, take the max one overlap rank at a time
+            order = torch.argsort(bev_ids * bev_ids.shape[0] + torch.arange(bev_ids.shape[0], device=bev_ids.device))
+            sorted_ids = bev_ids[order]
+            is_first = torch.ones_like(sorted_ids, dtype=torch.bool)
+            is_first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+            group_starts = torch.nonzero(is_first, as_tuple=False)[:, 0]
+            overlap_rank = torch.empty_like(order)
+            overlap_rank[order] = torch.arange(order.shape[0], device=order.device) - \
+                group_starts[torch.cumsum(is_first.long(), dim=0) - 1]
+            lidar_feat_output = output.new_zeros([batch_size * H*W, self.hidden_channel])
+            for rank in range(int(overlap_rank.max()) + 1 if overlap_rank.numel() > 0 else 0):
+                rank_mask = overlap_rank == rank
+                rank_ids = bev_ids[rank_mask]
+                rank_output = output[rank_mask]
+                if rank > 0:
+                    rank_output = torch.maximum(lidar_feat_output[rank_ids], rank_output)
+                lidar_feat_output = lidar_feat_output.index_copy(0, rank_ids, rank_output)
+        lidar_feat_output = lidar_feat_output.view(batch_size, H*W, self.hidden_channel).permute(0, 2, 1)
 
         lidar_feat_output = lidar_feat_output.reshape(batch_size, lidar_feat_output.shape[1], H, W)
         # lidar_feat_output = self.reduce_conv(lidar_feat_output)
@@ -807,6 +831,44 @@ class SparseFusionHead2D_Deform(nn.Module):
 
         return heatmap_output
 
+    @torch.no_grad()
+    def project_static_bev(self, lidar2img_rt, img_metas, H, W):
+        """Project the BEV grid at zero height into all views, cached per camera rig.
+
+        The rig is identified by the calibration arrays in ``img_metas``, which
+        are on the host, so looking up the cache never syncs with the device.
+
+        Args:
+            lidar2img_rt (torch.Tensor): [bs, num_view, 4, 4] projection matrices.
+            img_metas (list[dict]): Meta information of each sample, the
+                ``lidar2img_rt`` are built from their ``cam_intrinsic``,
+                ``lidar2cam_r`` and ``lidar2cam_t``.
+            H, W (int): size of the BEV grid.
+
+        Returns:
+            torch.Tensor: [bs, num_view, H*W, 4] homogeneous image coordinates.
+        """
+        bev_pos = self.bev_pos.to(lidar2img_rt.device)  # [1, H*W, 2]
+        points_static = []
+        for rt, img_meta in zip(lidar2img_rt, img_metas):
+            calib = b''.join(
+                np.ascontiguousarray(img_meta[name], dtype=np.float64).tobytes()
+                for name in ['cam_intrinsic', 'lidar2cam_r', 'lidar2cam_t'])
+            key = (calib, H, W, str(rt.device))
+            if key in self.projection_cache:
+                self.projection_cache.move_to_end(key)
+            else:
+                query_pos_realmetric = bev_pos[0] * self.test_cfg['out_size_factor'] * \
+                                       self.test_cfg['voxel_size'][0] + self.test_cfg['pc_range'][0]  # (H*W, 2)
+                points_4d = torch.cat([query_pos_realmetric, torch.zeros_like(query_pos_realmetric[:, :1]),
+                                       torch.ones_like(query_pos_realmetric[:, :1])], dim=1)  # (H*W, 4)
+                self.projection_cache[key] = torch.matmul(points_4d[None], rt.transpose(-1, -2))  # (num_view, H*W, 4)
+                # a new rig evicts the least recently used one
+                if len(self.projection_cache) > self.projection_cache_size:
+                    self.projection_cache.popitem(last=False)
+            points_static.append(self.projection_cache[key])
+        return torch.stack(points_static, dim=0)
+
     def generate_heatmap(self, lidar_feat, min_voxel_height, max_voxel_height, batch_size, img_metas, lidar2img_rt, img_feat=None, input_padding_mask=None):
         dense_heatmap = self.heatmap_head(lidar_feat)  # [BS, num_class, H, W]
         if img_feat is None:
@@ -836,7 +898,7 @@ class SparseFusionHead2D_Deform(nn.Module):
         heatmap = heatmap.view(batch_size, heatmap.shape[1], -1)  # [BS, num_class, H*W]
 
         # top #num_proposals among all classes
-        top_proposals = heatmap.reshape(batch_size, -1).argsort(dim=-1, descending=True)[..., :self.num_proposals]  # [BS, num_proposals]
+        top_proposals = topk_indices(heatmap.reshape(batch_size, -1), self.num_proposals)  # [BS, num_proposals]
 
         top_proposals_class = top_proposals // heatmap.shape[-1]  # [BS, num_proposals]
         top_proposals_index = top_proposals % heatmap.shape[-1]  # [BS, num_proposals]
@@ -870,7 +932,7 @@ class SparseFusionHead2D_Deform(nn.Module):
 
         img_heatmap_stack = torch.cat(img_heatmaps, dim=3)  # [BS, num_class, num_views, h*w (sum)]
         # top #num_proposals among all classes
-        top_proposals = img_heatmap_stack.view(batch_size, -1).argsort(dim=-1, descending=True)[..., :self.num_img_proposals]  # [BS, num_proposals]
+        top_proposals = topk_indices(img_heatmap_stack.reshape(batch_size, -1), self.num_img_proposals)  # [BS, num_proposals]
         top_proposals_class = top_proposals // (img_heatmap_stack.shape[-1]*img_heatmap_stack.shape[-2])  # [BS, num_proposals]
 
         top_proposals_view_index = top_proposals % (img_heatmap_stack.shape[-1]*img_heatmap_stack.shape[-2]) // img_heatmap_stack.shape[-1]  # [BS, num_proposals]
@@ -898,50 +960,46 @@ class SparseFusionHead2D_Deform(nn.Module):
                 - torch.Tensor: regression target. [BS, num_proposals, 8]
                 - torch.Tensor: regression weights. [BS, num_proposals, 8]
         """
-        # change preds_dict into list of dict (index by batch_id)
-        # preds_dict[0]['center'].shape [bs, 3, num_proposal]
-        list_of_pred_dict = []
-        for batch_idx in range(len(gt_bboxes_3d)):
-            pred_dict = {}
-            for key in preds_dict[0].keys():
-                pred_dict[key] = preds_dict[0][key][batch_idx:batch_idx + 1]
-            list_of_pred_dict.append(pred_dict)
-
-        assert len(gt_bboxes_3d) == len(list_of_pred_dict)
-
-        res_tuple = multi_apply(self.get_targets_single, gt_bboxes_3d, gt_labels_3d, gt_visible, list_of_pred_dict, np.arange(len(gt_labels_3d)))
-
-        labels = torch.cat(res_tuple[0], dim=0)
-        label_weights = torch.cat(res_tuple[1], dim=0)
-        bbox_targets = torch.cat(res_tuple[2], dim=0)
-        bbox_weights = torch.cat(res_tuple[3], dim=0)
-        ious = torch.cat(res_tuple[4], dim=0)
-        num_pos_layer = np.concatenate(res_tuple[5], axis=0)  # [BS, num_layer]
-        # matched_ious = np.mean(res_tuple[6])
-        matched_ious = torch.cat(res_tuple[6], dim=0)
-
-        res_tuple_2d = multi_apply(self.get_targets_single_2d, gt_bboxes, gt_labels, gt_img_centers_view, gt_bboxes_cam_view, gt_bboxes_lidar_view, list_of_pred_dict, img_metas, np.arange(len(gt_bboxes)))
-        labels_2d = torch.cat(res_tuple_2d[0], dim=0)
-        label_weights_2d = torch.cat(res_tuple_2d[1], dim=0)
-        bbox_targets_2d = torch.cat(res_tuple_2d[2], dim=0)
-        bbox_weights_2d = torch.cat(res_tuple_2d[3], dim=0)
-        ious_2d = torch.cat(res_tuple_2d[4], dim=0)
-        num_pos_layer_2d = np.concatenate(res_tuple_2d[5], axis=0)  # [BS, num_layer]
-        matched_ious_2d = torch.cat(res_tuple_2d[6], dim=0)
+        if self.train_cfg.get('batch_targets', False):
+            res_tuple, res_tuple_2d, res_tuple_view = self.get_targets_batch(
+                gt_bboxes_3d, gt_labels_3d, gt_bboxes, gt_labels, gt_img_centers_view, gt_bboxes_cam_view, gt_visible,
+                preds_dict[0], img_metas)
+        else:
+            # change preds_dict into list of dict (index by batch_id)
+            # preds_dict[0]['center'].shape [bs, 3, num_proposal]
+            list_of_pred_dict = []
+            for batch_idx in range(len(gt_bboxes_3d)):
+                pred_dict = {}
+                for key in preds_dict[0].keys():
+                    pred_dict[key] = preds_dict[0][key][batch_idx:batch_idx + 1]
+                list_of_pred_dict.append(pred_dict)
+
+            assert len(gt_bboxes_3d) == len(list_of_pred_dict)
+
+            res_tuple = multi_apply(self.get_targets_single, gt_bboxes_3d, gt_labels_3d, gt_visible, list_of_pred_dict, np.arange(len(gt_labels_3d)))
+            res_tuple_2d = multi_apply(self.get_targets_single_2d, gt_bboxes, gt_labels, gt_img_centers_view, gt_bboxes_cam_view, gt_bboxes_lidar_view, list_of_pred_dict, img_metas, np.arange(len(gt_bboxes)))
+            if self.view_transform: # True
+                res_tuple_view = multi_apply(self.get_targets_single_view, gt_bboxes_3d, gt_labels_3d, gt_visible, list_of_pred_dict, np.arange(len(gt_bboxes)))
+            else:
+                res_tuple_view = None
+            # concatenate the targets of the samples, num_pos_layer is [BS, num_layer]
+            res_tuple, res_tuple_2d, res_tuple_view = [
+                None if res is None else [
+                    np.concatenate(item, axis=0) if isinstance(item[0], np.ndarray) else torch.cat(item, dim=0)
+                    for item in res
+                ] for res in (res_tuple, res_tuple_2d, res_tuple_view)
+            ]
 
+        labels, label_weights, bbox_targets, bbox_weights, ious, num_pos_layer, matched_ious = res_tuple[:7]
+        labels_2d, label_weights_2d, bbox_targets_2d, bbox_weights_2d, ious_2d, num_pos_layer_2d, matched_ious_2d = \
+            res_tuple_2d[:7]
         if self.view_transform: # True
-            res_tuple_view = multi_apply(self.get_targets_single_view, gt_bboxes_3d, gt_labels_3d, gt_visible, list_of_pred_dict, np.arange(len(gt_bboxes)))
-            labels_view = torch.cat(res_tuple_view[0], dim=0)
-            label_weights_view = torch.cat(res_tuple_view[1], dim=0)
-            bbox_targets_view = torch.cat(res_tuple_view[2], dim=0)
-            bbox_weights_view = torch.cat(res_tuple_view[3], dim=0)
-            ious_view = torch.cat(res_tuple_view[4], dim=0)
-            num_pos_layer_view = np.concatenate(res_tuple_view[5], axis=0)  # [BS, num_layer]
-            matched_ious_view = torch.cat(res_tuple_view[6], dim=0)
+            labels_view, label_weights_view, bbox_targets_view, bbox_weights_view, ious_view, num_pos_layer_view, \
+                matched_ious_view = res_tuple_view[:7]
 
         if self.initialize_by_heatmap: # True
-            heatmap = torch.cat(res_tuple[7], dim=0)
-            heatmap_2d = torch.cat(res_tuple_2d[7], dim=0)
+            heatmap = res_tuple[7]
+            heatmap_2d = res_tuple_2d[7]
             if self.view_transform: # True
                 return labels, label_weights, bbox_targets, bbox_weights, ious, num_pos_layer, matched_ious, heatmap, \
                    labels_2d, label_weights_2d, bbox_targets_2d, bbox_weights_2d, ious_2d, num_pos_layer_2d, \
@@ -961,6 +1019,282 @@ class SparseFusionHead2D_Deform(nn.Module):
                 return labels, label_weights, bbox_targets, bbox_weights, ious, num_pos_layer, matched_ious, \
                     labels_2d, label_weights_2d, bbox_targets_2d, bbox_weights_2d, ious_2d, num_pos_layer_2d, matched_ious_2d,
 
+    def get_targets_batch(self, gt_bboxes_3d, gt_labels_3d, gt_bboxes, gt_labels, gt_img_centers_view, gt_bboxes_cam_view, gt_visible, preds_dict, img_metas):
+        """Generate training targets of the whole batch at once.
+
+        The matching costs of all samples are computed on the device with the
+        ground truths padded to the same number, only the Hungarian matching
+        runs on the host, and the gaussian heatmaps of all ground truths are
+        drawn together. The matchings of all branches are started before
+        waiting for any of them, so the host transfers and the solvers overlap
+        with the device. Enabled by ``batch_targets=True`` in ``train_cfg``.
+
+        Returns:
+            tuple[list]: Batched targets of the 3D, 2D and view branches in the
+                same order as :meth:`get_targets_single`,
+                :meth:`get_targets_single_2d` and
+                :meth:`get_targets_single_view`, without the LiDAR targets of
+                the 2D branch.
+        """
+        assert isinstance(self.bbox_sampler, PseudoSampler), 'batch_targets only supports PseudoSampler'
+        assert self.train_cfg.assigner.type == 'HungarianAssigner3D', 'batch_targets only supports HungarianAssigner3D'
+        device = preds_dict['center'].device
+        gt_bboxes_3d = [bboxes.to(device) for bboxes in gt_bboxes_3d]
+
+        # 3D branch
+        num_layer = self.num_pts_decoder_layers + self.num_fusion_decoder_layers
+        layer_sizes = [self.get_layer_num_proposal(idx_layer) for idx_layer in range(num_layer)]
+        score = preds_dict['heatmap'].detach()
+        boxes_dicts = self.bbox_coder.decode(
+            score, preds_dict['rot'].detach().clone(), preds_dict['dim'].detach().clone(),
+            preds_dict['center'].detach().clone(), preds_dict['height'].detach().clone(),
+            preds_dict['vel'].detach().clone() if 'vel' in preds_dict else None)
+        bboxes = torch.stack([boxes_dict['bboxes'] for boxes_dict in boxes_dicts])
+        gt_bboxes_tensor = [bboxes.tensor for bboxes in gt_bboxes_3d]
+        matching = self._batch_assign(
+            self.bbox_assigner, bboxes, score, gt_bboxes_tensor, gt_labels_3d, layer_sizes)
+
+        # 2D branch
+        layer_sizes_2d = [self.num_img_proposals] * self.num_img_decoder_layers
+        score = preds_dict['cls'].detach()
+        view = preds_dict['view'].detach()
+        boxes_dicts = self.bbox_2d_coder.decode(
+            score, preds_dict['rot_2d'].detach().clone(), preds_dict['dim_2d'].detach().clone(),
+            preds_dict['loc_cam_3d'].detach().clone(),
+            preds_dict['vel_2d'].detach().clone() if 'vel_2d' in preds_dict else None)
+        bboxes = torch.stack([boxes_dict['bboxes'] for boxes_dict in boxes_dicts])
+        gt_bboxes_cam_tensor = [bboxes.tensor.to(device) for bboxes in gt_bboxes_cam_view]
+        matching_2d = self._batch_assign(
+            self.bbox_assigner_2d, bboxes, score, gt_bboxes_cam_tensor, gt_labels, layer_sizes_2d, view=view)
+
+        # view branch
+        if self.view_transform:
+            gt_masks = [visible == 1 for visible in gt_visible]
+            gt_bboxes_view_tensor = [bboxes[mask].tensor for bboxes, mask in zip(gt_bboxes_3d, gt_masks)]
+            gt_labels_view = [labels[mask] for labels, mask in zip(gt_labels_3d, gt_masks)]
+            score = preds_dict['heatmap_view'].detach()
+            boxes_dicts = self.bbox_coder.decode(
+                score, preds_dict['rot_view'].detach().clone(), preds_dict['dim_view'].detach().clone(),
+                preds_dict['center_view'].detach().clone(), preds_dict['height_view'].detach().clone(),
+                preds_dict['vel_view'].detach().clone() if 'vel_view' in preds_dict else None)
+            bboxes = torch.stack([boxes_dict['bboxes'] for boxes_dict in boxes_dicts])
+            layer_sizes_view = [bboxes.shape[1]]
+            matching_view = self._batch_assign(
+                self.bbox_assigner, bboxes, score, gt_bboxes_view_tensor, gt_labels_view, layer_sizes_view)
+
+        assigned_gt_inds, ious = self._batch_matched(*matching)
+        res_tuple = self._batch_bbox_targets(
+            assigned_gt_inds, ious, gt_bboxes_tensor, gt_labels_3d, layer_sizes, self.bbox_coder)
+        if self.initialize_by_heatmap:
+            res_tuple.append(self._batch_heatmap(gt_bboxes_3d, gt_labels_3d))
+
+        assigned_gt_inds, ious = self._batch_matched(*matching_2d)
+        res_tuple_2d = self._batch_bbox_targets(
+            assigned_gt_inds, ious, gt_bboxes_cam_tensor, gt_labels, layer_sizes_2d, self.bbox_2d_coder)
+
+        pos_batch_inds, pos_inds = torch.nonzero(assigned_gt_inds >= 0, as_tuple=True)
+        if len(pos_inds) > 0:
+            # the 2D boxes regress the normalized image center and the depth instead
+            gt_offsets = self._gt_offsets([len(labels) for labels in gt_labels], device)
+            pos_gt_inds = gt_offsets[pos_batch_inds] + assigned_gt_inds[pos_batch_inds, pos_inds]
+            gt_centers_2d = torch.cat(gt_img_centers_view).float()[pos_gt_inds]
+            img_scale = torch.Tensor([[img_meta['pad_shape'][1], img_meta['pad_shape'][0]] for img_meta in img_metas]).to(device)
+            labels_2d, label_weights_2d, bbox_targets_2d, bbox_weights_2d = res_tuple_2d[:4]
+            bbox_targets_2d[pos_batch_inds, pos_inds, :2] = gt_centers_2d[:, :2] / img_scale[pos_batch_inds]
+            bbox_targets_2d[pos_batch_inds, pos_inds, 2] = gt_centers_2d[:, 2]
+
+            # ignore the positive proposals predicted in another view
+            view_mask_ignore = torch.cat(gt_labels)[pos_gt_inds, 1] != view[pos_batch_inds, pos_inds]
+            bbox_weights_2d[pos_batch_inds[view_mask_ignore], pos_inds[view_mask_ignore]] = 0
+            label_weights_2d[pos_batch_inds[view_mask_ignore], pos_inds[view_mask_ignore]] = 0
+        if self.initialize_by_heatmap:
+            res_tuple_2d.append(self._batch_heatmap_2d(gt_bboxes, gt_labels, gt_img_centers_view, img_metas))
+
+        if not self.view_transform:
+            return res_tuple, res_tuple_2d, None
+
+        assigned_gt_inds, ious = self._batch_matched(*matching_view)
+        res_tuple_view = self._batch_bbox_targets(
+            assigned_gt_inds, ious, gt_bboxes_view_tensor, gt_labels_view, layer_sizes_view, self.bbox_coder)
+        return res_tuple, res_tuple_2d, res_tuple_view
+
+    @staticmethod
+    def _gt_offsets(num_gts, device):
+        num_gts = torch.tensor(num_gts, dtype=torch.long, device=device)
+        return torch.cumsum(num_gts, dim=0) - num_gts
+
+    def _batch_assign(self, assigner, bboxes, cls_pred, gt_bboxes, gt_labels, layer_sizes, view=None):
+        """Start matching the proposals of a batch to their ground truths.
+
+        The costs are computed by ``assigner.get_cost`` between the proposals
+        and the ground truths of each sample only, padded to the same number
+        of ground truths into one cost matrix of the batch, and matched with
+        the options of ``assigner.matcher``.
+
+        Args:
+            assigner (:obj:`BaseAssigner`): Assigner providing ``get_cost``.
+            bboxes (torch.Tensor): Decoded proposals with the shape of [B, P, C].
+            cls_pred (torch.Tensor): Class scores with the shape of [B, num_classes, P].
+            gt_bboxes (list[torch.Tensor]): Ground truth boxes of each sample.
+            gt_labels (list[torch.Tensor]): Ground truth labels of each sample.
+            layer_sizes (list[int]): Number of proposals of each decoder layer,
+                which are matched separately.
+            view (torch.Tensor, optional): Predicted views with the shape of [B, P].
+
+        Returns:
+            tuple: The started :obj:`PendingAssignment` and the IoU of all
+                pairs with the shape of [B, P, max_num_gts].
+        """
+        batch_size, num_proposals = bboxes.shape[:2]
+        num_gts = [len(gt) for gt in gt_bboxes]
+        max_num_gts = max(num_gts)
+        if max_num_gts == 0:
+            iou = bboxes.new_zeros(batch_size, num_proposals, 0)
+            return start_batch_linear_assignment(iou, num_gts), iou
+
+        # [B, P, max_num_gts], padded by repeating the last ground truth
+        cost = bboxes.new_zeros(batch_size, num_proposals, max_num_gts)
+        iou = bboxes.new_zeros(batch_size, num_proposals, max_num_gts)
+        pad_inds = torch.arange(max_num_gts, device=bboxes.device)
+        for batch_idx, num_gt in enumerate(num_gts):
+            if num_gt == 0:
+                continue
+            cost_args = [bboxes[batch_idx], gt_bboxes[batch_idx], gt_labels[batch_idx],
+                         cls_pred[batch_idx:batch_idx + 1]]
+            if view is not None:
+                cost_args.append(view[batch_idx])
+            sample_cost, sample_iou = assigner.get_cost(*cost_args, self.train_cfg)
+            gt_inds = pad_inds.clamp(max=num_gt - 1)
+            cost[batch_idx] = sample_cost[:, gt_inds]
+            iou[batch_idx] = sample_iou[:, gt_inds]
+
+        return start_batch_linear_assignment(cost, num_gts, layer_sizes, **assigner.matcher), iou
+
+    @staticmethod
+    def _batch_matched(matching, iou):
+        """Wait for a matching started by :meth:`_batch_assign`.
+
+        Returns:
+            tuple[torch.Tensor]: Index of the matched ground truth of each
+                proposal, -1 for negatives, and the IoU with it, both with the
+                shape of [B, P].
+        """
+        assigned_gt_inds = matching.result()
+        if iou.shape[2] == 0:
+            return assigned_gt_inds, iou.new_zeros(assigned_gt_inds.shape)
+        ious = iou.gather(2, assigned_gt_inds.clamp(min=0)[..., None])[..., 0]
+        ious = torch.where(assigned_gt_inds >= 0, ious, torch.zeros_like(ious))
+        return assigned_gt_inds, ious
+
+    def _batch_bbox_targets(self, assigned_gt_inds, ious, gt_bboxes, gt_labels, layer_sizes, bbox_coder):
+        """Build the classification and regression targets of a batch.
+
+        Returns:
+            list: Labels, label weights, bbox targets, bbox weights, IoUs,
+                number of positives of each layer and matched IoUs.
+        """
+        batch_size, num_proposals = assigned_gt_inds.shape
+        device = assigned_gt_inds.device
+        pos_mask = assigned_gt_inds >= 0
+        pos_batch_inds, pos_inds = torch.nonzero(pos_mask, as_tuple=True)
+
+        bbox_targets = torch.zeros([batch_size, num_proposals, bbox_coder.code_size], device=device)
+        bbox_weights = torch.zeros([batch_size, num_proposals, bbox_coder.code_size], device=device)
+        labels = assigned_gt_inds.new_full((batch_size, num_proposals), self.num_classes)
+        label_weights = assigned_gt_inds.new_ones((batch_size, num_proposals))
+
+        # both pos and neg have classification loss, only pos has regression and iou loss
+        if len(pos_inds) > 0:
+            gt_offsets = self._gt_offsets([len(labels) for labels in gt_labels], device)
+            pos_gt_inds = gt_offsets[pos_batch_inds] + assigned_gt_inds[pos_batch_inds, pos_inds]
+            pos_bbox_targets = bbox_coder.encode(torch.cat(gt_bboxes)[pos_gt_inds])
+            bbox_targets[pos_batch_inds, pos_inds, :pos_bbox_targets.shape[1]] = pos_bbox_targets
+            bbox_weights[pos_batch_inds, pos_inds] = 1.0
+
+            pos_gt_labels = torch.cat(gt_labels)[pos_gt_inds]
+            if pos_gt_labels.dim() > 1:
+                # 2D labels carry the view id in the second column
+                pos_gt_labels = pos_gt_labels[:, 0]
+            labels[pos_batch_inds, pos_inds] = pos_gt_labels
+            if self.train_cfg.pos_weight > 0:
+                label_weights[pos_batch_inds, pos_inds] = self.train_cfg.pos_weight
+
+        ious = torch.clamp(ious, min=0.0, max=1.0)
+        matched_ious = torch.where(pos_mask, ious, torch.full_like(ious, -1))
+        num_pos_layer = torch.stack(
+            [layer_mask.sum(1) for layer_mask in torch.split(pos_mask, layer_sizes, dim=1)], dim=1)
+        return [labels, label_weights, bbox_targets, bbox_weights, ious, num_pos_layer.cpu().numpy(), matched_ious]
+
+    def _batch_heatmap(self, gt_bboxes_3d, gt_labels_3d):
+        """Draw the BEV heatmap targets of a batch at once."""
+        device = gt_bboxes_3d[0].tensor.device
+        grid_size = torch.tensor(self.train_cfg['grid_size'])
+        pc_range = torch.tensor(self.train_cfg['point_cloud_range'])
+        voxel_size = torch.tensor(self.train_cfg['voxel_size'])
+        feature_map_size = grid_size[:2] // self.train_cfg['out_size_factor']  # [x_len, y_len]
+        heatmap = torch.zeros(len(gt_bboxes_3d) * self.num_classes, int(feature_map_size[1]),
+                              int(feature_map_size[0]), device=device)
+
+        gt_bboxes = torch.cat([torch.cat([bboxes.gravity_center, bboxes.tensor[:, 3:]], dim=1)
+                               for bboxes in gt_bboxes_3d]).to(device)
+        gt_labels = torch.cat(gt_labels_3d).to(device)
+        batch_inds = torch.cat([gt_labels.new_full((len(labels), ), batch_idx)
+                                for batch_idx, labels in enumerate(gt_labels_3d)])
+
+        width = gt_bboxes[:, 3] / voxel_size[0] / self.train_cfg['out_size_factor']
+        length = gt_bboxes[:, 4] / voxel_size[1] / self.train_cfg['out_size_factor']
+        valid = (width > 0) & (length > 0)
+        radius = gaussian_radius((length, width), min_overlap=self.train_cfg['gaussian_overlap'])
+        radius = radius.int().clamp(min=self.train_cfg['min_radius'])
+        coor_x = (gt_bboxes[:, 0] - pc_range[0]) / voxel_size[0] / self.train_cfg['out_size_factor']
+        coor_y = (gt_bboxes[:, 1] - pc_range[1]) / voxel_size[1] / self.train_cfg['out_size_factor']
+        center_int = torch.stack([coor_x, coor_y], dim=1).float().to(torch.int32)
+
+        draw_heatmap_gaussian_batch(heatmap, (batch_inds * self.num_classes + gt_labels)[valid],
+                                    center_int[valid], radius[valid])
+        return heatmap.view(len(gt_bboxes_3d), self.num_classes, *heatmap.shape[1:])
+
+    def _batch_heatmap_2d(self, gt_bboxes, gt_labels, gt_centers_2d, img_metas):
+        """Draw the multi-level image heatmap targets of a batch at once."""
+        device = gt_bboxes[0].device
+        batch_size = len(gt_bboxes)
+        img_shape = img_metas[0]['pad_shape']
+        w, h = img_shape[1] // self.out_size_factor_img, img_shape[0] // self.out_size_factor_img
+        heatmaps = []
+        for lvl in range(self.level_num):
+            heatmaps.append(torch.zeros(batch_size * self.num_classes * self.num_views, h, w, device=device))
+            h = h // 2
+            w = w // 2
+
+        boxes = torch.cat(gt_bboxes)
+        labels = torch.cat(gt_labels)
+        centers = torch.cat(gt_centers_2d).float()
+        batch_inds = torch.cat([labels.new_full((len(box), ), batch_idx) for batch_idx, box in enumerate(gt_bboxes)])
+
+        width = boxes[:, 2]
+        length = boxes[:, 3]
+        max_l = torch.maximum(length, width)
+        width = width / self.out_size_factor_img
+        length = length / self.out_size_factor_img
+        valid = (width > 0) & (length > 0)
+        radius = gaussian_radius((length, width), min_overlap=self.train_cfg['gaussian_overlap_2d'])
+        radius = radius.clamp(min=self.train_cfg['min_radius'], max=self.train_cfg['max_radius'])
+        center = torch.stack([centers[:, 0], centers[:, 1]], dim=1) / self.out_size_factor_img
+
+        # larger boxes are drawn on coarser levels
+        level_thresholds = {4: [48, 96, 192], 3: [48, 96], 2: [96], 1: []}[self.level_num]
+        levels = (max_l[:, None] >= max_l.new_tensor(level_thresholds)).sum(1)
+        scale = (2 ** levels).float()
+        center_int = (center / scale[:, None]).to(torch.int32)
+        radius = (radius / scale).int()
+        map_ids = (batch_inds * self.num_classes + labels[:, 0]) * self.num_views + labels[:, 1]
+
+        for lvl in range(self.level_num):
+            mask = valid & (levels == lvl)
+            draw_heatmap_gaussian_batch(heatmaps[lvl], map_ids[mask], center_int[mask], radius[mask])
+            heatmaps[lvl] = heatmaps[lvl].view(batch_size, self.num_classes, self.num_views, -1)
+        return torch.cat(heatmaps, dim=-1)
+
     def get_targets_single_2d(self, gt_bboxes, gt_labels, gt_centers_2d, gt_bboxes_cam_view, gt_bboxes_lidar_view, preds_dict, img_metas, batch_idx):
         num_proposals = preds_dict['cls'].shape[-1]
         loc_cam_3d = copy.deepcopy(preds_dict['loc_cam_3d'].detach())
@@ -1716,6 +2050,10 @@ class SparseFusionHead2D_Deform(nn.Module):
             labels_2d, labels, img_feats_aligned, pts_feats_aligned
         )
 
+        if self.calibration is not None and self.calibration.collect:
+            self.calibration.collect_scores('cam', img_feats_aligned, labels_2d)
+            self.calibration.collect_scores('lidar', pts_feats_aligned, labels[..., :self.num_proposals])
+
         losses_center = [loss_center * 0.5]
         losses_additional = [loss_geomed]
         losses_sep = [loss_sep]
@@ -1810,31 +2148,42 @@ class SparseFusionHead2D_Deform(nn.Module):
                 ]
 
             ret_layer = []
-            for i in range(batch_size):
-                boxes3d = temp[i]['bboxes']
-                scores = temp[i]['scores']
-                labels = temp[i]['labels']
-
-                ## adopt circle nms for different categories
-                if self.test_cfg['nms_type'] != None:
-                    keep_mask = torch.zeros_like(scores)
-                    for task in self.tasks:
-                        task_mask = torch.zeros_like(scores)
-                        for cls_idx in task['indices']:
-                            task_mask += labels == cls_idx
-                        task_mask = task_mask.bool()
-                        if task['radius'] > 0 and task_mask.sum() > 0:
-                            if self.test_cfg['nms_type'] == 'circle':
-                                boxes_for_nms = torch.cat([boxes3d[task_mask][:, :2], scores[:, None][task_mask]], dim=1)
-                                task_keep_indices = torch.tensor(
-                                    circle_nms(
-                                        boxes_for_nms.detach().cpu().numpy(),
-                                        task['radius'],
-                                        # 5,
-                                        post_max_size=500
-                                    )
-                                )
-                            else:
+            if self.test_cfg['nms_type'] == 'circle':
+                ## class-aware circle nms of all samples and tasks in one call, kept on the device
+                boxes3d = torch.cat([temp[i]['bboxes'] for i in range(batch_size)], dim=0)
+                scores = torch.cat([temp[i]['scores'] for i in range(batch_size)], dim=0)
+                labels = torch.cat([temp[i]['labels'] for i in range(batch_size)], dim=0)
+                batch_ids = torch.cat([torch.full_like(temp[i]['labels'], i) for i in range(batch_size)], dim=0)
+
+                # labels outside of every task get their own group and are dropped
+                class_to_task = labels.new_full((self.num_classes, ), len(self.tasks))
+                for task_id, task in enumerate(self.tasks):
+                    class_to_task[task['indices']] = task_id
+                task_ids = class_to_task[labels.long()]
+                task_radius = [task['radius'] for task in self.tasks] + [-1]
+
+                keep_mask = batched_circle_nms(
+                    boxes3d[:, :2], scores, task_ids, task_radius, batch_ids=batch_ids, post_max_size=500
+                )
+                keep_mask = keep_mask & (task_ids < len(self.tasks))
+                for i in range(batch_size):
+                    sample_mask = keep_mask & (batch_ids == i)
+                    ret_layer.append(dict(bboxes=boxes3d[sample_mask], scores=scores[sample_mask], labels=labels[sample_mask]))
+            else:
+                for i in range(batch_size):
+                    boxes3d = temp[i]['bboxes']
+                    scores = temp[i]['scores']
+                    labels = temp[i]['labels']
+
+                    ## adopt rotated nms for different categories
+                    if self.test_cfg['nms_type'] != None:
+                        keep_mask = torch.zeros_like(scores)
+                        for task in self.tasks:
+                            task_mask = torch.zeros_like(scores)
+                            for cls_idx in task['indices']:
+                                task_mask += labels == cls_idx
+                            task_mask = task_mask.bool()
+                            if task['radius'] > 0 and task_mask.sum() > 0:
                                 boxes_for_nms = xywhr2xyxyr(img_metas[i]['box_type_3d'](boxes3d[task_mask][:, :7], 7).bev)
                                 top_scores = scores[task_mask]
 
@@ -1845,25 +2194,24 @@ class SparseFusionHead2D_Deform(nn.Module):
                                     # pre_maxsize=self.test_cfg['pre_maxsize'],
                                     # post_max_size=self.test_cfg['post_maxsize'],
                                 )
-                        else:
-                            task_keep_indices = torch.arange(task_mask.sum())
-                        if task_keep_indices.shape[0] != 0:
-                            keep_indices = torch.where(task_mask != 0)[0][task_keep_indices]
-                            keep_mask[keep_indices] = 1
-                    keep_mask = keep_mask.bool()
-                    ret = dict(bboxes=boxes3d[keep_mask], scores=scores[keep_mask], labels=labels[keep_mask])
-                else:  # no nms
-                    ret = dict(bboxes=boxes3d, scores=scores, labels=labels)
-                ret_layer.append(ret)
+                            else:
+                                task_keep_indices = torch.arange(task_mask.sum())
+                            if task_keep_indices.shape[0] != 0:
+                                keep_indices = torch.where(task_mask != 0)[0][task_keep_indices]
+                                keep_mask[keep_indices] = 1
+                        keep_mask = keep_mask.bool()
+                        ret = dict(bboxes=boxes3d[keep_mask], scores=scores[keep_mask], labels=labels[keep_mask])
+                    else:  # no nms
+                        ret = dict(bboxes=boxes3d, scores=scores, labels=labels)
+                    ret_layer.append(ret)
             rets.append(ret_layer)
         assert len(rets) == 1
-        assert len(rets[0]) == 1
 
         res = [[
-            img_metas[0]['box_type_3d'](rets[0][0]['bboxes'], box_dim=rets[0][0]['bboxes'].shape[-1]),
-            rets[0][0]['scores'],
-            rets[0][0]['labels'].int()
-        ]]
+            img_metas[i]['box_type_3d'](ret['bboxes'], box_dim=ret['bboxes'].shape[-1]),
+            ret['scores'],
+            ret['labels'].int()
+        ] for i, ret in enumerate(rets[0])]
         return res
 
     def get_layer_num_proposal(self, idx_layer):
@@ -9,8 +9,10 @@ import numpy as np
 import time
 
 from mmdet3d.core import (Box3DMode, Coord3DMode, bbox3d2result,
-                          merge_aug_bboxes_3d, show_result)
-from mmdet3d.ops import Voxelization
+                          merge_aug_bboxes_3d, rasterize_sparse_depth,
+                          sample_global_transforms, show_result,
+                          sparse_depth_calib, transform_points_batch)
+from mmdet3d.ops import Voxelization, dynamic_scatter
 from mmdet.core import multi_apply
 from mmdet.models import DETECTORS
 from .. import builder
@@ -19,10 +21,31 @@ from mmdet3d.ops import Voxelization
 
 @DETECTORS.register_module()
 class SparseFusionDetector(MVXTwoStageDetector):
-    """Base class of Multi-modality VoxelNet."""
-
-    def __init__(self, **kwargs):
+    """Base class of Multi-modality VoxelNet.
+
+    Args:
+        sparse_depth_cfg (dict, optional): When given, the sparse depth maps
+            are rasterized on the model device from the input points and the
+            calibration in ``img_metas`` instead of being loaded by the
+            ``SparseDepth`` pipeline, e.g. ``dict(scale_factors=[4])``.
+            Accepts the arguments of ``SparseDepth``. Defaults to None.
+        pts_aug_cfg (dict, optional): When given, the global rotation,
+            scaling, translation and flip of the point clouds are drawn per
+            sample and applied to the whole batch on the model device in
+            ``forward_train``, instead of by ``OurGlobalRotScaleTrans``,
+            ``OurRandomFlip3D``, ``PointsRangeFilter`` and
+            ``OurObjectRangeFilter`` in the dataloader workers. Accepts the
+            arguments of ``sample_global_transforms`` and
+            ``point_cloud_range``, and ``depth_mean`` and ``depth_var``, the
+            normalization of the sparse depth loaded by the ``SparseDepth``
+            pipeline, which default to the ones of ``sparse_depth_cfg`` or
+            else of ``SparseDepth``. Defaults to None.
+    """
+
+    def __init__(self, sparse_depth_cfg=None, pts_aug_cfg=None, **kwargs):
         super(SparseFusionDetector, self).__init__(**kwargs)
+        self.sparse_depth_cfg = sparse_depth_cfg
+        self.pts_aug_cfg = pts_aug_cfg
         
 
         self.freeze_img = kwargs.get('freeze_img', True)
@@ -89,6 +112,8 @@ class SparseFusionDetector(MVXTwoStageDetector):
                 B, N, C, H, W = img.size()
                 img = img.view(B * N, C, H, W)
 
+            if img_metas[0].get('img_norm_cfg', dict()).get('on_device', False):
+                img = self.normalize_img(img, img_metas)
             img_feats = self.img_backbone(img.float())
         else:
             return None
@@ -97,46 +122,241 @@ class SparseFusionDetector(MVXTwoStageDetector):
 
         return img_feats
 
+    @torch.no_grad()
+    def normalize_img(self, img, img_metas):
+        """Normalize the images left unnormalized by ``MyNormalize`` with
+        ``on_device=True``.
+
+        The channel swap and the normalization run as one op on the device of
+        the images, and the padding is set to 0 as ``MyPad`` does after
+        ``MyNormalize``.
+
+        Args:
+            img (torch.Tensor): Images of all views of the batch with the
+                shape of [B * N, C, H, W], usually uint8.
+            img_metas (list[dict]): Meta information of each sample.
+
+        Returns:
+            torch.Tensor: Normalized images in float32.
+        """
+        img_norm_cfg = img_metas[0]['img_norm_cfg']
+        mean = img.new_tensor(img_norm_cfg['mean'], dtype=torch.float32)
+        std = img.new_tensor(img_norm_cfg['std'], dtype=torch.float32)
+        if img_norm_cfg['to_rgb']:
+            img = img.flip(1)
+        scale = (1 / std).view(1, -1, 1, 1)
+        img = torch.addcmul((-mean).view(1, -1, 1, 1) * scale, img, scale)
+
+        num_views = img.size(0) // len(img_metas)
+        for batch_id, img_meta in enumerate(img_metas):
+            h, w = img_meta['img_shape'][:2]
+            views = img[batch_id * num_views:(batch_id + 1) * num_views]
+            views[..., h:, :] = 0
+            views[..., :h, w:] = 0
+        return img
+
     def extract_voxel_heights(self, voxels, coors):
+        """Min and max point height of every BEV cell of the head.
+
+        Points padded with zeros are ignored. All voxels are reduced into
+        the [B, H/out_size_factor, W/out_size_factor] grid in one scatter.
+        """
         batch_size = coors[-1, 0].item() + 1
         grid_size = self.test_cfg['pts']['grid_size']
         out_size_factor = self.test_cfg['pts']['out_size_factor']
 
-        height_num = grid_size[2]
         x_num = grid_size[0] // out_size_factor
         y_num = grid_size[1] // out_size_factor
 
-        voxels_ = voxels[:, :, 2].clone()
-        voxels_[voxels_==0] = 100
-        min_voxel = torch.min(voxels_, dim=-1)[0]
-        voxels_[voxels_==100] = -200
-        max_voxel = torch.max(voxels_, dim=-1)[0]
+        heights = voxels[:, :, 2]
+        padding = heights == 0
+        min_voxel = heights.masked_fill(padding, 100).min(dim=-1)[0]
+        max_voxel = heights.masked_fill(padding, -200).max(dim=-1)[0]
 
-        min_voxel_height = torch.zeros((batch_size, y_num, x_num, out_size_factor*out_size_factor)).to(voxels.device) + 100
-        max_voxel_height = torch.zeros((batch_size, y_num, x_num, out_size_factor*out_size_factor)).to(voxels.device) - 200
+        cell_ids = (coors[:, 0].long() * y_num + (coors[:, 2] // out_size_factor).long()) * x_num \
+            + (coors[:, 3] // out_size_factor).long()
+        num_cells = batch_size * y_num * x_num
 
-        batch_ids = coors[:, 0].long()
-        height_ids = coors[:, 1].long()
-        y_ids = (coors[:, 2] // out_size_factor).long()
-        x_ids = (coors[:, 3] // out_size_factor).long()
-        y_offsets = (coors[:, 2] % out_size_factor).long()
-        x_offsets = (coors[:, 3] % out_size_factor).long()
+        if hasattr(torch.Tensor, 'scatter_reduce_'):
+            min_voxel_height = min_voxel.new_full((num_cells, ), 100).scatter_reduce_(
+                0, cell_ids, min_voxel, reduce='amin')
+            max_voxel_height = max_voxel.new_full((num_cells, ), -200).scatter_reduce_(
+                0, cell_ids, max_voxel, reduce='amax')
+        else:
+            # torch<1.12, reduce both maps with a single max over the occupied cells
+            cell_feats, cells = dynamic_scatter(
+                torch.stack([-min_voxel, max_voxel], dim=-1).contiguous(),
+                cell_ids[:, None].int().contiguous(), 'max')
+            cells = cells[:, 0].long()
+            min_voxel_height = min_voxel.new_full((num_cells, ), 100)
+            max_voxel_height = max_voxel.new_full((num_cells, ), -200)
+            min_voxel_height[cells] = torch.minimum(min_voxel_height[cells], -cell_feats[:, 0])
+            max_voxel_height[cells] = torch.maximum(max_voxel_height[cells], cell_feats[:, 1])
+
+        min_voxel_height = min_voxel_height.view(batch_size, y_num, x_num)
+        max_voxel_height = max_voxel_height.view(batch_size, y_num, x_num)
 
-        for hid in range(height_num):
-            height_mask = height_ids == hid
-            batch_mask = batch_ids[height_mask]
-            y_ids_mask = y_ids[height_mask]
-            x_ids_mask = x_ids[height_mask]
-            y_offsets_mask = y_offsets[height_mask]
-            x_offsets_mask = x_offsets[height_mask]
+        return min_voxel_height, max_voxel_height
 
-            min_voxel_height[batch_mask, y_ids_mask, x_ids_mask, y_offsets_mask * out_size_factor + x_offsets_mask] = torch.minimum(min_voxel_height[batch_mask, y_ids_mask, x_ids_mask, y_offsets_mask * out_size_factor + x_offsets_mask], min_voxel[height_mask])
-            max_voxel_height[batch_mask, y_ids_mask, x_ids_mask, y_offsets_mask * out_size_factor + x_offsets_mask] = torch.maximum(max_voxel_height[batch_mask, y_ids_mask, x_ids_mask, y_offsets_mask * out_size_factor + x_offsets_mask], max_voxel[height_mask])
+    @torch.no_grad()
+    def generate_sparse_depth(self, points, img_metas):
+        """Rasterize the normalized sparse depth maps of a batch.
 
-        min_voxel_height = torch.min(min_voxel_height, dim=-1)[0]
-        max_voxel_height = torch.max(max_voxel_height, dim=-1)[0]
+        This is the in-graph counterpart of the ``SparseDepth`` pipeline, all
+        samples of the batch are rasterized together on the device of the
+        points.
 
-        return min_voxel_height, max_voxel_height
+        Args:
+            points (list[torch.Tensor]): Points of each sample.
+            img_metas (list[dict]): Meta information of each sample.
+
+        Returns:
+            torch.Tensor: Sparse depth with the shape of
+                [B, num_views, num_scales, 2, H, W].
+        """
+        cfg = self.sparse_depth_cfg
+        scale_factors = cfg['scale_factors']
+        device = points[0].device
+
+        lidar2img, valid_shapes = zip(*[sparse_depth_calib(img_meta) for img_meta in img_metas])
+        lidar2img = torch.from_numpy(np.stack(lidar2img)).to(device)
+        valid_shapes = torch.from_numpy(np.stack(valid_shapes)).to(device)
+
+        # only the points of the current sweep, as in the pipeline
+        points = [pts[pts[:, 4] == 0, :3] for pts in points]
+        pad_shape = img_metas[0]['pad_shape']
+        feat_shape = (pad_shape[0] // scale_factors[0], pad_shape[1] // scale_factors[0])
+        depth, valid_mask = rasterize_sparse_depth(
+            points, lidar2img, valid_shapes, feat_shape, scale_factors, cfg.get('exp_time', 0))
+        valid_mask = valid_mask.float()
+        depth = (depth - cfg.get('depth_mean', 14.41)) / np.sqrt(cfg.get('depth_var', 156.89)) * valid_mask
+        return torch.stack([depth, valid_mask], dim=3)
+
+    @torch.no_grad()
+    def augment_batch(self, points, img_metas, annos, sparse_depth=None):
+        """Apply the global 3D augmentation to a batch on the model device.
+
+        The points of all samples are transformed and range filtered in one
+        pass. The annotations in ``annos`` and the calibration in
+        ``img_metas`` are updated in place as ``OurGlobalRotScaleTrans``,
+        ``OurRandomFlip3D`` and ``OurObjectRangeFilter`` would do.
+
+        Args:
+            points (list[torch.Tensor]): Points of each sample.
+            img_metas (list[dict]): Meta information of each sample.
+            annos (dict): Annotations of the batch, keyed by the arguments of
+                ``forward_train``.
+            sparse_depth (torch.Tensor, optional): Normalized sparse depth of
+                the batch loaded by the ``SparseDepth`` pipeline. The scaling
+                changes its depth. Defaults to None.
+
+        Returns:
+            tuple[list[torch.Tensor], torch.Tensor]: Augmented points and
+                sparse depth.
+        """
+        cfg = dict(self.pts_aug_cfg)
+        point_cloud_range = cfg.pop('point_cloud_range', None)
+        sparse_depth_cfg = self.sparse_depth_cfg or dict()
+        depth_mean = cfg.pop('depth_mean', sparse_depth_cfg.get('depth_mean', 14.41))
+        depth_var = cfg.pop('depth_var', sparse_depth_cfg.get('depth_var', 156.89))
+        params = sample_global_transforms(
+            len(points), device=points[0].device, **cfg)
+        points = transform_points_batch(points, params['transform'],
+                                        point_cloud_range)
+
+        transforms = params['transform'].cpu().numpy().astype(np.float64)
+        rotations = params['rotation'].tolist()
+        scales = params['scale'].tolist()
+        translations = params['translation'].cpu().numpy()
+        horizontal_flips = params['horizontal_flip'].tolist()
+        vertical_flips = params['vertical_flip'].tolist()
+        for i, img_meta in enumerate(img_metas):
+            scale = scales[i]
+            linear = transforms[i, :3, :3] / scale
+            translation = transforms[i, :3, 3]
+            # the extrinsics keep their rotation and scale the camera coordinates
+            lidar2cam_r = np.stack(img_meta['lidar2cam_r']) @ linear.T
+            lidar2cam_t = scale * np.stack(img_meta['lidar2cam_t']) - lidar2cam_r @ translation
+            if 'lidar2img' in img_meta:
+                lidar2img = np.stack(img_meta['lidar2img'])
+                inv_transform = np.eye(4)
+                inv_transform[:3, :3] = linear.T
+                inv_transform[:3, 3] = -linear.T @ translation
+                inv_transform[3, 3] = scale
+                lidar2img[:, :3] = lidar2img[:, :3] @ inv_transform
+                img_meta['lidar2img'] = list(lidar2img)
+            img_meta['lidar2cam_r'] = list(lidar2cam_r)
+            img_meta['lidar2cam_t'] = list(lidar2cam_t)
+            img_meta.update(
+                pcd_rotation_angle=rotations[i],
+                pcd_scale_factor=scale,
+                pcd_trans=translations[i],
+                pcd_horizontal_flip=horizontal_flips[i],
+                pcd_vertical_flip=vertical_flips[i])
+
+            flips = [direction for direction, flip in zip(
+                ['horizontal', 'vertical'], [horizontal_flips[i], vertical_flips[i]]) if flip]
+            for key in ['gt_bboxes_3d', 'gt_bboxes_lidar_view']:
+                if annos.get(key) is None:
+                    continue
+                boxes = annos[key][i]
+                boxes.rotate(rotations[i])
+                boxes.scale(scale)
+                boxes.translate(translations[i])
+                for direction in flips:
+                    boxes.flip(direction)
+            if annos.get('gt_bboxes_cam_view') is not None:
+                annos['gt_bboxes_cam_view'][i].scale(scale)
+            if annos.get('gt_img_centers_view') is not None:
+                annos['gt_img_centers_view'][i][:, 2] *= scale
+            if annos.get('gt_pts_centers_view') is not None:
+                centers = annos['gt_pts_centers_view'][i]
+                transform = params['transform'][i].to(centers)
+                annos['gt_pts_centers_view'][i] = centers @ transform[:3, :3].T + transform[:3, 3]
+
+            if point_cloud_range is not None:
+                self._filter_annos(annos, i, point_cloud_range)
+
+        if sparse_depth is not None:
+            depth_std = np.sqrt(depth_var)
+            scale = params['scale'].to(sparse_depth)[:, None, None, None, None]
+            valid_mask = sparse_depth[:, :, :, 1]
+            depth = sparse_depth[:, :, :, 0] * depth_std + depth_mean
+            sparse_depth = sparse_depth.clone()
+            sparse_depth[:, :, :, 0] = (depth * scale - depth_mean) / depth_std * valid_mask
+        return points, sparse_depth
+
+    @staticmethod
+    def _filter_annos(annos, sample_id, point_cloud_range):
+        """Filter the annotations of a sample by the range as
+        ``OurObjectRangeFilter``.
+
+        Args:
+            annos (dict): Annotations of the batch.
+            sample_id (int): Index of the sample to filter.
+            point_cloud_range (list[float]): Point cloud range.
+        """
+        bev_range = [point_cloud_range[i] for i in [0, 1, 3, 4]]
+        gt_bboxes_3d = annos['gt_bboxes_3d'][sample_id]
+        mask = gt_bboxes_3d.in_range_bev(bev_range)
+        gt_bboxes_3d = gt_bboxes_3d[mask]
+        gt_bboxes_3d.limit_yaw(offset=0.5, period=2 * np.pi)
+        annos['gt_bboxes_3d'][sample_id] = gt_bboxes_3d
+        for key in ['gt_labels_3d', 'gt_visible_3d']:
+            if annos.get(key) is not None:
+                annos[key][sample_id] = annos[key][sample_id][mask.to(annos[key][sample_id].device)]
+
+        if annos.get('gt_pts_centers_view') is None:
+            return
+        centers = annos['gt_pts_centers_view'][sample_id]
+        mask_2d = (centers[:, 0] > bev_range[0]) & (centers[:, 0] < bev_range[2]) & \
+            (centers[:, 1] > bev_range[1]) & (centers[:, 1] < bev_range[3])
+        for key in ['gt_bboxes', 'gt_labels', 'gt_img_centers_view', 'gt_pts_centers_view',
+                    'gt_bboxes_cam_view', 'gt_bboxes_lidar_view']:
+            if annos.get(key) is not None:
+                value = annos[key][sample_id]
+                device = value.device if isinstance(value, torch.Tensor) else value.tensor.device
+                annos[key][sample_id] = value[mask_2d.to(device)]
 
     def extract_pts_feat(self, pts, img_feats, img_metas):
         """Extract features of points."""
@@ -169,19 +389,10 @@ class SparseFusionDetector(MVXTwoStageDetector):
             tuple[torch.Tensor]: Concatenated points, number of points
                 per voxel, and coordinates.
         """
-        voxels, coors, num_points = [], [], []
-        for res in points:
-            res_voxels, res_coors, res_num_points = self.pts_voxel_layer(res)
-            voxels.append(res_voxels)
-            coors.append(res_coors)
-            num_points.append(res_num_points)
-        voxels = torch.cat(voxels, dim=0)
-        num_points = torch.cat(num_points, dim=0)
-        coors_batch = []
-        for i, coor in enumerate(coors):
-            coor_pad = F.pad(coor, (1, 0), mode='constant', value=i)
-            coors_batch.append(coor_pad)
-        coors_batch = torch.cat(coors_batch, dim=0)
+        # all samples are voxelized in one pass, coordinates come with the batch index
+        batch_offsets = torch.tensor([0] + [len(res) for res in points], device=points[0].device).cumsum(0)
+        voxels, coors_batch, num_points = self.pts_voxel_layer.forward_batched(
+            torch.cat(points, dim=0), batch_offsets)
 
         min_voxel_height, max_voxel_height = self.extract_voxel_heights(voxels, coors_batch)
 
@@ -228,9 +439,24 @@ class SparseFusionDetector(MVXTwoStageDetector):
         Returns:
             dict: Losses of different branches.
         """
-        
+        if self.pts_aug_cfg is not None:
+            annos = dict(
+                gt_bboxes_3d=gt_bboxes_3d,
+                gt_labels_3d=gt_labels_3d,
+                gt_labels=gt_labels,
+                gt_bboxes=gt_bboxes,
+                gt_pts_centers_view=gt_pts_centers_view,
+                gt_img_centers_view=gt_img_centers_view,
+                gt_bboxes_cam_view=gt_bboxes_cam_view,
+                gt_visible_3d=gt_visible_3d,
+                gt_bboxes_lidar_view=gt_bboxes_lidar_view)
+            points, sparse_depth = self.augment_batch(
+                points, img_metas, annos, sparse_depth)
+
         img_feats, pts_feats = self.extract_feat(
             points, img=img, img_metas=img_metas)
+        if sparse_depth is None and self.sparse_depth_cfg is not None:
+            sparse_depth = self.generate_sparse_depth(points, img_metas)
         losses = dict()
         if pts_feats:
             losses_pts = self.forward_pts_train(
@@ -326,6 +552,8 @@ class SparseFusionDetector(MVXTwoStageDetector):
         """Test function without augmentaiton."""
         img_feats, pts_feats = self.extract_feat(
             points, img=img, img_metas=img_metas)
+        if sparse_depth is None and self.sparse_depth_cfg is not None:
+            sparse_depth = self.generate_sparse_depth(points, img_metas)
 
         bbox_list = [dict() for i in range(len(img_metas))]
         if pts_feats and self.with_pts_bbox:
@@ -368,6 +596,7 @@ class SparseFusionDetector(MVXTwoStageDetector):
 
         if num_augs == 1:
             img = [img] if img is None else img
+            sparse_depth = [None] if sparse_depth is None else sparse_depth
             return self.simple_test(points[0], img_metas[0], img[0], sparse_depth[0], **kwargs)
         else: # True
             return self.aug_test(points, img_metas, img, **kwargs)
\ No newline at end of file
@@ -1,5 +1,6 @@
 from .clip_sigmoid import clip_sigmoid
 from .inverse_sigmoid import inverse_sigmoid
+from .topk import topk_indices
 from .mlp import MLP
 from .transformerdecoder import PositionEmbeddingLearned, TransformerDecoderLayer, MultiheadAttention, PositionEmbeddingLearnedwoNorm
 from .ffn import FFN, FFNLN
@@ -17,5 +18,6 @@ __all__ = ['clip_sigmoid', "MLP", 'PositionEmbeddingLearned', 'TransformerDecode
            'Dropout', 'DropPath', 'build_dropout',
            'DeformableTransformerDecoderLayer' 'ImageTransformer_Cam_3D_MS',
            'ViewTransformer', 'DepthEncoderResNet',
-           'LayerNorm', 'ConvLN', "normalize_pos", "denormalize_pos"
+           'LayerNorm', 'ConvLN', "normalize_pos", "denormalize_pos",
+           'topk_indices'
 ]
@@ -8,27 +8,232 @@
 **************************************************************************************************
 */
 
+#include <cmath>
 #include <vector>
 
 #include <ATen/ATen.h>
-#include <ATen/cuda/CUDAContext.h>
+#include <ATen/Parallel.h>
+
+
+// Bilinear corners of a sampling location, same convention as the CUDA im2col kernels:
+// pixel centers at integer + 0.5 and zero padding outside of the feature map.
+template <typename scalar_t>
+struct BilinearCorners
+{
+    int64_t ptr[4];
+    scalar_t weight[4];
+    bool valid[4];
+    scalar_t lh, lw, hh, hw;
+};
+
+template <typename scalar_t>
+static inline bool ms_deform_attn_bilinear_corners(
+    const scalar_t loc_h, const scalar_t loc_w, const int64_t height, const int64_t width,
+    const int64_t base_ptr, const int64_t row_stride, BilinearCorners<scalar_t> &corners)
+{
+    const scalar_t h_im = loc_h * height - 0.5;
+    const scalar_t w_im = loc_w * width - 0.5;
+    if (!(h_im > -1 && w_im > -1 && h_im < height && w_im < width))
+        return false;
+
+    const int64_t h_low = static_cast<int64_t>(std::floor(h_im));
+    const int64_t w_low = static_cast<int64_t>(std::floor(w_im));
+    const int64_t h_high = h_low + 1;
+    const int64_t w_high = w_low + 1;
+
+    corners.lh = h_im - h_low;
+    corners.lw = w_im - w_low;
+    corners.hh = 1 - corners.lh;
+    corners.hw = 1 - corners.lw;
+
+    corners.valid[0] = h_low >= 0 && w_low >= 0;
+    corners.valid[1] = h_low >= 0 && w_high <= width - 1;
+    corners.valid[2] = h_high <= height - 1 && w_low >= 0;
+    corners.valid[3] = h_high <= height - 1 && w_high <= width - 1;
+
+    corners.ptr[0] = base_ptr + (h_low * width + w_low) * row_stride;
+    corners.ptr[1] = base_ptr + (h_low * width + w_high) * row_stride;
+    corners.ptr[2] = base_ptr + (h_high * width + w_low) * row_stride;
+    corners.ptr[3] = base_ptr + (h_high * width + w_high) * row_stride;
+
+    corners.weight[0] = corners.hh * corners.hw;
+    corners.weight[1] = corners.hh * corners.lw;
+    corners.weight[2] = corners.lh * corners.hw;
+    corners.weight[3] = corners.lh * corners.lw;
+    return true;
+}
+
+
+template <typename scalar_t>
+static void ms_deformable_im2col_cpu(
+    const scalar_t *data_value,
+    const int64_t *data_spatial_shapes,
+    const int64_t *data_level_start_index,
+    const scalar_t *data_sampling_loc,
+    const scalar_t *data_attn_weight,
+    const int64_t batch_size, const int64_t spatial_size, const int64_t num_heads, const int64_t channels,
+    const int64_t num_levels, const int64_t num_query, const int64_t num_point,
+    scalar_t *data_col)
+{
+    const int64_t row_stride = num_heads * channels;
+    // every (batch, query, head) owns its output row, no synchronization is needed
+    at::parallel_for(0, batch_size * num_query * num_heads, 1, [&](int64_t begin, int64_t end) {
+        for (int64_t index = begin; index < end; ++index)
+        {
+            const int64_t m = index % num_heads;
+            const int64_t b = index / (num_query * num_heads);
+            scalar_t *col = data_col + index * channels;
+            const scalar_t *loc = data_sampling_loc + index * num_levels * num_point * 2;
+            const scalar_t *attn = data_attn_weight + index * num_levels * num_point;
+
+            for (int64_t l = 0; l < num_levels; ++l)
+            {
+                const int64_t height = data_spatial_shapes[l * 2];
+                const int64_t width = data_spatial_shapes[l * 2 + 1];
+                const int64_t base_ptr = (b * spatial_size + data_level_start_index[l]) * row_stride + m * channels;
+                for (int64_t p = 0; p < num_point; ++p, loc += 2, ++attn)
+                {
+                    BilinearCorners<scalar_t> corners;
+                    if (!ms_deform_attn_bilinear_corners(loc[1], loc[0], height, width, base_ptr, row_stride, corners))
+                        continue;
+                    for (int k = 0; k < 4; ++k)
+                    {
+                        if (!corners.valid[k])
+                            continue;
+                        const scalar_t weight = corners.weight[k] * attn[0];
+                        const scalar_t *value = data_value + corners.ptr[k];
+                        for (int64_t c = 0; c < channels; ++c)
+                            col[c] += weight * value[c];
+                    }
+                }
+            }
+        }
+    });
+}
+
+
+template <typename scalar_t>
+static void ms_deformable_col2im_cpu(
+    const scalar_t *data_value,
+    const int64_t *data_spatial_shapes,
+    const int64_t *data_level_start_index,
+    const scalar_t *data_sampling_loc,
+    const scalar_t *data_attn_weight,
+    const scalar_t *grad_col,
+    const int64_t batch_size, const int64_t spatial_size, const int64_t num_heads, const int64_t channels,
+    const int64_t num_levels, const int64_t num_query, const int64_t num_point,
+    scalar_t *grad_value,
+    scalar_t *grad_sampling_loc,
+    scalar_t *grad_attn_weight)
+{
+    const int64_t row_stride = num_heads * channels;
+    // the queries of one (batch, head) scatter into the same value rows, so the work is
+    // split over (batch, head) pairs, whose value rows are disjoint
+    at::parallel_for(0, batch_size * num_heads, 1, [&](int64_t begin, int64_t end) {
+        scalar_t corner_values[4];
+        for (int64_t bm = begin; bm < end; ++bm)
+        {
+            const int64_t b = bm / num_heads;
+            const int64_t m = bm % num_heads;
+            for (int64_t q = 0; q < num_query; ++q)
+            {
+                const int64_t index = (b * num_query + q) * num_heads + m;
+                const scalar_t *top_grad = grad_col + index * channels;
+                const scalar_t *loc = data_sampling_loc + index * num_levels * num_point * 2;
+                const scalar_t *attn = data_attn_weight + index * num_levels * num_point;
+                scalar_t *grad_loc = grad_sampling_loc + index * num_levels * num_point * 2;
+                scalar_t *grad_attn = grad_attn_weight + index * num_levels * num_point;
+
+                for (int64_t l = 0; l < num_levels; ++l)
+                {
+                    const int64_t height = data_spatial_shapes[l * 2];
+                    const int64_t width = data_spatial_shapes[l * 2 + 1];
+                    const int64_t base_ptr = (b * spatial_size + data_level_start_index[l]) * row_stride + m * channels;
+                    for (int64_t p = 0; p < num_point; ++p, loc += 2, ++attn, grad_loc += 2, ++grad_attn)
+                    {
+                        BilinearCorners<scalar_t> corners;
+                        if (!ms_deform_attn_bilinear_corners(loc[1], loc[0], height, width, base_ptr, row_stride, corners))
+                            continue;
+
+                        scalar_t grad_attn_sum = 0, grad_h_sum = 0, grad_w_sum = 0;
+                        for (int64_t c = 0; c < channels; ++c)
+                        {
+                            for (int k = 0; k < 4; ++k)
+                                corner_values[k] = corners.valid[k] ? data_value[corners.ptr[k] + c] : scalar_t(0);
+                            const scalar_t val = corners.weight[0] * corner_values[0] + corners.weight[1] * corner_values[1]
+                                               + corners.weight[2] * corner_values[2] + corners.weight[3] * corner_values[3];
+                            const scalar_t grad_h_weight = -corners.hw * corner_values[0] - corners.lw * corner_values[1]
+                                                           + corners.hw * corner_values[2] + corners.lw * corner_values[3];
+                            const scalar_t grad_w_weight = -corners.hh * corner_values[0] + corners.hh * corner_values[1]
+                                                           - corners.lh * corner_values[2] + corners.lh * corner_values[3];
+                            const scalar_t top_grad_value = top_grad[c] * attn[0];
+
+                            grad_attn_sum += top_grad[c] * val;
+                            grad_h_sum += grad_h_weight * top_grad_value;
+                            grad_w_sum += grad_w_weight * top_grad_value;
+                            for (int k = 0; k < 4; ++k)
+                                if (corners.valid[k])
+                                    grad_value[corners.ptr[k] + c] += corners.weight[k] * top_grad_value;
+                        }
+                        grad_attn[0] = grad_attn_sum;
+                        grad_loc[0] = width * grad_w_sum;
+                        grad_loc[1] = height * grad_h_sum;
+                    }
+                }
+            }
+        }
+    });
+}
 
 
 at::Tensor
 ms_deform_attn_cpu_forward(
-    const at::Tensor &value, 
+    const at::Tensor &value,
     const at::Tensor &spatial_shapes,
     const at::Tensor &level_start_index,
     const at::Tensor &sampling_loc,
     const at::Tensor &attn_weight,
     const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
+    AT_ASSERTM(!value.is_cuda(), "value must be a CPU tensor");
+
+    const auto value_ = value.contiguous();
+    const auto spatial_shapes_ = spatial_shapes.contiguous();
+    const auto level_start_index_ = level_start_index.contiguous();
+    const auto sampling_loc_ = sampling_loc.contiguous();
+    const auto attn_weight_ = attn_weight.contiguous();
+
+    const int64_t batch = value.size(0);
+    const int64_t spatial_size = value.size(1);
+    const int64_t num_heads = value.size(2);
+    const int64_t channels = value.size(3);
+
+    const int64_t num_levels = spatial_shapes.size(0);
+
+    const int64_t num_query = sampling_loc.size(1);
+    const int64_t num_point = sampling_loc.size(4);
+
+    auto output = at::zeros({batch, num_query, num_heads, channels}, value.options());
+
+    AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_forward_cpu", ([&] {
+        ms_deformable_im2col_cpu(
+            value_.data_ptr<scalar_t>(),
+            spatial_shapes_.data_ptr<int64_t>(),
+            level_start_index_.data_ptr<int64_t>(),
+            sampling_loc_.data_ptr<scalar_t>(),
+            attn_weight_.data_ptr<scalar_t>(),
+            batch, spatial_size, num_heads, channels, num_levels, num_query, num_point,
+            output.data_ptr<scalar_t>());
+    }));
+
+    output = output.view({batch, num_query, num_heads*channels});
+    return output;
 }
 
+
 std::vector<at::Tensor>
 ms_deform_attn_cpu_backward(
-    const at::Tensor &value, 
+    const at::Tensor &value,
     const at::Tensor &spatial_shapes,
     const at::Tensor &level_start_index,
     const at::Tensor &sampling_loc,
@@ -36,6 +241,44 @@ ms_deform_attn_cpu_backward(
     const at::Tensor &grad_output,
     const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
-}
+    AT_ASSERTM(!value.is_cuda(), "value must be a CPU tensor");
+
+    const auto value_ = value.contiguous();
+    const auto spatial_shapes_ = spatial_shapes.contiguous();
+    const auto level_start_index_ = level_start_index.contiguous();
+    const auto sampling_loc_ = sampling_loc.contiguous();
+    const auto attn_weight_ = attn_weight.contiguous();
+    const auto grad_output_ = grad_output.contiguous();
+
+    const int64_t batch = value.size(0);
+    const int64_t spatial_size = value.size(1);
+    const int64_t num_heads = value.size(2);
+    const int64_t channels = value.size(3);
+
+    const int64_t num_levels = spatial_shapes.size(0);
 
+    const int64_t num_query = sampling_loc.size(1);
+    const int64_t num_point = sampling_loc.size(4);
+
+    auto grad_value = at::zeros_like(value_);
+    auto grad_sampling_loc = at::zeros_like(sampling_loc_);
+    auto grad_attn_weight = at::zeros_like(attn_weight_);
+
+    AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_backward_cpu", ([&] {
+        ms_deformable_col2im_cpu(
+            value_.data_ptr<scalar_t>(),
+            spatial_shapes_.data_ptr<int64_t>(),
+            level_start_index_.data_ptr<int64_t>(),
+            sampling_loc_.data_ptr<scalar_t>(),
+            attn_weight_.data_ptr<scalar_t>(),
+            grad_output_.data_ptr<scalar_t>(),
+            batch, spatial_size, num_heads, channels, num_levels, num_query, num_point,
+            grad_value.data_ptr<scalar_t>(),
+            grad_sampling_loc.data_ptr<scalar_t>(),
+            grad_attn_weight.data_ptr<scalar_t>());
+    }));
+
+    return {
+        grad_value, grad_sampling_loc, grad_attn_weight
+    };
+}
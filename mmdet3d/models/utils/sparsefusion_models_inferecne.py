@@ -334,7 +334,7 @@ class ViewTransformer(nn.Module):
 
 class FusionTransformer2D_3D_Self(nn.Module):
     def __init__(self, hidden_channel, num_heads, num_decoder_layers, prediction_heads, ffn_channel, dropout, activation, test_cfg,
-                 query_pos, key_pos, pts_projection, img_projection, num_proposals):
+                 query_pos, key_pos, pts_projection, img_projection, num_proposals, calibration=None, fusion_type="static"):
         super(FusionTransformer2D_3D_Self, self).__init__()
         self.hidden_channel = hidden_channel
         self.num_heads = num_heads
@@ -346,6 +346,10 @@ class FusionTransformer2D_3D_Self(nn.Module):
         self.pts_projection = pts_projection
         self.img_projection = img_projection
         self.num_proposals = num_proposals
+        # CalibrationState shared with the head, None disables calibrated fusion
+        self.calibration = calibration
+        self.fusion_type = fusion_type
+        self.ncscores = None
 
         self.decoder = nn.ModuleList()
         for i in range(self.num_decoder_layers):
@@ -364,118 +368,19 @@ class FusionTransformer2D_3D_Self(nn.Module):
             nn.LayerNorm(400),
         )
 
-    def compute_ncscore(self, img_output, pts_output, layer_id=None):
-        curr_model = "/home/minkycho/SparseFusion/work_dirs/sparsefusion_nusc_voxel_LC_r50_elsumffn_2ndtrain/epoch_2.pth"
-        tmp = torch.load(curr_model)
+    def compute_ncscore(self, img_output, pts_output):
+        # img_output.shape == pts_output.shape == [bs, num_proposals, C], all samples are scored in one pass
+        return self.calibration.score(img_output, pts_output)
 
-        feature_aligner = FeatureAligner(input_dim=128, hidden_dim=256, output_dim=128, mode="test")
+    def dynamic_weighting(self, img_output, pts_output, fusion_type="static"):
+        if fusion_type == "static": # Fist Stage: Cam_On;y
+            cam_ncscore, lidar_ncscore, img_centers_idx, pts_centers_idx, top3_img_values, top3_img_indices, top3_pts_values, top3_pts_indices = self.compute_ncscore(img_output, pts_output) # img_output.shape == pts_output.shape == [1, 900, 256]
+            # ranks against the per-class calibration scores of the nearest center, None without a table
+            p_cam, p_lidar = self.calibration.p_values(cam_ncscore, img_centers_idx, lidar_ncscore, pts_centers_idx)
 
-        centers = tmp["state_dict"][f"pts_bbox_head.center_loss.centers{layer_id}"]
-
-        # Assuming feature_aligner has layers fc1 to fc8
-        for i in range(1, 9):
-            layer = getattr(feature_aligner, f'fc{i}')
-            
-            layer.weight = torch.nn.Parameter(
-                tmp[f"state_dict"][f"pts_bbox_head.feature_aligner{layer_id}.fc{i}.weight"]
-            )
-            layer.bias = torch.nn.Parameter(
-                tmp[f"state_dict"][f"pts_bbox_head.feature_aligner{layer_id}.fc{i}.bias"]
-            )
-
-        # assert (centers == tmp["state_dict"][f"pts_bbox_head.center_loss.centers{layer_id}"]).all()
-        # assert (feature_aligner.fc1.weight == tmp["state_dict"][f"pts_bbox_head.feature_aligner{layer_id}.fc1.weight"]).all()
-        # assert (feature_aligner.fc1.bias == tmp["state_dict"][f"pts_bbox_head.feature_aligner{layer_id}.fc1.bias"]).all()
-        # assert (feature_aligner.fc2.weight == tmp["state_dict"][f"pts_bbox_head.feature_aligner{layer_id}.fc2.weight"]).all()
-        # assert (feature_aligner.fc2.bias == tmp["state_dict"][f"pts_bbox_head.feature_aligner{layer_id}.fc2.bias"]).all()
-        # assert (feature_aligner.fc8.weight == tmp["state_dict"][f"pts_bbox_head.feature_aligner{layer_id}.fc8.weight"]).all()
-        # assert (feature_aligner.fc8.bias == tmp["state_dict"][f"pts_bbox_head.feature_aligner{layer_id}.fc8.bias"]).all()
-
-
-        img_feats_aligned = feature_aligner(img_output.cpu())
-        pts_feats_aligned = feature_aligner(pts_output.cpu())
-
-        classes = torch.arange(10).long()  # TODO: if use_gpu(), then cuda()
-
-        img_to_center = torch.cdist(
-            img_feats_aligned[0].double(), centers.double(), p=2
-        )  # [900, 10]
-        img_centers_idx = torch.argmin(img_to_center, dim=1)  # [900]
-        img_centers = centers[img_centers_idx]  # [900, 128]
-        
-        pts_to_center = torch.cdist(
-            pts_feats_aligned[0].double(), centers.double(), p=2
-        )
-        pts_centers_idx = torch.argmin(pts_to_center, dim=1)
-        pts_centers = centers[pts_centers_idx]
-        
-        top3_img_values, top3_img_indices = torch.topk(img_to_center, k=10, largest=False)
-        top3_pts_values, top3_pts_indices = torch.topk(pts_to_center, k=10, largest=False)
-        
-        assert round(pts_to_center[200][4].item(), 3) == round(
-            torch.norm(
-                pts_feats_aligned[0][200].double() - centers[4].double(), p=2
-            ).item(),
-            3,
-        )
-        assert round(pts_to_center[0][0].item(), 3) == round(
-            torch.norm(
-                pts_feats_aligned[0][0].double() - centers[0].double(), p=2
-            ).item(),
-            3,
-        )
-        assert round(pts_to_center[10][1].item(), 3) == round(
-            torch.norm(
-                pts_feats_aligned[0][10].double() - centers[1].double(), p=2
-            ).item(),
-            3,
-        )
-
-        for i in range(20):
-            assert (
-                pts_centers[i] == centers[torch.argmin(pts_to_center, dim=1)[i]]
-            ).all()
-
-        ncscore_img = torch.norm(
-            img_feats_aligned[0] - img_centers, p=2, dim=1
-        )  # [900]
-        ncscore_pts = torch.norm(
-            pts_feats_aligned[0] - pts_centers, p=2, dim=1
-        )  # [900]
-            
-        return ncscore_img, ncscore_pts, img_centers_idx, pts_centers_idx, top3_img_values, top3_img_indices, top3_pts_values, top3_pts_indices
-
-
-    def dynamic_weighting(self, img_output, pts_output, calib_path, fusion_type="static"):
-        cam_consistency = torch.zeros(200, 10)
-        lidar_consistency = torch.zeros(200, 10)
-        
-        print ("@@@@@ hi: dynamic_weighting.py")
-        exit()
-        if True: #not is_localization: # Fist Stage: Cam_On;y
-            cam_ncscore, lidar_ncscore, img_centers_idx, pts_centers_idx, top3_img_values, top3_img_indices, top3_pts_values, top3_pts_indices = self.compute_ncscore(img_output, pts_output, layer_id=layer_id) # img_output.shape == pts_output.shape == [1, 900, 256]
-            p_cam = None
-            p_lidar = None
-            
-            '''
-            # dummies...
-            cam_consistency[torch.arange(cam_consistency.shape[0]), top3_img_indices[:, 0]] = 1 
-            lidar_consistency[torch.arange(lidar_consistency.shape[0]), top3_pts_indices[:, 0]] = 1
-            cam_ranks = torch.ones(200)
-            lidar_ranks = torch.ones(200)
-            indices_for_gathering = top3_img_indices[:, 0]
-            cam_ranks = ((calib_values_matrix[indices_for_gathering] > cam_ncscore.unsqueeze(1)).sum(dim=1).float() / calib_lengths_vector[indices_for_gathering])
-            indices_for_gathering = top3_pts_indices[:, 0]
-            lidar_ranks = ((calib_values_matrix[indices_for_gathering] > lidar_ncscore.unsqueeze(1)).sum(dim=1).float() / calib_lengths_vector[indices_for_gathering])                    
-                
-            if prev_cam_factor is not None:
-                prev_cam_factor = None
-                prev_lidar_factor = None
-            '''
-                
             # img_output *= 1.
             # pts_output *= 1.
-            return img_output, pts_output, cam_ncscore, lidar_ncscore #, cam_ranks, lidar_ranks, img_centers_idx, pts_centers_idx, top3_img_values, top3_img_indices, top3_pts_values, top3_pts_indices, cam_consistency, lidar_consistency, prev_cam_factor, prev_lidar_factor
+            return img_output, pts_output, cam_ncscore, lidar_ncscore, p_cam, p_lidar #, cam_ranks, lidar_ranks, img_centers_idx, pts_centers_idx, top3_img_values, top3_img_indices, top3_pts_values, top3_pts_indices, cam_consistency, lidar_consistency, prev_cam_factor, prev_lidar_factor
 
             
         # elif is_localization and not is_classification: # Second Stage: LiDAR only
@@ -501,10 +406,13 @@ class FusionTransformer2D_3D_Self(nn.Module):
         
         
         # case2: elsum + ffn
-        if True: #self.run_mode == "test": # and layer_id == 5:
-            img_query_feat, pts_query_feat, cam_ncscore, lidar_ncscore  = self.dynamic_weighting(
-                img_output, pts_output, calib_path, fusion_type=self.fusion_type
+        if self.calibration is not None:
+            img_output, pts_output, cam_ncscore, lidar_ncscore, p_cam, p_lidar = self.dynamic_weighting(
+                img_query_feat.permute(0, 2, 1), pts_query_feat.permute(0, 2, 1), fusion_type=self.fusion_type
             )
+            img_query_feat = img_output.permute(0, 2, 1)
+            pts_query_feat = pts_output.permute(0, 2, 1)
+            self.ncscores = dict(cam=cam_ncscore, lidar=lidar_ncscore, p_cam=p_cam, p_lidar=p_lidar)
             # img_query_feat, pts_query_feat, cam_ncscore, lidar_ncscore, p_cam, p_lidar, img_centers_idx, pts_centers_idx, top3_img_values, top3_img_indices, top3_pts_values, top3_pts_indices, cam_consistency, lidar_consistency, cam_factor, lidar_factor  = self.dynamic_weighting(
             #     img_output, pts_output, calib_path, fusion_type=self.fusion_type
             # )
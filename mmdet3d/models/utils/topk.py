@@ -0,0 +1,31 @@
+import torch
+
+
+def topk_indices(scores, k):
+    """Indices of the k largest scores along the last dim, without a full sort.
+
+    Ties are broken by the smaller index, as a stable descending sort would do,
+    so the result is deterministic on both CPU and GPU. Only ``topk`` and
+    element-wise passes run over the full tensor, the final ordering is
+    computed among the k selected entries.
+
+    Args:
+        scores (torch.Tensor): Scores with the shape of [B, N].
+        k (int): Number of indices to keep.
+
+    Returns:
+        torch.Tensor: Indices with the shape of [B, k], sorted by descending
+            score then ascending index.
+    """
+    kth_score = scores.topk(k, dim=-1)[0][..., -1:]  # [B, 1]
+    greater = scores > kth_score
+    equal = scores == kth_score
+    # among the entries tied with the k-th score keep the ones with the smallest indices
+    num_ties = k - greater.sum(dim=-1, keepdim=True)
+    selected = greater | (equal & (torch.cumsum(equal.long(), dim=-1) <= num_ties))
+    indices = torch.nonzero(selected, as_tuple=False)[:, 1].view(scores.shape[0], k)  # ascending index
+
+    selected_scores = scores.gather(-1, indices)
+    rank = (selected_scores[:, None, :] > selected_scores[:, :, None]).sum(dim=-1)
+    rank = rank + torch.tril(selected_scores[:, None, :] == selected_scores[:, :, None], diagonal=-1).sum(dim=-1)
+    return indices.new_zeros(indices.shape).scatter_(-1, rank, indices)
@@ -6,6 +6,8 @@ from . import iou3d_cuda
 def boxes_iou_bev(boxes_a, boxes_b):
     """Calculate boxes IoU in the bird view.
 
+    The CUDA or the CPU implementation is picked by the device of the boxes.
+
     Args:
         boxes_a (torch.Tensor): Input boxes a with shape (M, 5).
         boxes_b (torch.Tensor): Input boxes b with shape (N, 5).
@@ -16,8 +18,12 @@ def boxes_iou_bev(boxes_a, boxes_b):
     ans_iou = boxes_a.new_zeros(
         torch.Size((boxes_a.shape[0], boxes_b.shape[0])))
 
-    iou3d_cuda.boxes_iou_bev_gpu(boxes_a.contiguous(), boxes_b.contiguous(),
-                                 ans_iou)
+    if boxes_a.is_cuda:
+        iou3d_cuda.boxes_iou_bev_gpu(boxes_a.contiguous(),
+                                     boxes_b.contiguous(), ans_iou)
+    else:
+        iou3d_cuda.boxes_iou_bev_cpu(boxes_a.contiguous(),
+                                     boxes_b.contiguous(), ans_iou)
 
     return ans_iou
 
@@ -25,6 +31,9 @@ def boxes_iou_bev(boxes_a, boxes_b):
 def nms_gpu(boxes, scores, thresh, pre_maxsize=None, post_max_size=None):
     """Nms function with gpu implementation.
 
+    Boxes on the CPU are handled by the CPU implementation, which keeps the
+    same boxes as the CUDA one.
+
     Args:
         boxes (torch.Tensor): Input boxes with the shape of [N, 5]
             ([x1, y1, x2, y2, ry]).
@@ -43,8 +52,11 @@ def nms_gpu(boxes, scores, thresh, pre_maxsize=None, post_max_size=None):
     boxes = boxes[order].contiguous()
 
     keep = torch.zeros(boxes.size(0), dtype=torch.long)
-    num_out = iou3d_cuda.nms_gpu(boxes, keep, thresh, boxes.device.index)
-    keep = order[keep[:num_out].cuda(boxes.device)].contiguous()
+    if boxes.is_cuda:
+        num_out = iou3d_cuda.nms_gpu(boxes, keep, thresh, boxes.device.index)
+    else:
+        num_out = iou3d_cuda.nms_cpu(boxes, keep, thresh)
+    keep = order[keep[:num_out].to(boxes.device)].contiguous()
     if post_max_size is not None:
         keep = keep[:post_max_size]
     return keep
@@ -53,6 +65,8 @@ def nms_gpu(boxes, scores, thresh, pre_maxsize=None, post_max_size=None):
 def nms_normal_gpu(boxes, scores, thresh):
     """Normal non maximum suppression on GPU.
 
+    Boxes on the CPU are handled by the CPU implementation.
+
     Args:
         boxes (torch.Tensor): Input boxes with shape (N, 5).
         scores (torch.Tensor): Scores of predicted boxes with shape (N).
@@ -66,6 +80,9 @@ def nms_normal_gpu(boxes, scores, thresh):
     boxes = boxes[order].contiguous()
 
     keep = torch.zeros(boxes.size(0), dtype=torch.long)
-    num_out = iou3d_cuda.nms_normal_gpu(boxes, keep, thresh,
-                                        boxes.device.index)
-    return order[keep[:num_out].cuda(boxes.device)].contiguous()
+    if boxes.is_cuda:
+        num_out = iou3d_cuda.nms_normal_gpu(boxes, keep, thresh,
+                                            boxes.device.index)
+    else:
+        num_out = iou3d_cuda.nms_normal_cpu(boxes, keep, thresh)
+    return order[keep[:num_out].to(boxes.device)].contiguous()
@@ -7,13 +7,23 @@ Written by Shaoshuai Shi
 All Rights Reserved 2019-2020.
 */
 
-#include <cuda.h>
-#include <cuda_runtime_api.h>
 #include <torch/extension.h>
 #include <torch/serialize/tensor.h>
 
 #include <vector>
 
+int boxes_overlap_bev_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                          at::Tensor ans_overlap);
+int boxes_iou_bev_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                      at::Tensor ans_iou);
+int nms_cpu(at::Tensor boxes, at::Tensor keep, float nms_overlap_thresh);
+int nms_normal_cpu(at::Tensor boxes, at::Tensor keep,
+                   float nms_overlap_thresh);
+
+#ifdef WITH_CUDA
+#include <cuda.h>
+#include <cuda_runtime_api.h>
+
 #define CHECK_CUDA(x) \
   TORCH_CHECK(x.device().is_cuda(), #x, " must be a CUDAtensor ")
 #define CHECK_CONTIGUOUS(x) \
@@ -200,10 +210,19 @@ int nms_normal_gpu(at::Tensor boxes, at::Tensor keep,
   return num_to_keep;
 }
 
+#endif
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+#ifdef WITH_CUDA
   m.def("boxes_overlap_bev_gpu", &boxes_overlap_bev_gpu,
         "oriented boxes overlap");
   m.def("boxes_iou_bev_gpu", &boxes_iou_bev_gpu, "oriented boxes iou");
   m.def("nms_gpu", &nms_gpu, "oriented nms gpu");
   m.def("nms_normal_gpu", &nms_normal_gpu, "nms gpu");
+#endif
+  m.def("boxes_overlap_bev_cpu", &boxes_overlap_bev_cpu,
+        "oriented boxes overlap cpu");
+  m.def("boxes_iou_bev_cpu", &boxes_iou_bev_cpu, "oriented boxes iou cpu");
+  m.def("nms_cpu", &nms_cpu, "oriented nms cpu");
+  m.def("nms_normal_cpu", &nms_normal_cpu, "nms cpu");
 }
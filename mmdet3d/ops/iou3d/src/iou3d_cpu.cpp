@@ -0,0 +1,311 @@
+// CPU counterpart of iou3d_kernel.cu, the box geometry is kept identical so
+// that both backends return the same overlaps and the same kept indices.
+
+#include <ATen/Parallel.h>
+#include <math.h>
+#include <torch/extension.h>
+#include <torch/serialize/tensor.h>
+
+#include <vector>
+
+#define CHECK_CPU(x) \
+  TORCH_CHECK(!x.device().is_cuda(), #x, " must be a CPU tensor ")
+#define CHECK_CONTIGUOUS(x) \
+  TORCH_CHECK(x.is_contiguous(), #x, " must be contiguous ")
+#define CHECK_INPUT(x) \
+  CHECK_CPU(x);        \
+  CHECK_CONTIGUOUS(x)
+
+namespace {
+
+const float EPS = 1e-8;
+
+struct Point {
+  float x, y;
+  Point() {}
+  Point(double _x, double _y) { x = _x, y = _y; }
+
+  void set(float _x, float _y) {
+    x = _x;
+    y = _y;
+  }
+
+  Point operator+(const Point &b) const { return Point(x + b.x, y + b.y); }
+
+  Point operator-(const Point &b) const { return Point(x - b.x, y - b.y); }
+};
+
+inline float cross(const Point &a, const Point &b) {
+  return a.x * b.y - a.y * b.x;
+}
+
+inline float cross(const Point &p1, const Point &p2, const Point &p0) {
+  return (p1.x - p0.x) * (p2.y - p0.y) - (p2.x - p0.x) * (p1.y - p0.y);
+}
+
+inline int check_rect_cross(const Point &p1, const Point &p2, const Point &q1,
+                            const Point &q2) {
+  int ret = std::min(p1.x, p2.x) <= std::max(q1.x, q2.x) &&
+            std::min(q1.x, q2.x) <= std::max(p1.x, p2.x) &&
+            std::min(p1.y, p2.y) <= std::max(q1.y, q2.y) &&
+            std::min(q1.y, q2.y) <= std::max(p1.y, p2.y);
+  return ret;
+}
+
+inline int check_in_box2d(const float *box, const Point &p) {
+  // params: box (5) [x1, y1, x2, y2, angle]
+  const float MARGIN = 1e-5;
+
+  float center_x = (box[0] + box[2]) / 2;
+  float center_y = (box[1] + box[3]) / 2;
+  // rotate the point in the opposite direction of box
+  float angle_cos = cos(-box[4]), angle_sin = sin(-box[4]);
+  float rot_x =
+      (p.x - center_x) * angle_cos + (p.y - center_y) * angle_sin + center_x;
+  float rot_y =
+      -(p.x - center_x) * angle_sin + (p.y - center_y) * angle_cos + center_y;
+  return (rot_x > box[0] - MARGIN && rot_x < box[2] + MARGIN &&
+          rot_y > box[1] - MARGIN && rot_y < box[3] + MARGIN);
+}
+
+inline int intersection(const Point &p1, const Point &p0, const Point &q1,
+                        const Point &q0, Point &ans) {
+  // fast exclusion
+  if (check_rect_cross(p0, p1, q0, q1) == 0) return 0;
+
+  // check cross standing
+  float s1 = cross(q0, p1, p0);
+  float s2 = cross(p1, q1, p0);
+  float s3 = cross(p0, q1, q0);
+  float s4 = cross(q1, p1, q0);
+
+  if (!(s1 * s2 > 0 && s3 * s4 > 0)) return 0;
+
+  // calculate intersection of two lines
+  float s5 = cross(q1, p1, p0);
+  if (fabs(s5 - s1) > EPS) {
+    ans.x = (s5 * q0.x - s1 * q1.x) / (s5 - s1);
+    ans.y = (s5 * q0.y - s1 * q1.y) / (s5 - s1);
+
+  } else {
+    float a0 = p0.y - p1.y, b0 = p1.x - p0.x, c0 = p0.x * p1.y - p1.x * p0.y;
+    float a1 = q0.y - q1.y, b1 = q1.x - q0.x, c1 = q0.x * q1.y - q1.x * q0.y;
+    float D = a0 * b1 - a1 * b0;
+
+    ans.x = (b0 * c1 - b1 * c0) / D;
+    ans.y = (a1 * c0 - a0 * c1) / D;
+  }
+
+  return 1;
+}
+
+inline void rotate_around_center(const Point &center, const float angle_cos,
+                                 const float angle_sin, Point &p) {
+  float new_x =
+      (p.x - center.x) * angle_cos + (p.y - center.y) * angle_sin + center.x;
+  float new_y =
+      -(p.x - center.x) * angle_sin + (p.y - center.y) * angle_cos + center.y;
+  p.set(new_x, new_y);
+}
+
+inline int point_cmp(const Point &a, const Point &b, const Point &center) {
+  return atan2(a.y - center.y, a.x - center.x) >
+         atan2(b.y - center.y, b.x - center.x);
+}
+
+float box_overlap(const float *box_a, const float *box_b) {
+  // params: box_a (5) [x1, y1, x2, y2, angle]
+  // params: box_b (5) [x1, y1, x2, y2, angle]
+
+  float a_x1 = box_a[0], a_y1 = box_a[1], a_x2 = box_a[2], a_y2 = box_a[3],
+        a_angle = box_a[4];
+  float b_x1 = box_b[0], b_y1 = box_b[1], b_x2 = box_b[2], b_y2 = box_b[3],
+        b_angle = box_b[4];
+
+  Point center_a((a_x1 + a_x2) / 2, (a_y1 + a_y2) / 2);
+  Point center_b((b_x1 + b_x2) / 2, (b_y1 + b_y2) / 2);
+
+  Point box_a_corners[5];
+  box_a_corners[0].set(a_x1, a_y1);
+  box_a_corners[1].set(a_x2, a_y1);
+  box_a_corners[2].set(a_x2, a_y2);
+  box_a_corners[3].set(a_x1, a_y2);
+
+  Point box_b_corners[5];
+  box_b_corners[0].set(b_x1, b_y1);
+  box_b_corners[1].set(b_x2, b_y1);
+  box_b_corners[2].set(b_x2, b_y2);
+  box_b_corners[3].set(b_x1, b_y2);
+
+  // get oriented corners
+  float a_angle_cos = cos(a_angle), a_angle_sin = sin(a_angle);
+  float b_angle_cos = cos(b_angle), b_angle_sin = sin(b_angle);
+
+  for (int k = 0; k < 4; k++) {
+    rotate_around_center(center_a, a_angle_cos, a_angle_sin, box_a_corners[k]);
+    rotate_around_center(center_b, b_angle_cos, b_angle_sin, box_b_corners[k]);
+  }
+
+  box_a_corners[4] = box_a_corners[0];
+  box_b_corners[4] = box_b_corners[0];
+
+  // get intersection of lines
+  Point cross_points[16];
+  Point poly_center;
+  int cnt = 0, flag = 0;
+
+  poly_center.set(0, 0);
+  for (int i = 0; i < 4; i++) {
+    for (int j = 0; j < 4; j++) {
+      flag = intersection(box_a_corners[i + 1], box_a_corners[i],
+                          box_b_corners[j + 1], box_b_corners[j],
+                          cross_points[cnt]);
+      if (flag) {
+        poly_center = poly_center + cross_points[cnt];
+        cnt++;
+      }
+    }
+  }
+
+  // check corners
+  for (int k = 0; k < 4; k++) {
+    if (check_in_box2d(box_a, box_b_corners[k])) {
+      poly_center = poly_center + box_b_corners[k];
+      cross_points[cnt] = box_b_corners[k];
+      cnt++;
+    }
+    if (check_in_box2d(box_b, box_a_corners[k])) {
+      poly_center = poly_center + box_a_corners[k];
+      cross_points[cnt] = box_a_corners[k];
+      cnt++;
+    }
+  }
+  if (cnt < 3) return 0;
+
+  poly_center.x /= cnt;
+  poly_center.y /= cnt;
+
+  // sort the points of polygon
+  Point temp;
+  for (int j = 0; j < cnt - 1; j++) {
+    for (int i = 0; i < cnt - j - 1; i++) {
+      if (point_cmp(cross_points[i], cross_points[i + 1], poly_center)) {
+        temp = cross_points[i];
+        cross_points[i] = cross_points[i + 1];
+        cross_points[i + 1] = temp;
+      }
+    }
+  }
+
+  // get the overlap areas
+  float area = 0;
+  for (int k = 0; k < cnt - 1; k++) {
+    area += cross(cross_points[k] - cross_points[0],
+                  cross_points[k + 1] - cross_points[0]);
+  }
+
+  return fabs(area) / 2.0;
+}
+
+inline float iou_bev(const float *box_a, const float *box_b) {
+  // params: box_a (5) [x1, y1, x2, y2, angle]
+  // params: box_b (5) [x1, y1, x2, y2, angle]
+  float sa = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1]);
+  float sb = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1]);
+  float s_overlap = box_overlap(box_a, box_b);
+  return s_overlap / fmaxf(sa + sb - s_overlap, EPS);
+}
+
+inline float iou_normal(float const *const a, float const *const b) {
+  float left = fmaxf(a[0], b[0]), right = fminf(a[2], b[2]);
+  float top = fmaxf(a[1], b[1]), bottom = fminf(a[3], b[3]);
+  float width = fmaxf(right - left, 0.f), height = fmaxf(bottom - top, 0.f);
+  float interS = width * height;
+  float Sa = (a[2] - a[0]) * (a[3] - a[1]);
+  float Sb = (b[2] - b[0]) * (b[3] - b[1]);
+  return interS / fmaxf(Sa + Sb - interS, EPS);
+}
+
+template <float (*box_func)(const float *, const float *)>
+void boxes_pairwise_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                        at::Tensor ans) {
+  CHECK_INPUT(boxes_a);
+  CHECK_INPUT(boxes_b);
+  CHECK_INPUT(ans);
+
+  const int num_a = boxes_a.size(0);
+  const int num_b = boxes_b.size(0);
+  const float *boxes_a_data = boxes_a.data_ptr<float>();
+  const float *boxes_b_data = boxes_b.data_ptr<float>();
+  float *ans_data = ans.data_ptr<float>();
+
+  // each row of the answer is written by a single thread
+  at::parallel_for(0, num_a, 1, [&](int64_t begin, int64_t end) {
+    for (int64_t i = begin; i < end; i++) {
+      for (int j = 0; j < num_b; j++) {
+        ans_data[i * num_b + j] =
+            box_func(boxes_a_data + i * 5, boxes_b_data + j * 5);
+      }
+    }
+  });
+}
+
+template <float (*iou_func)(const float *, const float *)>
+int nms_cpu_impl(at::Tensor boxes, at::Tensor keep, float nms_overlap_thresh) {
+  // params boxes: (N, 5) [x1, y1, x2, y2, ry], sorted by descending score
+  // params keep: (N)
+  CHECK_INPUT(boxes);
+  CHECK_CONTIGUOUS(keep);
+
+  const int boxes_num = boxes.size(0);
+  const float *boxes_data = boxes.data_ptr<float>();
+  long *keep_data = keep.data_ptr<long>();
+
+  // greedy suppression, the overlaps of a kept box with the remaining ones
+  // are independent of each other and computed in parallel
+  std::vector<char> removed(boxes_num, 0);
+  int num_to_keep = 0;
+  for (int i = 0; i < boxes_num; i++) {
+    if (removed[i]) continue;
+    keep_data[num_to_keep++] = i;
+    const float *cur_box = boxes_data + i * 5;
+    at::parallel_for(i + 1, boxes_num, 64, [&](int64_t begin, int64_t end) {
+      for (int64_t j = begin; j < end; j++) {
+        if (!removed[j] &&
+            iou_func(cur_box, boxes_data + j * 5) > nms_overlap_thresh) {
+          removed[j] = 1;
+        }
+      }
+    });
+  }
+  return num_to_keep;
+}
+
+}  // namespace
+
+int boxes_overlap_bev_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                          at::Tensor ans_overlap) {
+  // params boxes_a: (N, 5) [x1, y1, x2, y2, ry]
+  // params boxes_b: (M, 5)
+  // params ans_overlap: (N, M)
+  boxes_pairwise_cpu<box_overlap>(boxes_a, boxes_b, ans_overlap);
+  return 1;
+}
+
+int boxes_iou_bev_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                      at::Tensor ans_iou) {
+  // params boxes_a: (N, 5) [x1, y1, x2, y2, ry]
+  // params boxes_b: (M, 5)
+  // params ans_iou: (N, M)
+  boxes_pairwise_cpu<iou_bev>(boxes_a, boxes_b, ans_iou);
+  return 1;
+}
+
+int nms_cpu(at::Tensor boxes, at::Tensor keep, float nms_overlap_thresh) {
+  return nms_cpu_impl<iou_bev>(boxes, keep, nms_overlap_thresh);
+}
+
+int nms_normal_cpu(at::Tensor boxes, at::Tensor keep,
+                   float nms_overlap_thresh) {
+  return nms_cpu_impl<iou_normal>(boxes, keep, nms_overlap_thresh);
+}
@@ -1,4 +1,7 @@
 from .scatter_points import DynamicScatter, dynamic_scatter
-from .voxelize import Voxelization, voxelization
+from .voxelize import Voxelization, batched_voxelization, voxelization
 
-__all__ = ['Voxelization', 'voxelization', 'dynamic_scatter', 'DynamicScatter']
+__all__ = [
+    'Voxelization', 'voxelization', 'batched_voxelization', 'dynamic_scatter',
+    'DynamicScatter'
+]
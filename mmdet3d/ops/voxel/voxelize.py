@@ -61,6 +61,104 @@ class _Voxelization(Function):
 voxelization = _Voxelization.apply
 
 
+def batched_voxelization(points,
+                         batch_offsets,
+                         voxel_size,
+                         coors_range,
+                         max_points=35,
+                         max_voxels=20000):
+    """Hard voxelization of several samples in a single pass.
+
+    The points of all samples are voxelized by one ``dynamic_voxelize`` call
+    and grouped into voxels with a sort, so the cost does not depend on the
+    number of samples. Each sample gives the same voxels, in the same order,
+    as calling :func:`voxelization` on it alone.
+
+    Args:
+        points: [N, ndim] float tensor. points of all samples concatenated.
+        batch_offsets: [B + 1] int tensor. points of sample i are
+            points[batch_offsets[i]:batch_offsets[i + 1]].
+        voxel_size: [3] list/tuple or array, float. xyz, indicate voxel
+            size
+        coors_range: [6] list/tuple or array, float. indicate voxel
+            range. format: xyzxyz, minmax
+        max_points: int. indicate maximum points contained in a voxel.
+        max_voxels: int. indicate maximum voxels created for each sample.
+
+    Returns:
+        voxels: [M, max_points, ndim] float tensor.
+        coordinates: [M, 4] int32 tensor, (batch_idx, z, y, x).
+        num_points_per_voxel: [M] int32 tensor.
+    """
+    num_points = points.size(0)
+    batch_offsets = batch_offsets.to(points.device).long()
+    batch_size = batch_offsets.numel() - 1
+    batch_ids = torch.repeat_interleave(
+        torch.arange(batch_size, device=points.device),
+        batch_offsets[1:] - batch_offsets[:-1])
+
+    coors = points.new_zeros(size=(num_points, 3), dtype=torch.int)
+    dynamic_voxelize(points, coors, voxel_size, coors_range, 3)
+    point_ids = torch.nonzero(coors[:, 0] != -1, as_tuple=False)[:, 0]
+    coors = coors[point_ids].long()
+    batch_ids = batch_ids[point_ids]
+
+    # group the points by voxel, keeping the input order inside each voxel
+    grid_size = coors.new_tensor([
+        round((coors_range[i + 3] - coors_range[i]) / voxel_size[i])
+        for i in (2, 1, 0)
+    ])
+    keys = ((batch_ids * grid_size[0] + coors[:, 0]) * grid_size[1] +
+            coors[:, 1]) * grid_size[2] + coors[:, 2]
+    order = torch.argsort(keys * num_points + point_ids)
+    keys, point_ids = keys[order], point_ids[order]
+    coors, batch_ids = coors[order], batch_ids[order]
+
+    is_first = torch.ones_like(keys, dtype=torch.bool)
+    is_first[1:] = keys[1:] != keys[:-1]
+    voxel_ids = torch.cumsum(is_first.long(), dim=0) - 1
+    starts = torch.nonzero(is_first, as_tuple=False)[:, 0]
+    point_ranks = torch.arange(
+        keys.numel(), device=keys.device) - starts[voxel_ids]
+
+    # voxels are created in the order of their first point, the kernels
+    # stop at the first point that would open voxel number max_voxels
+    first_point_ids = point_ids[starts]
+    voxel_order = torch.argsort(first_point_ids)
+    voxel_batch_ids = batch_ids[starts][voxel_order]
+    num_voxels = torch.bincount(voxel_batch_ids, minlength=batch_size)
+    voxel_offsets = torch.cumsum(num_voxels, dim=0) - num_voxels
+    voxel_ranks = torch.arange(
+        voxel_order.numel(), device=keys.device) - voxel_offsets[
+            voxel_batch_ids]
+    cutoffs = batch_offsets[1:].clone()
+    overflow = voxel_ranks == max_voxels
+    cutoffs[voxel_batch_ids[overflow]] = first_point_ids[
+        voxel_order[overflow]]
+
+    new_voxel_ids = torch.empty_like(voxel_order)
+    new_voxel_ids[voxel_order] = torch.arange(
+        voxel_order.numel(), device=keys.device)
+    voxel_ids = new_voxel_ids[voxel_ids]
+    keep = (point_ranks < max_points) & (point_ids < cutoffs[batch_ids])
+    voxel_keep = voxel_ranks < max_voxels
+    num_kept_voxels = int(voxel_keep.sum())
+    # kept voxels stay contiguous per sample, compact their indices
+    voxel_index = torch.cumsum(voxel_keep.long(), dim=0) - 1
+
+    voxels = points.new_zeros(
+        size=(num_kept_voxels, max_points, points.size(1)))
+    kept_voxel_ids = voxel_index[voxel_ids[keep]]
+    voxels[kept_voxel_ids, point_ranks[keep]] = points[point_ids[keep]]
+    num_points_per_voxel = torch.bincount(
+        kept_voxel_ids, minlength=num_kept_voxels).int()
+
+    voxel_coors = coors.new_zeros(size=(num_kept_voxels, 4))
+    voxel_coors[kept_voxel_ids, 0] = batch_ids[keep]
+    voxel_coors[kept_voxel_ids, 1:] = coors[keep]
+    return voxels, voxel_coors.int(), num_points_per_voxel
+
+
 class Voxelization(nn.Module):
 
     def __init__(self,
@@ -112,6 +210,21 @@ class Voxelization(nn.Module):
         return voxelization(input, self.voxel_size, self.point_cloud_range,
                             self.max_num_points, max_voxels)
 
+    def forward_batched(self, points, batch_offsets):
+        """
+        Args:
+            points: NC points of all samples concatenated
+            batch_offsets: B + 1 start offsets of the samples in points
+        """
+        if self.training:
+            max_voxels = self.max_voxels[0]
+        else:
+            max_voxels = self.max_voxels[1]
+
+        return batched_voxelization(points, batch_offsets, self.voxel_size,
+                                    self.point_cloud_range,
+                                    self.max_num_points, max_voxels)
+
     def __repr__(self):
         tmpstr = self.__class__.__name__ + '('
         tmpstr += 'voxel_size=' + str(self.voxel_size)
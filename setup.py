@@ -32,10 +32,17 @@ def make_cuda_ext(name,
                   sources,
                   sources_cuda=[],
                   extra_args=[],
-                  extra_include_path=[]):
+                  extra_include_path=[],
+                  openmp=False):
 
     define_macros = []
     extra_compile_args = {'cxx': [] + extra_args}
+    extra_link_args = []
+    if openmp:
+        # host kernels use at::parallel_for, which is only parallel when the
+        # extension is built with the same OpenMP backend as PyTorch
+        extra_compile_args['cxx'] += ['-fopenmp']
+        extra_link_args += ['-fopenmp']
 
     if torch.cuda.is_available() or os.getenv('FORCE_CUDA', '0') == '1':
         define_macros += [('WITH_CUDA', None)]
@@ -56,7 +63,8 @@ def make_cuda_ext(name,
         sources=[os.path.join(*module.split('.'), p) for p in sources],
         include_dirs=extra_include_path,
         define_macros=define_macros,
-        extra_compile_args=extra_compile_args)
+        extra_compile_args=extra_compile_args,
+        extra_link_args=extra_link_args)
 
 
 def parse_requirements(fname='requirements.txt', with_version=True):
@@ -193,8 +201,10 @@ if __name__ == '__main__':
                 module='mmdet3d.ops.iou3d',
                 sources=[
                     'src/iou3d.cpp',
-                    'src/iou3d_kernel.cu',
-                ]),
+                    'src/iou3d_cpu.cpp',
+                ],
+                sources_cuda=['src/iou3d_kernel.cu'],
+                openmp=True),
             make_cuda_ext(
                 name='voxel_layer',
                 module='mmdet3d.ops.voxel',
@@ -76,3 +76,48 @@ def test_getitem():
     assert data['img_metas'].data['flip'] is False
     assert data['img_metas'].data['pcd_horizontal_flip'] is False
     assert data['points']._data.shape == (901, 5)
+
+
+class _ToyDataset(object):
+    CLASSES = ('car', 'truck', 'pedestrian')
+
+    def __init__(self, ann_file):
+        self.ann_file = ann_file
+        self.cat_ids = [[0], [0, 1], [2], [0, 2], [], [0]]
+        self.flag = np.zeros(len(self.cat_ids), dtype=np.uint8)
+
+    def get_cat_ids(self, idx):
+        return self.cat_ids[idx]
+
+    def __getitem__(self, idx):
+        return idx
+
+    def __len__(self):
+        return len(self.cat_ids)
+
+
+def test_cbgs_resample(tmp_path):
+    from mmdet3d.datasets.dataset_wrappers import CBGSDataset
+
+    ann_file = tmp_path / 'infos.pkl'
+    ann_file.write_bytes(b'infos')
+    cache_dir = str(tmp_path / 'cache')
+    dataset = CBGSDataset(
+        _ToyDataset(str(ann_file)), seed=0, cache_dir=cache_dir)
+    assert [inds.tolist() for inds in dataset.class_sample_idxs] == \
+        [[0, 1, 3, 5], [1], [2, 3]]
+    assert len(dataset.flag) == len(dataset)
+
+    # the same seed and epoch draw the same scenes, from the cache as well
+    cached = CBGSDataset(
+        _ToyDataset(str(ann_file)), seed=0, cache_dir=cache_dir)
+    assert np.array_equal(cached.sample_indices, dataset.sample_indices)
+    num_samples = len(dataset)
+    epoch_indices = []
+    for epoch in range(4):
+        dataset.set_epoch(epoch)
+        assert len(dataset) == num_samples
+        epoch_indices.append(dataset.sample_indices.copy())
+    assert np.array_equal(epoch_indices[0], cached.sample_indices)
+    assert any(not np.array_equal(epoch_indices[0], indices)
+               for indices in epoch_indices[1:])
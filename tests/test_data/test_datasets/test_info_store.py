@@ -0,0 +1,126 @@
+import mmcv
+import numpy as np
+from os import path as osp
+
+from mmdet3d.datasets import InfoStore, NuScenesDataset
+from mmdet3d.datasets.info_store import pack_infos
+
+
+def _get_infos(num_infos):
+    rng = np.random.RandomState(0)
+    names = np.array(NuScenesDataset.CLASSES + ('animal', ))
+    infos = []
+    # empty boxes, views and sweeps included
+    for i, (num_boxes, num_views, num_sweeps) in enumerate(
+            zip([3, 0, 5, 1, 0], [4, 2, 0, 3, 0], [2, 0, 1, 3, 0])):
+        info = dict(
+            token='token_%d' % i,
+            lidar_path='samples/LIDAR_TOP/%d.bin' % i,
+            timestamp=int(rng.randint(0, 10**6)),
+            cams={
+                cam: dict(
+                    data_path='samples/%s/%d.jpg' % (cam, i),
+                    cam_intrinsic=rng.rand(3, 3),
+                    sensor2lidar_rotation=rng.rand(3, 3),
+                    sensor2lidar_translation=rng.rand(3))
+                for cam in ['CAM_FRONT', 'CAM_BACK']
+            },
+            sweeps=[
+                dict(
+                    data_path='sweeps/LIDAR_TOP/%d_%d.bin' % (i, j),
+                    timestamp=int(rng.randint(0, 10**6)),
+                    sensor2lidar_rotation=rng.rand(3, 3),
+                    sensor2lidar_translation=rng.rand(3))
+                for j in range(num_sweeps)
+            ],
+            gt_boxes=rng.rand(num_boxes, 7).astype(np.float32),
+            gt_names=names[rng.randint(0, len(names), num_boxes)],
+            gt_velocity=rng.rand(num_boxes, 2).astype(np.float32),
+            num_lidar_pts=rng.randint(0, 3, num_boxes),
+            valid_flag=rng.rand(num_boxes) > 0.3,
+            gt_bboxes2d_view=rng.rand(num_views, 4).astype(np.float32),
+            gt_names2d_view=names[rng.randint(0, len(names), num_views)],
+            gt_viewsIDs=rng.randint(0, 2, num_views),
+            gt_pts_centers_view=rng.rand(num_views, 3).astype(np.float32))
+        info['gt_velocity'][:1, 0] = np.nan
+        infos.append(info)
+    return infos[:num_infos]
+
+
+def _assert_equal(value, expected):
+    if isinstance(expected, dict):
+        assert set(value) == set(expected)
+        for key in expected:
+            _assert_equal(value[key], expected[key])
+    elif isinstance(expected, list):
+        assert len(value) == len(expected)
+        for item, expected_item in zip(value, expected):
+            _assert_equal(item, expected_item)
+    elif isinstance(expected, np.ndarray):
+        assert value.shape == expected.shape
+        assert np.array_equal(
+            value, expected, equal_nan=expected.dtype.kind == 'f')
+    else:
+        assert type(value) == type(expected)
+        assert value == expected
+
+
+def test_info_store(tmp_path):
+    infos = _get_infos(5)
+    data = dict(infos=infos, metadata=dict(version='v1.0-trainval'))
+    store_dir = osp.join(str(tmp_path), 'store')
+    pack_infos(data, store_dir, classes=NuScenesDataset.CLASSES)
+
+    store = InfoStore(store_dir)
+    assert len(store) == len(infos)
+    assert store.metadata == data['metadata']
+    for i, info in enumerate(infos):
+        _assert_equal(store[i], info)
+    assert np.array_equal(
+        store.column('sweeps', 'offsets'), [0, 2, 2, 3, 6, 6])
+    assert np.array_equal(
+        store.label_map(NuScenesDataset.CLASSES),
+        list(range(len(NuScenesDataset.CLASSES))) + [-1])
+
+    indices = np.array([3, 0, 4])
+    subset = store.select(indices)
+    assert len(subset) == len(indices)
+    for i, idx in enumerate(indices):
+        _assert_equal(subset[i], infos[idx])
+        _assert_equal(subset.get_annos(i), store.get_annos(idx))
+    _assert_equal(subset.select([2, 0])[1], infos[3])
+
+
+def test_nuscenes_dataset_info_store(tmp_path):
+    data = dict(infos=_get_infos(5), metadata=dict(version='v1.0-trainval'))
+    ann_file = osp.join(str(tmp_path), 'infos.pkl')
+    mmcv.dump(data, ann_file)
+    store_dir = osp.join(str(tmp_path), 'store')
+    pack_infos(data, store_dir, classes=NuScenesDataset.CLASSES)
+
+    for load_interval in [1, 2]:
+        for use_valid_flag in [False, True]:
+            pkl_dataset = NuScenesDataset(
+                ann_file,
+                load_interval=load_interval,
+                use_valid_flag=use_valid_flag)
+            store_dataset = NuScenesDataset(
+                store_dir,
+                load_interval=load_interval,
+                use_valid_flag=use_valid_flag)
+            assert len(store_dataset) == len(pkl_dataset)
+            for i in range(len(pkl_dataset)):
+                _assert_equal(store_dataset.data_infos[i],
+                              pkl_dataset.data_infos[i])
+                ann_info = store_dataset.get_ann_info(i)
+                expected = pkl_dataset.get_ann_info(i)
+                assert ann_info['gt_bboxes_3d'].tensor.allclose(
+                    expected['gt_bboxes_3d'].tensor)
+                assert np.array_equal(ann_info['gt_labels_3d'],
+                                      expected['gt_labels_3d'])
+                assert np.array_equal(ann_info['gt_names'],
+                                      expected['gt_names'])
+                assert sorted(store_dataset.get_cat_ids(i)) == sorted(
+                    pkl_dataset.get_cat_ids(i))
+            assert np.array_equal(store_dataset.get_cat_masks(),
+                                  pkl_dataset.get_cat_masks())
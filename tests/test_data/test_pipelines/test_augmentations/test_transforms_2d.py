@@ -0,0 +1,93 @@
+import copy
+import numpy as np
+
+from mmdet3d.datasets.pipelines import FusedMultiViewImageTransform
+from mmdet3d.datasets.pipelines.loading import MyNormalize, MyPad, MyResize
+from mmdet3d.datasets.pipelines.transforms_2d import OurRandomAffine
+
+
+def _multi_view_results(num_views=6, height=180, width=320, num_boxes=20):
+    rng = np.random.RandomState(0)
+    ys, xs = np.mgrid[0:height, 0:width]
+    imgs = [
+        np.stack([xs * 0.7 + view_id * 5, ys * 1.3, (xs + ys) * 0.4],
+                 axis=-1).astype(np.uint8) for view_id in range(num_views)
+    ]
+    gt_bboxes = np.concatenate([
+        rng.uniform(0, width, (num_boxes, 1)),
+        rng.uniform(0, height, (num_boxes, 1)),
+        rng.uniform(5, 60, (num_boxes, 2))
+    ], axis=1).astype(np.float32)
+    gt_img_centers_view = np.concatenate(
+        [gt_bboxes[:, :2], rng.uniform(1, 50, (num_boxes, 1))],
+        axis=1).astype(np.float32)
+    return dict(
+        img=imgs,
+        img_fields=['img'],
+        bbox_fields=['gt_bboxes'],
+        gt_bboxes=gt_bboxes,
+        gt_labels=np.stack([
+            rng.randint(0, 10, num_boxes),
+            rng.randint(0, num_views, num_boxes)
+        ], axis=1),
+        gt_img_centers_view=gt_img_centers_view,
+        gt_pts_centers_view=rng.rand(num_boxes, 3),
+        gt_bboxes_lidar_view=rng.rand(num_boxes, 9),
+        lidar2img=[rng.rand(4, 4) for _ in range(num_views)],
+        lidar2cam_r=[rng.rand(3, 3) for _ in range(num_views)],
+        lidar2cam_t=[rng.rand(3) for _ in range(num_views)],
+        cam_intrinsic=[rng.rand(3, 3) for _ in range(num_views)])
+
+
+def test_fused_multi_view_image_transform():
+    affine = dict(scaling_ratio_range=(0.9, 1.1), flip_ratio=0.5)
+    resize = dict(img_scale=(200, 90), keep_ratio=True)
+    normalize = dict(
+        mean=[103.530, 116.280, 123.675],
+        std=[57.375, 57.120, 58.395],
+        to_rgb=False)
+    pad = dict(size_divisor=32)
+    results = _multi_view_results()
+
+    np.random.seed(0)
+    expected = copy.deepcopy(results)
+    for transform in [
+            OurRandomAffine(**affine),
+            MyResize(**resize),
+            MyNormalize(**normalize),
+            MyPad(**pad)
+    ]:
+        expected = transform(expected)
+    np.random.seed(0)
+    fused = FusedMultiViewImageTransform(
+        resize=resize, pad=pad, affine=affine, normalize=normalize)
+    results = fused(copy.deepcopy(results))
+
+    assert results['img_shape'] == expected['img_shape'] == (90, 160, 3)
+    assert results['pad_shape'] == expected['pad_shape'] == (96, 160, 3)
+    assert results['image_flip'] == expected['image_flip']
+    for key in [
+            'gt_bboxes', 'gt_labels', 'gt_img_centers_view', 'scale_factor',
+            'valid_shape', 'lidar2img', 'lidar2cam_r', 'lidar2cam_t',
+            'cam_intrinsic'
+    ]:
+        assert np.allclose(results[key], expected[key]), key
+
+    # one resampling instead of two, except at the image borders
+    imgs = np.stack(results['img'])
+    expected_imgs = np.stack(expected['img'])
+    assert imgs.dtype == np.float32
+    assert np.abs(imgs - expected_imgs)[:, 2:88, 2:158].mean() < 0.02
+    assert np.array_equal(imgs[:, 90:], expected_imgs[:, 90:])
+
+    # uint8 images are left to be normalized by the detector
+    np.random.seed(0)
+    fused = FusedMultiViewImageTransform(
+        resize=resize,
+        pad=pad,
+        affine=affine,
+        normalize=dict(normalize, on_device=True))
+    results = fused(_multi_view_results())
+    assert results['img'][0].dtype == np.uint8
+    assert results['img_norm_cfg']['on_device']
+    assert np.allclose(results['gt_bboxes'], expected['gt_bboxes'])
@@ -1,3 +1,4 @@
+import copy
 import mmcv
 import numpy as np
 import pytest
@@ -6,8 +7,11 @@ import torch
 from mmdet3d.core import Box3DMode, CameraInstance3DBoxes, LiDARInstance3DBoxes
 from mmdet3d.core.points import LiDARPoints
 from mmdet3d.datasets import (BackgroundPointsFilter, ObjectNoise,
-                              ObjectSample, RandomFlip3D,
+                              ObjectSample, PointsRangeFilter, RandomFlip3D,
                               VoxelBasedPointSampler)
+from mmdet3d.datasets.pipelines import (ApplyPointsTransform, DataBaseSampler,
+                                        OurGlobalRotScaleTrans,
+                                        OurRandomFlip3D)
 
 
 def test_remove_points_in_boxes():
@@ -103,6 +107,68 @@ def test_object_sample():
     assert np.all(gt_labels_3d == [0])
 
 
+def test_packed_database_sampler():
+    import tempfile
+    from os import path as osp
+
+    rng = np.random.RandomState(0)
+    db_infos = dict(Car=[], Pedestrian=[])
+    packed_db_infos = dict(Car=[], Pedestrian=[])
+    tmp_dir = tempfile.TemporaryDirectory()
+    points_offset = 0
+    with open(osp.join(tmp_dir.name, 'gt_database.bin'), 'wb') as f:
+        for i in range(20):
+            name = 'Car' if i % 2 else 'Pedestrian'
+            gt_points = rng.randn(rng.randint(1, 30), 4).astype(np.float32)
+            gt_points.tofile(f)
+            gt_points.tofile(osp.join(tmp_dir.name, f'{i}.bin'))
+            box3d_lidar = np.concatenate([
+                rng.uniform(-20, 20, 2),
+                rng.uniform(-2, 0, 1),
+                rng.uniform(1, 4, 3),
+                rng.uniform(-3, 3, 1)
+            ]).astype(np.float32)
+            db_info = dict(
+                name=name,
+                path=f'{i}.bin',
+                box3d_lidar=box3d_lidar,
+                num_points_in_gt=gt_points.shape[0],
+                difficulty=0)
+            db_infos[name].append(db_info)
+            packed_db_infos[name].append(
+                dict(
+                    db_info,
+                    path='gt_database.bin',
+                    points_offset=points_offset))
+            points_offset += gt_points.shape[0]
+    mmcv.dump(db_infos, osp.join(tmp_dir.name, 'dbinfos.pkl'))
+    mmcv.dump(packed_db_infos, osp.join(tmp_dir.name, 'packed_dbinfos.pkl'))
+
+    gt_bboxes = np.array([[0, 0, -1, 2, 4, 1.5, 0]], dtype=np.float32)
+    gt_labels = np.array([0])
+    results = []
+    for info_path in ['dbinfos.pkl', 'packed_dbinfos.pkl']:
+        np.random.seed(0)
+        db_sampler = DataBaseSampler(
+            info_path=osp.join(tmp_dir.name, info_path),
+            data_root=tmp_dir.name,
+            rate=1.0,
+            prepare=dict(),
+            sample_groups=dict(Car=6, Pedestrian=6),
+            classes=['Car', 'Pedestrian'])
+        results.append(db_sampler.sample_all(gt_bboxes, gt_labels))
+    tmp_dir.cleanup()
+
+    sampled, packed_sampled = results
+    assert len(sampled['gt_labels_3d']) > 0
+    assert np.array_equal(sampled['gt_labels_3d'],
+                          packed_sampled['gt_labels_3d'])
+    assert np.array_equal(sampled['gt_bboxes_3d'],
+                          packed_sampled['gt_bboxes_3d'])
+    assert torch.equal(sampled['points'].tensor,
+                       packed_sampled['points'].tensor)
+
+
 def test_object_noise():
     np.random.seed(0)
     object_noise = ObjectNoise()
@@ -196,6 +262,77 @@ def test_random_flip_3d():
     assert repr_str == expected_repr_str
 
 
+def test_apply_points_transform():
+    rng = np.random.RandomState(0)
+    points = np.concatenate([
+        rng.uniform(-60, 60, (1000, 2)),
+        rng.uniform(-6, 4, (1000, 1)),
+        rng.rand(1000, 2)
+    ], axis=1).astype(np.float32)
+    gt_bboxes_3d = np.concatenate([
+        rng.uniform(-40, 40, (5, 2)),
+        rng.uniform(-2, 0, (5, 1)),
+        rng.uniform(1, 4, (5, 3)),
+        rng.uniform(-3, 3, (5, 1))
+    ], axis=1)
+    input_dict = dict(
+        points=LiDARPoints(points, points_dim=5),
+        bbox3d_fields=['gt_bboxes_3d'],
+        box_type_3d=LiDARInstance3DBoxes,
+        gt_bboxes_3d=LiDARInstance3DBoxes(gt_bboxes_3d),
+        gt_pts_centers_view=rng.rand(8, 3),
+        lidar2cam_r=[np.linalg.qr(rng.randn(3, 3))[0] for _ in range(6)],
+        lidar2cam_t=[rng.randn(3) for _ in range(6)])
+    point_cloud_range = [-54, -54, -5, 54, 54, 3]
+    rot_scale_trans = dict(
+        rot_range=[-0.785, 0.785],
+        scale_ratio_range=[0.9, 1.1],
+        translation_std=[0.5, 0.5, 0.5])
+    flip = dict(
+        sync_2d=False,
+        flip_ratio_bev_horizontal=1.0,
+        flip_ratio_bev_vertical=1.0)
+
+    np.random.seed(0)
+    expected = copy.deepcopy(input_dict)
+    for transform in [
+            OurGlobalRotScaleTrans(**rot_scale_trans),
+            OurRandomFlip3D(**flip),
+            PointsRangeFilter(point_cloud_range)
+    ]:
+        expected = transform(expected)
+    np.random.seed(0)
+    results = copy.deepcopy(input_dict)
+    for transform in [
+            OurGlobalRotScaleTrans(defer=True, **rot_scale_trans),
+            OurRandomFlip3D(defer=True, **flip),
+            ApplyPointsTransform(point_cloud_range)
+    ]:
+        results = transform(results)
+
+    assert 'pcd_transform' not in results
+    assert torch.allclose(
+        results['points'].tensor, expected['points'].tensor, atol=1e-4)
+    assert torch.allclose(results['gt_bboxes_3d'].tensor,
+                          expected['gt_bboxes_3d'].tensor)
+    for key in ['gt_pts_centers_view', 'lidar2cam_r', 'lidar2cam_t']:
+        assert np.allclose(results[key], expected[key])
+
+    # filtering and shuffling gather the points once
+    apply_points_transform = ApplyPointsTransform(
+        point_cloud_range, shuffle=True)
+    shuffled = apply_points_transform(
+        dict(points=LiDARPoints(points, points_dim=5)))
+    filtered = PointsRangeFilter(point_cloud_range)(
+        dict(points=LiDARPoints(points, points_dim=5)))
+    assert torch.equal(shuffled['points'].tensor.sort(0)[0],
+                       filtered['points'].tensor.sort(0)[0])
+    repr_str = repr(apply_points_transform)
+    expected_repr_str = 'ApplyPointsTransform(point_cloud_range=' \
+                        '[-54.0, -54.0, -5.0, 54.0, 54.0, 3.0], shuffle=True)'
+    assert repr_str == expected_repr_str
+
+
 def test_background_points_filter():
     np.random.seed(0)
     background_points_filter = BackgroundPointsFilter((0.5, 2.0, 0.5))
@@ -0,0 +1,86 @@
+import cv2
+import numpy as np
+from os import path as osp
+
+from mmdet3d.datasets.pipelines import LoadMultiViewImageFromFiles
+
+
+def _write_views(tmp_path, num_views, height, width):
+    rng = np.random.RandomState(0)
+    filenames = []
+    for i in range(num_views):
+        img = cv2.resize(
+            rng.randint(0, 256, (height // 8, width // 8, 3)).astype(np.uint8),
+            (width, height))
+        filename = osp.join(str(tmp_path), '%d_%d_%d.jpg' % (height, width, i))
+        cv2.imwrite(filename, img)
+        filenames.append(filename)
+    return filenames
+
+
+def _get_results(filenames):
+    cam_intrinsic = np.array([[500., 0., 320.], [0., 500., 180.],
+                              [0., 0., 1.]])
+    return dict(
+        img_filename=filenames,
+        cam_intrinsic=[cam_intrinsic] * len(filenames),
+        bbox_fields=['gt_bboxes'],
+        gt_bboxes=np.array([[10., 20., 110., 220.]], dtype=np.float32),
+        gt_img_centers_view=np.array([[60., 120., 15.]], dtype=np.float32),
+        valid_shape=np.array([[640, 360]] * len(filenames)))
+
+
+def test_load_multi_view_image_from_files(tmp_path):
+    filenames = _write_views(tmp_path, 3, 360, 640)
+    full = LoadMultiViewImageFromFiles(
+        to_float32=True, img_scale=(368, 640), color_type='color')
+    full_results = full(_get_results(filenames))
+    assert full_results['img_shape'] == (368, 640, 3, 3)
+
+    # the views decoded on threads are the same
+    threaded = LoadMultiViewImageFromFiles(
+        to_float32=True,
+        img_scale=(368, 640),
+        color_type='color',
+        num_threads=2)
+    threaded_results = threaded(_get_results(filenames))
+    for img, threaded_img in zip(full_results['img'],
+                                 threaded_results['img']):
+        assert np.array_equal(img, threaded_img)
+
+    # the views are decoded at half size and padded to half the scale
+    reduced = LoadMultiViewImageFromFiles(
+        to_float32=True,
+        img_scale=(368, 640),
+        color_type='color',
+        num_threads=2,
+        decode_scale=(320, 180))
+    for _ in range(2):
+        results = reduced(_get_results(filenames))
+        assert results['img_shape'] == (184, 320, 3, 3)
+        for img, full_img in zip(results['img'], full_results['img']):
+            assert (img[180:] == 0).all()
+            assert np.abs(img[:180] - cv2.resize(
+                full_img[:360], (320, 180),
+                interpolation=cv2.INTER_AREA)).mean() < 4
+        assert np.allclose(results['cam_intrinsic'][0],
+                           [[250., 0., 160.], [0., 250., 90.], [0., 0., 1.]])
+        assert np.allclose(results['gt_bboxes'], [[5., 10., 55., 110.]])
+        assert np.allclose(results['gt_img_centers_view'], [[30., 60., 15.]])
+        assert np.allclose(results['valid_shape'], [[320, 180]] * 3)
+
+    # the reduction follows a change of the image size
+    filenames = _write_views(tmp_path, 3, 720, 1280)
+    reduced.img_scale = None
+    results = reduced(_get_results(filenames))
+    assert results['img_shape'] == (180, 320, 3, 3)
+    assert np.allclose(results['gt_bboxes'], [[2.5, 5., 27.5, 55.]])
+
+    # annotations are brought to the resolution of the images
+    results = _get_results(filenames)
+    reduced._rescale_annotations(results, 8)
+    assert np.allclose(results['cam_intrinsic'][1],
+                       [[62.5, 0., 40.], [0., 62.5, 22.5], [0., 0., 1.]])
+    assert np.allclose(results['gt_bboxes'], [[1.25, 2.5, 13.75, 27.5]])
+    assert np.allclose(results['gt_img_centers_view'], [[7.5, 15., 15.]])
+    assert np.allclose(results['valid_shape'], [[80, 45]] * 3)
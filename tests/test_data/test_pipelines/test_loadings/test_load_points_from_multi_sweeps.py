@@ -1,4 +1,6 @@
 import numpy as np
+import pickle
+from os import path as osp
 
 from mmdet3d.core.points import LiDARPoints
 from mmdet3d.datasets.pipelines.loading import LoadPointsFromMultiSweeps
@@ -66,3 +68,119 @@ def test_load_points_from_multi_sweeps():
     input_results = dict(points=points, sweeps=[sweep] * 10, timestamp=1.0)
     results = load_points_from_multi_sweeps_3(input_results)
     assert results['points'].tensor.numpy().shape == (3259, 5)
+
+
+def _load_sweeps_reference(points, sweeps, timestamp, remove_close):
+    """Load the sweeps one by one and concatenate them."""
+    points = points.tensor.numpy().copy()
+    points[:, 4] = 0
+    points_list = [points]
+    for sweep in sweeps:
+        points_sweep = np.fromfile(
+            sweep['data_path'], dtype=np.float32).reshape(-1, 5)
+        if remove_close:
+            close = (np.abs(points_sweep[:, 0]) < 1.0) & (
+                np.abs(points_sweep[:, 1]) < 1.0)
+            points_sweep = points_sweep[~close]
+        points_sweep[:, :3] = points_sweep[:, :3] @ sweep[
+            'sensor2lidar_rotation'].T
+        points_sweep[:, :3] += sweep['sensor2lidar_translation']
+        points_sweep[:, 4] = timestamp - sweep['timestamp'] / 1e6
+        points_list.append(points_sweep)
+    return np.concatenate(points_list)
+
+
+def test_load_points_from_multi_sweeps_cache(tmp_path):
+    rng = np.random.RandomState(0)
+    sweeps = []
+    # the last sweep file is empty
+    for i, num_points in enumerate([200, 150, 300, 250, 0]):
+        data_path = osp.join(str(tmp_path), f'{i}.bin')
+        (rng.rand(num_points, 5) * 4 - 2).astype(np.float32).tofile(data_path)
+        rotation, _ = np.linalg.qr(rng.randn(3, 3))
+        sweeps.append(
+            dict(
+                data_path=data_path,
+                sensor2lidar_rotation=rotation,
+                sensor2lidar_translation=rng.randn(3),
+                timestamp=i * 50000))
+    points = rng.rand(100, 5).astype(np.float32) * 2
+
+    def load(transform, sweeps):
+        results = dict(
+            points=LiDARPoints(points.copy(), points_dim=5),
+            sweeps=sweeps,
+            timestamp=1.0)
+        return transform(results)['points'].tensor.numpy()
+
+    for remove_close in [False, True]:
+        uncached = LoadPointsFromMultiSweeps(
+            sweeps_num=10,
+            use_dim=[0, 1, 2, 3, 4],
+            remove_close=remove_close,
+            test_mode=True,
+            cache_size=0,
+            mmap=False)
+        cached = LoadPointsFromMultiSweeps(
+            sweeps_num=10,
+            use_dim=[0, 1, 2, 3, 4],
+            remove_close=remove_close,
+            test_mode=True,
+            cache_size=1 << 20)
+        assert cached.mmap
+        expected = _load_sweeps_reference(
+            LiDARPoints(points.copy(), points_dim=5), sweeps, 1.0,
+            remove_close)
+        assert np.array_equal(load(uncached, sweeps), expected)
+        assert np.array_equal(load(cached, sweeps), expected)
+        assert len(cached._cache) == len(sweeps)
+
+        # a repeat call reads nothing
+        load_points = cached._load_points
+        num_reads = []
+
+        def counting_load_points(pts_filename):
+            num_reads.append(pts_filename)
+            return load_points(pts_filename)
+
+        cached._load_points = counting_load_points
+        assert np.array_equal(load(cached, sweeps), expected)
+        assert num_reads == []
+        cached.__dict__.pop('_load_points')
+
+    # least recently used sweeps are evicted beyond the size of the cache
+    sweep_bytes = 200 * 5 * 4
+    transform = LoadPointsFromMultiSweeps(
+        sweeps_num=10,
+        use_dim=[0, 1, 2, 3, 4],
+        test_mode=True,
+        cache_size=2 * sweep_bytes)
+    for i in range(len(sweeps)):
+        load(transform, sweeps[i:i + 1])
+        assert transform._cache_bytes <= transform.cache_size
+        assert transform._cache_bytes == sum(
+            value.nbytes for value in transform._cache.values())
+    assert list(transform._cache) == [
+        sweeps[3]['data_path'], sweeps[4]['data_path']
+    ]
+    load(transform, sweeps[3:4])
+    load(transform, sweeps[1:2])
+    assert list(transform._cache) == [
+        sweeps[4]['data_path'], sweeps[3]['data_path'], sweeps[1]['data_path']
+    ]
+    load(transform, sweeps[:1])
+    assert list(transform._cache) == [
+        sweeps[1]['data_path'], sweeps[0]['data_path']
+    ]
+    assert np.array_equal(
+        load(transform, sweeps),
+        _load_sweeps_reference(
+            LiDARPoints(points.copy(), points_dim=5), sweeps, 1.0, False))
+
+    # dataloader workers start from an empty cache
+    assert transform.__getstate__()['_cache'] == dict()
+    assert transform.__getstate__()['_cache_bytes'] == 0
+    assert len(transform._cache) > 0
+    worker_transform = pickle.loads(pickle.dumps(transform))
+    assert len(worker_transform._cache) == 0
+    assert worker_transform._cache_bytes == 0
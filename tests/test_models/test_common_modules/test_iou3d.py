@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+import torch
+
+from mmdet3d.core.bbox import xywhr2xyxyr
+from mmdet3d.ops.iou3d import boxes_iou_bev, nms_gpu, nms_normal_gpu
+
+
+def _random_bev_boxes(num_boxes, seed=0):
+    # boxes in XYWHR format
+    rng = np.random.RandomState(seed)
+    boxes = np.concatenate([
+        rng.uniform(0, 10, (num_boxes, 2)),
+        rng.uniform(1, 4, (num_boxes, 2)),
+        rng.uniform(-np.pi, np.pi, (num_boxes, 1))
+    ], axis=1)
+    return torch.from_numpy(boxes).float()
+
+
+def _polygon_iou_bev(boxes_a, boxes_b):
+    """Reference IoU of XYWHR boxes by clipping their polygons."""
+
+    def corners(box):
+        x, y, w, h, r = box
+        local = np.array([[-w, -h], [w, -h], [w, h], [-w, h]]) / 2
+        # the kernel rotates the boxes by -r
+        rot = np.array([[np.cos(r), -np.sin(r)], [np.sin(r), np.cos(r)]])
+        return local @ rot + [x, y]
+
+    def area(poly):
+        x, y = poly[:, 0], poly[:, 1]
+        return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+    def clip(subject, clipper):
+        # Sutherland-Hodgman with a counter-clockwise convex clipper
+        for a, b in zip(clipper, np.roll(clipper, -1, axis=0)):
+            if len(subject) == 0:
+                break
+            side = np.cross(b - a, subject - a)
+            clipped = []
+            for i in range(len(subject)):
+                p, q = subject[i - 1], subject[i]
+                if side[i] >= 0:
+                    if side[i - 1] < 0:
+                        t = side[i - 1] / (side[i - 1] - side[i])
+                        clipped.append(p + t * (q - p))
+                    clipped.append(q)
+                elif side[i - 1] >= 0:
+                    t = side[i - 1] / (side[i - 1] - side[i])
+                    clipped.append(p + t * (q - p))
+            subject = np.array(clipped).reshape(-1, 2)
+        return subject
+
+    ious = np.zeros((len(boxes_a), len(boxes_b)))
+    for i, box_a in enumerate(boxes_a.double().numpy()):
+        for j, box_b in enumerate(boxes_b.double().numpy()):
+            poly_a, poly_b = corners(box_a), corners(box_b)
+            inter = clip(poly_a, poly_b)
+            inter = area(inter) if len(inter) > 2 else 0.
+            ious[i, j] = inter / (area(poly_a) + area(poly_b) - inter)
+    return ious
+
+
+def _greedy_nms(ious, scores, thresh):
+    order = scores.sort(0, descending=True)[1]
+    ious = ious[order][:, order]
+    removed = torch.zeros(len(order), dtype=torch.bool)
+    keep = []
+    for i in range(len(order)):
+        if removed[i]:
+            continue
+        keep.append(i)
+        removed |= ious[i] > thresh
+    return order[keep]
+
+
+def test_boxes_iou_bev_cpu():
+    # axis aligned boxes have a closed form IoU
+    boxes = _random_bev_boxes(40)
+    boxes[:, 4] = 0
+    boxes = xywhr2xyxyr(boxes)
+    left = torch.max(boxes[:, None, 0], boxes[None, :, 0])
+    right = torch.min(boxes[:, None, 2], boxes[None, :, 2])
+    top = torch.max(boxes[:, None, 1], boxes[None, :, 1])
+    bottom = torch.min(boxes[:, None, 3], boxes[None, :, 3])
+    inter = (right - left).clamp(min=0) * (bottom - top).clamp(min=0)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    expected_iou = inter / (area[:, None] + area[None, :] - inter)
+
+    iou = boxes_iou_bev(boxes, boxes)
+    assert iou.device == boxes.device
+    assert torch.allclose(iou, expected_iou, atol=1e-5)
+
+    # a rotated box against itself and against its 90 degree rotation
+    boxes = xywhr2xyxyr(
+        torch.tensor([[0., 0., 2., 4., 0.3], [0., 0., 4., 2., 0.3 + np.pi / 2],
+                      [10., 10., 2., 4., -1.2]]))
+    expected_iou = torch.tensor([[1., 1., 0.], [1., 1., 0.], [0., 0., 1.]])
+    assert torch.allclose(
+        boxes_iou_bev(boxes, boxes), expected_iou, atol=1e-4)
+
+
+def test_boxes_iou_bev_polygon():
+    boxes_a = _random_bev_boxes(60, seed=0)
+    boxes_b = _random_bev_boxes(50, seed=1)
+    # the same boxes at other angles overlap partially
+    boxes_b[:10] = boxes_a[:10]
+    boxes_b[:10, 4] += torch.linspace(0.1, 3., 10)
+    expected_iou = _polygon_iou_bev(boxes_a, boxes_b)
+    assert (expected_iou > 0).sum() > 50
+
+    iou = boxes_iou_bev(xywhr2xyxyr(boxes_a), xywhr2xyxyr(boxes_b))
+    assert np.allclose(iou.numpy(), expected_iou, atol=1e-4)
+
+
+def test_boxes_iou_bev_parity():
+    if not torch.cuda.is_available():
+        pytest.skip('test requires GPU and torch+cuda')
+    from mmdet3d.core.evaluation.kitti_utils.rotate_iou import \
+        rotate_iou_gpu_eval
+
+    boxes_a = _random_bev_boxes(60, seed=0)
+    boxes_b = _random_bev_boxes(50, seed=1)
+    expected_iou = rotate_iou_gpu_eval(boxes_a.numpy(), boxes_b.numpy())
+
+    iou_cpu = boxes_iou_bev(xywhr2xyxyr(boxes_a), xywhr2xyxyr(boxes_b))
+    iou_gpu = boxes_iou_bev(
+        xywhr2xyxyr(boxes_a).cuda(),
+        xywhr2xyxyr(boxes_b).cuda())
+    assert np.allclose(iou_cpu.numpy(), expected_iou, atol=1e-4)
+    assert torch.allclose(iou_cpu, iou_gpu.cpu(), atol=1e-5)
+
+
+def test_nms_cpu():
+    boxes = xywhr2xyxyr(_random_bev_boxes(300))
+    scores = torch.rand(300, generator=torch.Generator().manual_seed(0))
+
+    keep = nms_gpu(boxes, scores, 0.1)
+    expected_keep = _greedy_nms(boxes_iou_bev(boxes, boxes), scores, 0.1)
+    assert keep.device == boxes.device
+    assert torch.equal(keep, expected_keep)
+    assert torch.equal(
+        nms_gpu(boxes, scores, 0.1, post_max_size=10), expected_keep[:10])
+
+    axis_aligned = boxes.clone()
+    axis_aligned[:, 4] = 0
+    keep = nms_normal_gpu(boxes, scores, 0.1)
+    expected_keep = _greedy_nms(
+        boxes_iou_bev(axis_aligned, axis_aligned), scores, 0.1)
+    assert torch.equal(keep, expected_keep)
+
+    if torch.cuda.is_available():
+        assert torch.equal(nms_gpu(boxes.cuda(), scores.cuda(), 0.1).cpu(),
+                           nms_gpu(boxes, scores, 0.1))
+        assert torch.equal(
+            nms_normal_gpu(boxes.cuda(), scores.cuda(), 0.1).cpu(),
+            nms_normal_gpu(boxes, scores, 0.1))
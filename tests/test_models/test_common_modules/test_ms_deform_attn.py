@@ -0,0 +1,67 @@
+import pytest
+import torch
+from torch.autograd import gradcheck
+
+
+def _get_inputs(dtype):
+    torch.manual_seed(3)
+    N, M, D = 2, 2, 3
+    Lq, L, P = 5, 2, 3
+    shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long)
+    level_start_index = torch.cat(
+        (shapes.new_zeros((1, )), shapes.prod(1).cumsum(0)[:-1]))
+    S = sum([(H * W).item() for H, W in shapes])
+    value = torch.rand(N, S, M, D, dtype=dtype)
+    # the sampling locations also fall outside of the feature maps
+    sampling_locations = torch.rand(N, Lq, M, L, P, 2, dtype=dtype) * 1.2 - 0.1
+    attention_weights = torch.rand(N, Lq, M, L, P, dtype=dtype) + 1e-5
+    attention_weights /= attention_weights.sum(-1, keepdim=True).sum(
+        -2, keepdim=True)
+    return value, shapes, level_start_index, sampling_locations, \
+        attention_weights
+
+
+@pytest.mark.parametrize('im2col_step', [1, 2])
+def test_ms_deform_attn_cpu(im2col_step):
+    pytest.importorskip('MultiScaleDeformableAttention')
+    from mmdet3d.models.utils.ops.functions.ms_deform_attn_func import (
+        MSDeformAttnFunction, ms_deform_attn_core_pytorch)
+
+    for dtype, tol in [(torch.float64, 1e-10), (torch.float32, 1e-5)]:
+        value, shapes, level_start_index, sampling_locations, \
+            attention_weights = _get_inputs(dtype)
+        inputs = [
+            x.clone().requires_grad_()
+            for x in [value, sampling_locations, attention_weights]
+        ]
+        output = MSDeformAttnFunction.apply(inputs[0], shapes,
+                                            level_start_index, inputs[1],
+                                            inputs[2], im2col_step)
+        ref_inputs = [
+            x.clone().requires_grad_()
+            for x in [value, sampling_locations, attention_weights]
+        ]
+        ref_output = ms_deform_attn_core_pytorch(ref_inputs[0], shapes,
+                                                 ref_inputs[1],
+                                                 ref_inputs[2])
+        assert torch.allclose(output, ref_output, rtol=tol, atol=tol)
+
+        grad_output = torch.rand_like(output)
+        grads = torch.autograd.grad(output, inputs, grad_output)
+        ref_grads = torch.autograd.grad(ref_output, ref_inputs, grad_output)
+        # value, sampling_loc and attn_weight
+        for grad, ref_grad in zip(grads, ref_grads):
+            assert torch.allclose(grad, ref_grad, rtol=tol, atol=tol)
+
+    value, shapes, level_start_index, sampling_locations, \
+        attention_weights = _get_inputs(torch.float64)
+    value.requires_grad_()
+    sampling_locations.requires_grad_()
+    attention_weights.requires_grad_()
+    assert gradcheck(
+        lambda *args: MSDeformAttnFunction.apply(
+            args[0], shapes, level_start_index, args[1], args[2],
+            im2col_step),
+        (value, sampling_locations, attention_weights),
+        eps=1e-6,
+        atol=1e-4)
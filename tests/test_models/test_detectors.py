@@ -317,3 +317,280 @@ def test_centerpoint():
     assert boxes_3d_0.tensor.shape[1] == 9
     assert scores_3d_0.shape[0] >= 0
     assert labels_3d_0.shape[0] >= 0
+
+
+def test_sparsefusion_augment_batch():
+    from types import SimpleNamespace
+
+    from mmdet3d.models.detectors import SparseFusionDetector
+    _setup_seed(0)
+    sparse_depth_cfg = dict(scale_factors=[4], depth_mean=10., depth_var=64.)
+    self = SimpleNamespace(
+        pts_aug_cfg=dict(
+            rot_range=[-0.78539816, 0.78539816],
+            scale_ratio_range=[0.9, 1.1],
+            translation_std=[0.5, 0.5, 0.5],
+            flip_ratio_bev_horizontal=0.5,
+            flip_ratio_bev_vertical=0.5),
+        sparse_depth_cfg=sparse_depth_cfg,
+        _filter_annos=SparseFusionDetector._filter_annos)
+
+    # the x axis of the LiDAR is the optical axis of the camera
+    lidar2cam_r = np.array([[0., -1., 0.], [0., 0., -1.], [1., 0., 0.]])
+    lidar2cam_t = np.array([0.1, -0.2, 0.3])
+    cam_intrinsic = np.array([[500., 0., 400.], [0., 500., 300.],
+                              [0., 0., 1.]])
+    lidar2img = np.eye(4)
+    lidar2img[:3, :3] = cam_intrinsic @ lidar2cam_r
+    lidar2img[:3, 3] = cam_intrinsic @ lidar2cam_t
+
+    batch_size = 4
+    points, boxes, img_metas = [], [], []
+    for _ in range(batch_size):
+        box = torch.rand(3, 7)
+        box[:, :2] = box[:, :2] * 20 + 5
+        box[:, 3:6] = box[:, 3:6] * 3 + 1
+        box[:, 6] = box[:, 6] * 2 * np.pi
+        box = LiDARInstance3DBoxes(box)
+        # points near the corners of the boxes, inside the boxes
+        centers = box.gravity_center[:, None]
+        points.append(
+            torch.cat([(centers + 0.9 * (box.corners - centers)).view(-1, 3),
+                       torch.rand(24, 2)], dim=1))
+        boxes.append(box)
+        img_metas.append(
+            dict(
+                lidar2cam_r=[lidar2cam_r] * 2,
+                lidar2cam_t=[lidar2cam_t] * 2,
+                cam_intrinsic=[cam_intrinsic] * 2,
+                lidar2img=[lidar2img] * 2))
+    orig_points = [pts.clone() for pts in points]
+    annos = dict(
+        gt_bboxes_3d=[box.clone() for box in boxes],
+        gt_labels_3d=[torch.zeros(3, dtype=torch.long)] * batch_size)
+    sparse_depth = torch.zeros(batch_size, 2, 1, 2, 8, 8)
+    sparse_depth[:, :, :, 0, :4] = 1.
+    sparse_depth[:, :, :, 1, :4] = 1.
+
+    points, aug_depth = SparseFusionDetector.augment_batch(
+        self, points, img_metas, annos, sparse_depth)
+
+    for i in range(batch_size):
+        img_meta = img_metas[i]
+        scale = img_meta['pcd_scale_factor']
+        box = annos['gt_bboxes_3d'][i]
+        centers = box.gravity_center[:, None]
+        expected = centers + 0.9 * (box.corners - centers)
+        # the points stay inside their boxes
+        dist = torch.cdist(points[i][:, :3].view(3, 8, 3), expected)
+        assert torch.allclose(
+            dist.min(2)[0], torch.zeros(3, 8), atol=1e-4)
+        assert torch.allclose(points[i][:, 3:], orig_points[i][:, 3:])
+
+        # the calibration projects the points where it did before
+        aug_pts = points[i][:, :3].double().numpy()
+        pts = orig_points[i][:, :3].double().numpy()
+        for view in range(2):
+            cam_pts = pts @ lidar2cam_r.T + lidar2cam_t
+            aug_cam_pts = aug_pts @ img_meta['lidar2cam_r'][view].T + \
+                img_meta['lidar2cam_t'][view]
+            assert np.allclose(aug_cam_pts, scale * cam_pts, atol=1e-4)
+            img_pts = pts @ lidar2img[:3, :3].T + lidar2img[:3, 3]
+            aug_img_pts = aug_pts @ img_meta['lidar2img'][view][:3, :3].T + \
+                img_meta['lidar2img'][view][:3, 3]
+            assert np.allclose(
+                aug_img_pts[:, :2] / aug_img_pts[:, 2:],
+                img_pts[:, :2] / img_pts[:, 2:],
+                atol=1e-3)
+            assert np.allclose(aug_img_pts[:, 2], scale * img_pts[:, 2],
+                               atol=1e-4)
+
+        # the normalized sparse depth follows the scaling
+        depth = sparse_depth[i, :, :, 0, :4] * 8. + 10.
+        aug_depth_i = aug_depth[i, :, :, 0, :4] * 8. + 10.
+        assert torch.allclose(aug_depth_i, depth * scale, atol=1e-4)
+        assert (aug_depth[i, :, :, 0, 4:] == 0).all()
+
+
+def test_sparsefusion_normalize_img():
+    from types import SimpleNamespace
+
+    from mmdet3d.datasets.pipelines.loading import MyNormalize, MyPad
+    from mmdet3d.models.detectors import SparseFusionDetector
+    _setup_seed(0)
+    mean, std = [103.53, 116.28, 123.675], [57.375, 57.12, 58.395]
+    num_views = 2
+    # both samples are padded to 64 x 96
+    img_shapes = [(50, 70, 3), (60, 90, 3)]
+    for to_rgb in [True, False]:
+        expected, imgs, img_metas = [], [], []
+        for img_shape in img_shapes:
+            views = [
+                np.random.randint(0, 256, img_shape).astype(np.uint8)
+                for _ in range(num_views)
+            ]
+            results = dict(img=[view.copy() for view in views])
+            results = MyNormalize(mean, std, to_rgb=to_rgb)(results)
+            results = MyPad(size_divisor=32)(results)
+            expected += results['img']
+            pad_h, pad_w = results['pad_shape'][:2]
+            # the padding of the uint8 views holds anything
+            padded = np.random.randint(
+                0, 256, (num_views, pad_h, pad_w, 3)).astype(np.uint8)
+            padded[:, :img_shape[0], :img_shape[1]] = np.stack(views)
+            imgs.append(padded)
+            img_metas.append(
+                dict(
+                    img_shape=img_shape,
+                    pad_shape=results['pad_shape'],
+                    img_norm_cfg=dict(
+                        mean=np.array(mean, dtype=np.float32),
+                        std=np.array(std, dtype=np.float32),
+                        to_rgb=to_rgb,
+                        on_device=True)))
+        img = torch.from_numpy(np.concatenate(imgs)).permute(0, 3, 1, 2)
+        img = SparseFusionDetector.normalize_img(SimpleNamespace(), img,
+                                                 img_metas)
+        assert img.dtype == torch.float32
+        expected = torch.from_numpy(np.stack(expected)).permute(0, 3, 1, 2)
+        assert img.shape == expected.shape
+        assert torch.allclose(img, expected, atol=1e-5)
+
+
+def test_sparsefusion_generate_sparse_depth():
+    from types import SimpleNamespace
+
+    from mmdet3d.core.points import LiDARPoints
+    from mmdet3d.datasets.pipelines.loading import SparseDepth
+    from mmdet3d.models.detectors import SparseFusionDetector
+    _setup_seed(0)
+    sparse_depth_cfg = dict(
+        scale_factors=[4, 8], depth_mean=10., depth_var=64., exp_time=1)
+    self = SimpleNamespace(sparse_depth_cfg=sparse_depth_cfg)
+    pipeline = SparseDepth(**sparse_depth_cfg)
+
+    # the x axis of the LiDAR is the optical axis of the cameras
+    lidar2cam_r = np.array([[0., -1., 0.], [0., 0., -1.], [1., 0., 0.]])
+    cam_intrinsic = np.array([[50., 0., 48.], [0., 50., 32.], [0., 0., 1.]])
+    points, img_metas, expected = [], [], []
+    for i in range(2):
+        pts = torch.rand(500, 5)
+        pts[:, 0] = pts[:, 0] * 30 + 1
+        pts[:, 1:3] = (pts[:, 1:3] - 0.5) * 40
+        # the points of the previous sweeps are not projected
+        pts[:, 4] = (pts[:, 4] > 0.7).float()
+        img_meta = dict(
+            lidar2cam_r=[lidar2cam_r] * 2,
+            lidar2cam_t=[np.random.randn(3) for _ in range(2)],
+            cam_intrinsic=[cam_intrinsic] * 2,
+            pad_shape=(64, 96, 3))
+        if i == 1:
+            img_meta['valid_shape'] = np.array([[96, 64], [80, 50]])
+        results = pipeline(
+            dict(points=LiDARPoints(pts, points_dim=5), **img_meta))
+        expected.append(results['sparse_depth'])
+        points.append(pts)
+        img_metas.append(img_meta)
+
+    sparse_depth = SparseFusionDetector.generate_sparse_depth(
+        self, points, img_metas)
+    expected = torch.stack(expected)
+    assert sparse_depth.shape == expected.shape
+    assert sparse_depth.shape == (2, 2, 2, 2, 16, 24)
+    assert (expected[:, :, :, 1] > 0).any()
+    assert torch.allclose(sparse_depth, expected)
+
+
+def test_sparsefusion_filter_annos():
+    from mmdet3d.models.detectors import SparseFusionDetector
+    point_cloud_range = [-50, -50, -5, 50, 50, 3]
+    boxes = torch.tensor([[0., 0., 0., 2., 4., 1.5, 0.3],
+                          [60., 0., 0., 2., 4., 1.5, 0.3]])
+    centers = torch.tensor([[10., 10., 0.], [-60., 0., 0.], [0., 49., 0.]])
+
+    # without the 2D annotations only the 3D boxes are filtered
+    annos = dict(
+        gt_bboxes_3d=[LiDARInstance3DBoxes(boxes)],
+        gt_labels_3d=[torch.tensor([1, 2])],
+        gt_pts_centers_view=None)
+    SparseFusionDetector._filter_annos(annos, 0, point_cloud_range)
+    assert torch.equal(annos['gt_bboxes_3d'][0].tensor, boxes[:1])
+    assert torch.equal(annos['gt_labels_3d'][0], torch.tensor([1]))
+
+    annos = dict(
+        gt_bboxes_3d=[LiDARInstance3DBoxes(boxes)],
+        gt_labels_3d=[torch.tensor([1, 2])],
+        gt_pts_centers_view=[centers],
+        gt_labels=[torch.tensor([0, 1, 2])])
+    SparseFusionDetector._filter_annos(annos, 0, point_cloud_range)
+    assert torch.equal(annos['gt_labels_3d'][0], torch.tensor([1]))
+    assert torch.equal(annos['gt_pts_centers_view'][0], centers[[0, 2]])
+    assert torch.equal(annos['gt_labels'][0], torch.tensor([0, 2]))
+
+
+def _voxel_heights_reference(voxels, coors, batch_size, x_num, y_num,
+                             out_size_factor):
+    min_heights = torch.full((batch_size, y_num, x_num), 100.)
+    max_heights = torch.full((batch_size, y_num, x_num), -200.)
+    for voxel, coor in zip(voxels.cpu(), coors.cpu()):
+        heights = voxel[:, 2][voxel[:, 2] != 0]
+        if len(heights) == 0:
+            continue
+        cell = (coor[0], coor[2] // out_size_factor,
+                coor[3] // out_size_factor)
+        min_heights[cell] = min(min_heights[cell], heights.min())
+        max_heights[cell] = max(max_heights[cell], heights.max())
+    return min_heights, max_heights
+
+
+def test_sparsefusion_extract_voxel_heights(monkeypatch):
+    from types import SimpleNamespace
+
+    from mmdet3d.models.detectors import SparseFusionDetector
+    _setup_seed(0)
+    out_size_factor = 4
+    self = SimpleNamespace(
+        test_cfg=dict(
+            pts=dict(grid_size=[32, 24, 1], out_size_factor=out_size_factor)))
+    batch_size, x_num, y_num = 2, 8, 6
+
+    # unique voxels of a few cells, the other cells stay empty
+    cells = torch.randperm(batch_size * 24 * 32)[:60]
+    coors = torch.stack([
+        cells // (24 * 32),
+        torch.zeros_like(cells), cells // 32 % 24, cells % 32
+    ], dim=1).int()
+    coors = coors[coors[:, 0].argsort()]
+    voxels = torch.rand(60, 10, 4) * 4 - 2
+    num_points = torch.randint(0, 11, (60, ))
+    num_points[:3] = 0
+    voxels[torch.arange(10)[None] >= num_points[:, None]] = 0
+    expected_min, expected_max = _voxel_heights_reference(
+        voxels, coors, batch_size, x_num, y_num, out_size_factor)
+    assert (expected_min == 100).any() and (expected_max == -200).any()
+
+    devices = ['cpu']
+    if torch.cuda.is_available():
+        devices.append('cuda')
+    for device in devices:
+        min_heights, max_heights = SparseFusionDetector.extract_voxel_heights(
+            self, voxels.to(device), coors.to(device))
+        assert torch.equal(min_heights.cpu(), expected_min)
+        assert torch.equal(max_heights.cpu(), expected_max)
+
+    if not torch.cuda.is_available():
+        pytest.skip('test requires GPU and torch+cuda')
+
+    # dynamic_scatter is the fallback of torch<1.12 and only runs on GPU
+    class _Torch:
+        Tensor = object
+
+        def __getattr__(self, name):
+            return getattr(torch, name)
+
+    monkeypatch.setattr('mmdet3d.models.detectors.sparsefusion.torch',
+                        _Torch())
+    min_heights, max_heights = SparseFusionDetector.extract_voxel_heights(
+        self, voxels.cuda(), coors.cuda())
+    assert torch.equal(min_heights.cpu(), expected_min)
+    assert torch.equal(max_heights.cpu(), expected_max)
@@ -0,0 +1,251 @@
+import numpy as np
+import torch
+from os import path as osp
+from types import SimpleNamespace
+from torch import nn
+
+from mmdet3d.core.feature_aligner.aligner import FeatureAligner
+from mmdet3d.core.feature_aligner.calibration import (CalibrationState,
+                                                      CalibrationTable,
+                                                      CalibrationTableHook)
+from mmdet3d.core.feature_aligner.center_loss import CrossModalCenterLoss
+
+
+def _get_calibration(**kwargs):
+    torch.manual_seed(0)
+    feature_aligner = FeatureAligner(
+        input_dim=32, hidden_dim=32, output_dim=16)
+    center_loss = CrossModalCenterLoss(
+        num_classes=10, feat_dim=16, use_gpu=False, mode='test')
+    return CalibrationState(feature_aligner, center_loss, topk=3, **kwargs)
+
+
+def _nearest_centers(calibration, feats):
+    """Distances to all centers with ``torch.cdist`` in float64."""
+    with torch.no_grad():
+        feats_aligned = calibration.align(feats)
+    return torch.cdist(feats_aligned.double(),
+                       calibration.centers.detach().double()[None])
+
+
+def test_calibration_score():
+    from mmdet3d.models.utils.sparsefusion_models import \
+        FusionTransformer2D_3D_Self
+
+    img_feats = torch.randn(2, 20, 32)
+    pts_feats = torch.randn(2, 30, 32)
+    devices = ['cpu', 'cuda'] if torch.cuda.is_available() else ['cpu']
+    for device in devices:
+        for fp16, tol in [(False, 1e-4), (True, 2e-2)]:
+            calibration = _get_calibration(fp16=fp16)
+            calibration.feature_aligner.to(device)
+            calibration.center_loss.to(device)
+            img, pts = img_feats.to(device), pts_feats.to(device)
+            (img_scores, pts_scores, img_inds, pts_inds, img_dists,
+             img_topk_inds, pts_dists,
+             pts_topk_inds) = calibration.score(img, pts)
+
+            for feats, scores, inds, dists, topk_inds in [
+                (img, img_scores, img_inds, img_dists, img_topk_inds),
+                (pts, pts_scores, pts_inds, pts_dists, pts_topk_inds)
+            ]:
+                ref_dists = _nearest_centers(calibration, feats)
+                assert dists.shape == topk_inds.shape == feats.shape[:2] + (
+                    3, )
+                assert torch.allclose(
+                    scores.double(), ref_dists.min(-1)[0], rtol=tol, atol=tol)
+                assert torch.allclose(
+                    dists.double(),
+                    ref_dists.gather(-1, topk_inds),
+                    rtol=tol,
+                    atol=tol)
+                assert torch.allclose(
+                    dists.double(),
+                    ref_dists.topk(3, dim=-1, largest=False)[0],
+                    rtol=tol,
+                    atol=tol)
+                assert torch.equal(inds, topk_inds[..., 0])
+                if not fp16:
+                    assert torch.equal(inds, ref_dists.argmin(-1))
+
+            # the fusion layer weights the queries with the same scores
+            fusion = FusionTransformer2D_3D_Self.__new__(
+                FusionTransformer2D_3D_Self)
+            nn.Module.__init__(fusion)
+            fusion.calibration = calibration
+            img_output, pts_output, cam_ncscore, lidar_ncscore, p_cam, \
+                p_lidar = fusion.dynamic_weighting(img, pts)
+            assert img_output is img and pts_output is pts
+            assert torch.equal(cam_ncscore, img_scores)
+            assert torch.equal(lidar_ncscore, pts_scores)
+            assert p_cam is None and p_lidar is None
+
+            calibration.table = CalibrationTable.from_scores(
+                dict(
+                    cam=np.random.rand(100) * 5,
+                    lidar=np.random.rand(100) * 5),
+                dict(
+                    cam=np.random.randint(0, 10, 100),
+                    lidar=np.random.randint(0, 10, 100)), 10)
+            _, _, _, _, p_cam, p_lidar = fusion.dynamic_weighting(img, pts)
+            assert torch.equal(
+                p_cam, calibration.table.p_value('cam', img_scores, img_inds))
+            assert torch.equal(
+                p_lidar,
+                calibration.table.p_value('lidar', pts_scores, pts_inds))
+
+
+def test_calibration_table_p_value():
+    rng = np.random.RandomState(0)
+    # integer scores, so that most of them are tied
+    scores = dict(
+        cam=rng.randint(0, 8, 200).astype(np.float32),
+        lidar=rng.randint(0, 20, 50).astype(np.float32))
+    labels = dict(cam=rng.randint(0, 3, 200), lidar=rng.randint(0, 2, 50))
+    table = CalibrationTable.from_scores(scores, labels, 4)
+    assert table.lengths['cam'].tolist() == [
+        (labels['cam'] == i).sum() for i in range(4)
+    ]
+
+    for modality in ['cam', 'lidar']:
+        for cls_id in range(3):
+            calib = scores[modality][labels[modality] == cls_id]
+            if len(calib) == 0:
+                continue
+            # the calibration scores with their ties, both ends and beyond
+            query = np.concatenate([
+                np.unique(calib), [calib.min() - 1, calib.max() + 1],
+                np.unique(calib) + 0.5
+            ]).astype(np.float32)
+            p_value = table.p_value(
+                modality, torch.from_numpy(query),
+                torch.full((len(query), ), cls_id, dtype=torch.long))
+            expected = (calib[None] > query[:, None]).mean(1)
+            assert np.allclose(p_value.numpy(), expected)
+            assert p_value[query == calib.min() - 1].item() == 1
+            assert p_value[query == calib.max()].item() == 0
+            assert p_value[query == calib.max() + 1].item() == 0
+
+    # the classes of the scores are looked up elementwise
+    query = torch.tensor([[3., 3.], [3., 3.]])
+    query_labels = torch.tensor([[0, 1], [2, 0]])
+    p_value = table.p_value('cam', query, query_labels)
+    assert p_value.shape == (2, 2)
+    for i in range(2):
+        for j in range(2):
+            calib = scores['cam'][labels['cam'] == query_labels[i, j].item()]
+            assert np.isclose(p_value[i, j].item(), (calib > 3).mean())
+
+
+def test_calibration_table_dump_load(tmp_path):
+    rng = np.random.RandomState(0)
+    scores = dict(cam=rng.rand(100), lidar=rng.rand(80))
+    labels = dict(cam=rng.randint(0, 5, 100), lidar=rng.randint(0, 4, 80))
+    for num_quantiles in [None, 7]:
+        table = CalibrationTable.from_scores(scores, labels, 5, num_quantiles)
+        out_file = osp.join(str(tmp_path), 'calib_table.pkl')
+        table.dump(out_file)
+        loaded = CalibrationTable.load(out_file)
+        for modality in ['cam', 'lidar']:
+            assert torch.equal(loaded.tables[modality],
+                               table.tables[modality])
+            assert torch.equal(loaded.lengths[modality],
+                               table.lengths[modality])
+            query = torch.rand(30)
+            query_labels = torch.randint(0, 5, (30, ))
+            assert torch.equal(
+                loaded.p_value(modality, query, query_labels),
+                table.p_value(modality, query, query_labels))
+
+
+def test_calibration_table_hook(tmp_path):
+    calibration = _get_calibration(collect=True)
+    scores, labels = dict(cam=[], lidar=[]), dict(cam=[], lidar=[])
+    for _ in range(3):
+        for modality in ['cam', 'lidar']:
+            feats_aligned = torch.randn(2, 15, 16)
+            # the background label is the number of classes
+            query_labels = torch.randint(0, 11, (2, 15))
+            calibration.collect_scores(modality, feats_aligned, query_labels)
+            mask = query_labels < 10
+            centers = calibration.centers.detach()
+            scores[modality].append(
+                torch.norm(
+                    feats_aligned[mask] - centers[query_labels[mask]],
+                    dim=-1).numpy())
+            labels[modality].append(query_labels[mask].numpy())
+
+    hook = CalibrationTableHook(out_file='table.pkl', num_quantiles=None)
+    runner = SimpleNamespace(
+        model=SimpleNamespace(
+            pts_bbox_head=SimpleNamespace(calibration=calibration)),
+        work_dir=str(tmp_path),
+        logger=SimpleNamespace(info=lambda msg: None))
+    hook.after_run(runner)
+
+    table = CalibrationTable.load(osp.join(str(tmp_path), 'table.pkl'))
+    expected = CalibrationTable.from_scores(
+        {k: np.concatenate(v)
+         for k, v in scores.items()},
+        {k: np.concatenate(v)
+         for k, v in labels.items()}, 10)
+    for modality in ['cam', 'lidar']:
+        assert torch.equal(table.lengths[modality],
+                           expected.lengths[modality])
+        assert torch.allclose(table.tables[modality],
+                              expected.tables[modality])
+
+
+def test_calibration_load_from_checkpoint(tmp_path, monkeypatch):
+    from mmdet3d.core.feature_aligner import calibration as calibration_module
+
+    state_dict = dict()
+    for layer_id in ['', '5']:
+        aligner = FeatureAligner(input_dim=32, hidden_dim=32, output_dim=16)
+        for key, value in aligner.state_dict().items():
+            state_dict[f'pts_bbox_head.feature_aligner{layer_id}.{key}'] = \
+                value
+        state_dict[f'pts_bbox_head.center_loss.centers{layer_id}'] = \
+            torch.randn(10, 16)
+    filename = osp.join(str(tmp_path), 'model.pth')
+    torch.save(dict(state_dict=state_dict), filename)
+
+    num_reads = []
+    load_checkpoint = calibration_module._load_checkpoint
+
+    def counting_load_checkpoint(*args, **kwargs):
+        num_reads.append(1)
+        return load_checkpoint(*args, **kwargs)
+
+    monkeypatch.setattr(calibration_module, '_load_checkpoint',
+                        counting_load_checkpoint)
+
+    def check_loaded(calibration, layer_id):
+        prefix = f'pts_bbox_head.feature_aligner{layer_id}.'
+        for key, value in calibration.feature_aligner.state_dict().items():
+            assert torch.equal(value, state_dict[prefix + key])
+        assert torch.equal(
+            calibration.centers.detach(),
+            state_dict[f'pts_bbox_head.center_loss.centers{layer_id}'])
+
+    calibration = _get_calibration()
+    calibration.load_from_checkpoint(filename, layer_id=5)
+    assert len(num_reads) == 1
+    check_loaded(calibration, '5')
+
+    # the weights are overwritten, e.g. by init_weights of the head, and a
+    # second call restores them without reading the checkpoint again
+    with torch.no_grad():
+        calibration.centers.zero_()
+        calibration.feature_aligner.fc1.weight.zero_()
+    calibration.load_from_checkpoint(filename, layer_id='5')
+    assert len(num_reads) == 1
+    check_loaded(calibration, '5')
+
+    # another layer is read from the checkpoint
+    calibration.load_from_checkpoint(filename)
+    assert len(num_reads) == 2
+    check_loaded(calibration, '')
+    calibration.load_from_checkpoint(filename, layer_id=5)
+    assert len(num_reads) == 2
+    check_loaded(calibration, '5')
@@ -1044,3 +1044,355 @@ def test_shape_aware_head_getboxes():
                                   input_metas)
     assert len(result_list[0][1]) > 0  # ensure not all boxes are filtered
     assert (result_list[0][1] > 0.3).all()
+
+
+def test_sparsefusion_head_batch_targets():
+    if not torch.cuda.is_available():
+        pytest.skip('test requires GPU and torch+cuda')
+    from mmdet3d.core.bbox import CameraInstance3DBoxes
+    _setup_seed(0)
+    head_cfg = _get_pts_bbox_head_cfg('sparsefusion_nusc_voxel_LC_r50.py')
+    head_cfg.update(num_proposals=30, num_img_proposals=20)
+    self = build_head(head_cfg).cuda()
+    num_classes, num_views = self.num_classes, self.num_views
+
+    batch_size = 3
+    num_layer = self.num_pts_decoder_layers + self.num_fusion_decoder_layers
+    num_proposals = sum(
+        self.get_layer_num_proposal(idx_layer)
+        for idx_layer in range(num_layer))
+    num_img_proposals = self.num_img_proposals * self.num_img_decoder_layers
+    num_view_proposals = self.num_proposals
+
+    def rand(*shape):
+        return torch.rand(*shape).cuda()
+
+    def randn(*shape):
+        return torch.randn(*shape).cuda()
+
+    # the second sample has no ground truths
+    num_gts_3d, num_gts_2d = [7, 0, 12], [9, 0, 15]
+    gt_bboxes_3d = [
+        LiDARInstance3DBoxes(
+            torch.cat([
+                rand(n, 2) * 100 - 50,
+                rand(n, 1),
+                rand(n, 3) * 4 + 0.5,
+                rand(n, 3)
+            ], 1),
+            box_dim=9) for n in num_gts_3d
+    ]
+    gt_labels_3d = [
+        torch.randint(0, num_classes, (n, )).cuda() for n in num_gts_3d
+    ]
+    gt_visible_3d = [torch.randint(0, 2, (n, )).cuda() for n in num_gts_3d]
+    gt_bboxes = [
+        torch.cat([rand(n, 2) * 400, rand(n, 2) * 300 + 1], 1)
+        for n in num_gts_2d
+    ]
+    gt_labels = [
+        torch.stack([
+            torch.randint(0, num_classes, (n, )),
+            torch.randint(0, num_views, (n, ))
+        ], 1).cuda() for n in num_gts_2d
+    ]
+    gt_img_centers_view = [
+        torch.cat([rand(n, 2) * 420 - 10, rand(n, 1) * 50], 1)
+        for n in num_gts_2d
+    ]
+    gt_bboxes_cam_view = [
+        CameraInstance3DBoxes(
+            torch.cat([rand(n, 3) * 20, rand(n, 3) + 0.5,
+                       rand(n, 3)], 1),
+            box_dim=9) for n in num_gts_2d
+    ]
+    gt_bboxes_lidar_view = [
+        LiDARInstance3DBoxes(bboxes.tensor.clone(), box_dim=9)
+        for bboxes in gt_bboxes_cam_view
+    ]
+    preds_dict = dict(
+        heatmap=randn(batch_size, num_classes, num_proposals),
+        center=rand(batch_size, 2, num_proposals) * 180,
+        height=randn(batch_size, 1, num_proposals),
+        dim=randn(batch_size, 3, num_proposals),
+        rot=randn(batch_size, 2, num_proposals),
+        vel=randn(batch_size, 2, num_proposals),
+        cls=randn(batch_size, num_classes, num_img_proposals),
+        rot_2d=randn(batch_size, 2, num_img_proposals),
+        dim_2d=randn(batch_size, 3, num_img_proposals),
+        loc_cam_3d=rand(batch_size, 3, num_img_proposals) * 20,
+        vel_2d=randn(batch_size, 2, num_img_proposals),
+        view=torch.randint(0, num_views,
+                           (batch_size, num_img_proposals)).cuda(),
+        heatmap_view=randn(batch_size, num_classes, num_view_proposals),
+        center_view=rand(batch_size, 2, num_view_proposals) * 180,
+        height_view=randn(batch_size, 1, num_view_proposals),
+        dim_view=randn(batch_size, 3, num_view_proposals),
+        rot_view=randn(batch_size, 2, num_view_proposals),
+        vel_view=randn(batch_size, 2, num_view_proposals))
+    img_metas = [dict(pad_shape=(448, 800, 3)) for _ in range(batch_size)]
+    args = (gt_bboxes_3d, gt_labels_3d, gt_bboxes, gt_labels,
+            gt_img_centers_view, gt_bboxes_cam_view, gt_visible_3d,
+            gt_bboxes_lidar_view, [preds_dict], img_metas)
+
+    # labels, weights, bbox targets, IoUs and heatmaps of all branches
+    self.train_cfg['batch_targets'] = False
+    expected = self.get_targets(*args)
+    self.train_cfg['batch_targets'] = True
+    targets = self.get_targets(*args)
+    assert len(targets) == len(expected)
+    for target, expected_target in zip(targets, expected):
+        if isinstance(expected_target, np.ndarray):
+            assert np.array_equal(target, expected_target)
+        else:
+            assert target.shape == expected_target.shape
+            assert target.dtype == expected_target.dtype
+            assert torch.allclose(target, expected_target, atol=1e-5)
+
+
+def _generate_heatmap_deform_per_view(self, lidar_feat, img_feat, voxel_height,
+                                      img_metas, lidar2img_rt,
+                                      input_padding_mask):
+    """Camera-to-BEV transfer with one decoder call per sample and view."""
+    import torch.nn.functional as F
+
+    from mmdet3d.models.utils import inverse_sigmoid
+    batch_size, num_channels, H, W = lidar_feat.shape
+    num_views, level_num = self.num_views, self.level_num
+    img_feat = [
+        self.heatmap_img_proj(feat.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        for feat in img_feat
+    ]
+    img_h, img_w = img_feat[0].shape[-2:]
+    spatial_shapes = torch.tensor([feat.shape[-2:] for feat in img_feat],
+                                  device=lidar_feat.device)
+    level_start_index = torch.cat([
+        spatial_shapes.new_zeros(1),
+        spatial_shapes.prod(1).cumsum(0)[:-1]
+    ])
+    img_feats_stack = torch.cat([feat.flatten(2) for feat in img_feat],
+                                dim=2).view(batch_size, num_views,
+                                            num_channels, -1)
+    lidar_feat = self.heatmap_pts_proj(lidar_feat.permute(0, 2, 3,
+                                                          1)).permute(
+                                                              0, 3, 1, 2)
+    lidar_feat_flatten = lidar_feat.reshape(batch_size, num_channels, H * W)
+    voxel_height = voxel_height.view(batch_size, H * W)
+    bev_pos = self.bev_pos[0].to(lidar_feat.device)
+    bev_xy = bev_pos * self.test_cfg['out_size_factor'] * \
+        self.test_cfg['voxel_size'][0] + self.test_cfg['pc_range'][0]
+
+    lidar_feat_output = lidar_feat.new_zeros(batch_size, num_channels, H * W)
+    lidar_feat_count = lidar_feat.new_zeros(batch_size, H * W)
+    for sample_idx in range(batch_size):
+        points = torch.cat([
+            bev_xy, voxel_height[sample_idx, :, None],
+            torch.ones_like(bev_xy[:, :1])
+        ], dim=1)
+        for view_idx in range(num_views):
+            points_2d = points @ lidar2img_rt[sample_idx, view_idx].T
+            depth = points_2d[:, 2].clamp(min=1e-5)
+            xs = points_2d[:, 0] / depth / self.out_size_factor_img
+            ys = points_2d[:, 1] / depth / self.out_size_factor_img
+            valid_w, valid_h = img_metas[sample_idx]['valid_shape'][
+                view_idx] / self.out_size_factor_img
+            on_the_image = (xs >= 0) & (xs < valid_w) & (ys >= 0) & \
+                (ys < valid_h) & (voxel_height[sample_idx] > -50)
+            if not on_the_image.any():
+                continue
+
+            reference_points = torch.stack(
+                [xs[on_the_image] / img_w, ys[on_the_image] / img_h], dim=-1)
+            query_img_feat = torch.stack([
+                F.grid_sample(
+                    feat[sample_idx * num_views + view_idx, None],
+                    reference_points[None, None] * 2 - 1,
+                    mode='bilinear',
+                    padding_mode='border',
+                    align_corners=False)[0, :, 0] for feat in img_feat
+            ]).max(0)[0]
+            query_feat = lidar_feat_flatten[sample_idx][:, on_the_image] + \
+                query_img_feat
+            query_pos = torch.cat([
+                inverse_sigmoid(reference_points),
+                depth[on_the_image].log()[:, None]
+            ], dim=1)
+            output = self.cross_heatmap_decoder(
+                query_feat[None],
+                img_feats_stack[sample_idx, view_idx, None],
+                query_pos[None],
+                self.normal_img_feats_pos_stack,
+                reference_points=reference_points[None, :, None].repeat(
+                    1, 1, level_num, 1),
+                level_start_index=level_start_index,
+                spatial_shapes=spatial_shapes,
+                input_padding_mask=input_padding_mask[sample_idx, view_idx,
+                                                      None])[0]
+
+            # cells seen by an earlier view keep the max
+            seen = lidar_feat_count[sample_idx, on_the_image] > 0
+            output = torch.where(
+                seen, torch.maximum(
+                    lidar_feat_output[sample_idx][:, on_the_image], output),
+                output)
+            lidar_feat_output[sample_idx][:, on_the_image] = output
+            lidar_feat_count[sample_idx, on_the_image] += 1
+
+    lidar_feat_flag = (lidar_feat_count > 0).float().view(
+        batch_size, 1, H, W)
+    lidar_feat_output = lidar_feat_output.view(batch_size, num_channels, H, W)
+    lidar_feat_output = lidar_feat_output + (1 - lidar_feat_flag) * lidar_feat
+    lidar_feat_output = self.reduce_conv(
+        torch.cat([lidar_feat_output, lidar_feat_flag], dim=1))
+    return self.cross_heatmap_head(lidar_feat_output.contiguous())
+
+
+def test_sparsefusion_head_heatmap_deform():
+    if not torch.cuda.is_available():
+        pytest.skip('test requires GPU and torch+cuda')
+    from mmdet3d.models.utils import normalize_pos
+    _setup_seed(0)
+    head_cfg = _get_pts_bbox_head_cfg('sparsefusion_nusc_voxel_LC_r50.py')
+    # a 32 x 32 BEV grid over x, y in [-54, -34.8]
+    head_cfg['test_cfg']['grid_size'] = [256, 256, 40]
+    self = build_head(head_cfg).cuda().eval()
+    num_views, num_channels = self.num_views, self.hidden_channel
+    batch_size, H, W = 2, 32, 32
+    img_h, img_w = 128, 224
+
+    # the grid is at an azimuth of about 225 degrees, the views at 0 and 90
+    # degrees see none of it and the views around 225 degrees overlap
+    yaws = np.deg2rad([[225, 180, 270, 0, 90, 200],
+                       [250, 200, 0, 90, 45, 160]])
+    intrinsic = np.array([[112., 0., 112.], [0., 112., 64.], [0., 0., 1.]])
+    lidar2img_rt = np.tile(np.eye(4), (batch_size, num_views, 1, 1))
+    for sample_idx in range(batch_size):
+        for view_idx, yaw in enumerate(yaws[sample_idx]):
+            lidar2cam_r = np.array([[np.sin(yaw), -np.cos(yaw), 0.],
+                                    [0., 0., -1.],
+                                    [np.cos(yaw), np.sin(yaw), 0.]])
+            lidar2img_rt[sample_idx, view_idx, :3, :3] = \
+                intrinsic @ lidar2cam_r
+            lidar2img_rt[sample_idx, view_idx, :3, 3] = \
+                intrinsic @ np.array([0., 1.5, 0.])
+    lidar2img_rt = torch.from_numpy(lidar2img_rt).float().cuda()
+    valid_shape = np.array([[img_w, img_h]] * num_views)
+    img_metas = [
+        dict(valid_shape=valid_shape.copy()) for _ in range(batch_size)
+    ]
+    img_metas[1]['valid_shape'][0] = [200, 100]
+
+    lidar_feat = torch.randn(batch_size, num_channels, H, W).cuda()
+    img_feat = [
+        torch.randn(batch_size * num_views, num_channels,
+                    img_h // self.out_size_factor_img // 2**lvl,
+                    img_w // self.out_size_factor_img // 2**lvl).cuda()
+        for lvl in range(self.level_num)
+    ]
+    voxel_height = torch.rand(batch_size, H, W).cuda() * 6 - 3
+    # empty cells are never projected
+    voxel_height[torch.rand(batch_size, H, W) < 0.2] = -200
+    input_padding_mask = self.construct_input_padding_mask(
+        img_feat, img_metas)
+    self.normal_img_feats_pos_stack = torch.cat([
+        normalize_pos(
+            self.create_2D_grid(feat.shape[-2], feat.shape[-1]).cuda(),
+            feat.shape[-1], feat.shape[-2]) for feat in img_feat
+    ], dim=1)
+
+    with torch.no_grad():
+        expected = _generate_heatmap_deform_per_view(
+            self, lidar_feat, img_feat, voxel_height, img_metas,
+            lidar2img_rt, input_padding_mask)
+        heatmap = self.generate_heatmap_deform(
+            lidar_feat.clone(), [feat.clone() for feat in img_feat],
+            voxel_height, img_metas, lidar2img_rt, input_padding_mask)
+    assert heatmap.shape == expected.shape
+    assert torch.allclose(heatmap, expected, atol=1e-4)
+
+
+def test_sparsefusion_head_projection_cache():
+    from collections import OrderedDict
+    from types import SimpleNamespace
+
+    from mmdet3d.models.dense_heads.sparsefusion_head_deform import \
+        SparseFusionHead2D_Deform
+    _setup_seed(0)
+    batch_size, num_views, H, W = 2, 3, 8, 10
+    test_cfg = dict(out_size_factor=8, voxel_size=[0.075, 0.075, 0.2],
+                    pc_range=[-54.0, -54.0])
+    self = SimpleNamespace(
+        bev_pos=SparseFusionHead2D_Deform.create_2D_grid(None, W, H),
+        test_cfg=test_cfg,
+        projection_cache=OrderedDict(),
+        projection_cache_size=2)
+
+    def rig():
+        img_meta = dict(
+            cam_intrinsic=[
+                np.array([[500., 0., 400.], [0., 500., 225.], [0., 0., 1.]])
+                for _ in range(num_views)
+            ],
+            lidar2cam_r=[
+                np.linalg.qr(np.random.randn(3, 3))[0]
+                for _ in range(num_views)
+            ],
+            lidar2cam_t=[np.random.randn(3) for _ in range(num_views)])
+        return img_meta
+
+    def lidar2img(img_metas):
+        lidar2img_rt = np.tile(np.eye(4), (len(img_metas), num_views, 1, 1))
+        for i, img_meta in enumerate(img_metas):
+            lidar2cam = np.tile(np.eye(4), (num_views, 1, 1))
+            lidar2cam[:, :3, :3] = np.stack(img_meta['lidar2cam_r'])
+            lidar2cam[:, :3, 3] = np.stack(img_meta['lidar2cam_t'])
+            lidar2img_rt[i, :, :3] = np.stack(
+                img_meta['cam_intrinsic']) @ lidar2cam[:, :3]
+        return torch.from_numpy(lidar2img_rt).float()
+
+    # the cached projection at zero height plus the height term is the
+    # projection of the uncached path
+    img_metas = [rig(), rig()]
+    lidar2img_rt = lidar2img(img_metas)
+    voxel_height = torch.rand(batch_size, H * W) * 6 - 3
+    bev_pos = self.bev_pos.repeat(batch_size, 1, 1)
+    query_pos_realmetric = bev_pos.permute(0, 2, 1) * \
+        test_cfg['out_size_factor'] * test_cfg['voxel_size'][0] + \
+        test_cfg['pc_range'][0]
+    query_pos_3d = torch.cat(
+        [query_pos_realmetric, voxel_height[:, None]], dim=1)
+    points_4d = torch.cat(
+        [query_pos_3d, torch.ones_like(query_pos_3d[:, :1])],
+        dim=1).permute(0, 2, 1)
+    expected = torch.matmul(points_4d[:, None],
+                            lidar2img_rt.transpose(-1, -2))
+    points_2d = SparseFusionHead2D_Deform.project_static_bev(
+        self, lidar2img_rt, img_metas, H, W) + \
+        voxel_height[:, None, :, None] * lidar2img_rt[:, :, None, :, 2]
+    assert points_2d.shape == (batch_size, num_views, H * W, 4)
+    assert torch.allclose(points_2d, expected, rtol=1e-5, atol=1e-3)
+    assert len(self.projection_cache) == 2
+
+    # the same rig hits the cache and becomes the most recently used one
+    first_key, second_key = list(self.projection_cache)
+    cached = self.projection_cache[first_key]
+    static = SparseFusionHead2D_Deform.project_static_bev(
+        self, lidar2img_rt[:1], img_metas[:1], H, W)
+    assert torch.equal(static[0], cached)
+    assert list(self.projection_cache) == [second_key, first_key]
+    assert self.projection_cache[first_key] is cached
+
+    # a new translation is a new rig and evicts the least recently used one
+    moved_rig = dict(img_metas[0])
+    moved_rig['lidar2cam_t'] = [t + 0.1 for t in moved_rig['lidar2cam_t']]
+    moved_lidar2img_rt = lidar2img([moved_rig])
+    static = SparseFusionHead2D_Deform.project_static_bev(
+        self, moved_lidar2img_rt, [moved_rig], H, W)
+    assert len(self.projection_cache) == 2
+    assert second_key not in self.projection_cache
+    assert list(self.projection_cache)[0] == first_key
+    assert not torch.allclose(static[0], cached)
+    expected_static = torch.matmul(
+        points_4d[0].clone().index_fill_(1, torch.tensor([2]), 0),
+        moved_lidar2img_rt[0].transpose(-1, -2))
+    assert torch.allclose(static[0], expected_static, rtol=1e-5, atol=1e-3)
@@ -81,3 +81,39 @@ def test_voxelization():
         assert np.all(
             points[indices] == expected_coors[i][:num_points_current_voxel])
         assert num_points_current_voxel == expected_num_points_per_voxel[i]
+
+
+def test_batched_voxelization():
+    voxel_size = [0.5, 0.5, 0.5]
+    point_cloud_range = [0, -40, -3, 70.4, 40, 1]
+    max_num_points = 5
+    data_path = './tests/data/kitti/training/velodyne_reduced/000000.bin'
+    load_points_from_file = LoadPointsFromFile(
+        coord_type='LIDAR', load_dim=4, use_dim=4)
+    results = dict()
+    results['pts_filename'] = data_path
+    results = load_points_from_file(results)
+    points = results['points'].tensor
+    points_list = [points, points.flip(0), points[::3].contiguous()]
+    batch_offsets = torch.tensor([0] + [len(p) for p in points_list]).cumsum(0)
+
+    devices = ['cpu']
+    if torch.cuda.is_available():
+        devices.append('cuda:0')
+    for max_voxels in [20000, 1000]:
+        hard_voxelization = Voxelization(voxel_size, point_cloud_range,
+                                         max_num_points, max_voxels)
+        for device in devices:
+            points_list = [p.to(device) for p in points_list]
+            voxels, coors, num_points_per_voxel = \
+                hard_voxelization.forward_batched(
+                    torch.cat(points_list), batch_offsets)
+            assert coors.shape[1] == 4
+            for i, res in enumerate(points_list):
+                expected_voxels, expected_coors, expected_num_points = \
+                    hard_voxelization(res)
+                mask = coors[:, 0] == i
+                assert torch.equal(voxels[mask], expected_voxels)
+                assert torch.equal(coors[mask, 1:], expected_coors)
+                assert torch.equal(num_points_per_voxel[mask],
+                                   expected_num_points)
@@ -4,9 +4,12 @@ CommandLine:
     pytest tests/test_utils/test_assigner.py
     xdoctest tests/test_utils/test_assigner.py zero
 """
+import numpy as np
 import torch
+from scipy.optimize import linear_sum_assignment
 
-from mmdet3d.core.bbox.assigners import MaxIoUAssigner
+from mmdet3d.core.bbox.assigners import (MaxIoUAssigner,
+                                         batch_linear_assignment)
 
 
 def test_max_iou_assigner():
@@ -147,3 +150,37 @@ def test_max_iou_assigner_with_empty_boxes_and_gt():
     gt_bboxes = torch.empty((0, 4))
     assign_result = self.assign(bboxes, gt_bboxes)
     assert len(assign_result.gt_inds) == 0
+
+
+def test_batch_linear_assignment():
+    torch.manual_seed(0)
+    num_gts = [5, 0, 8]
+    cost = torch.rand(3, 20, 8)
+    query_groups = [12, 8]
+    for kwargs in [dict(), dict(num_workers=2), dict(solver='sparse')]:
+        assigned_gt_inds = batch_linear_assignment(cost, num_gts,
+                                                   query_groups, **kwargs)
+        assert assigned_gt_inds.shape == (3, 20)
+        assert (assigned_gt_inds[1] == -1).all()
+        for batch_id, num_gt in enumerate(num_gts):
+            start = 0
+            for group_size in query_groups:
+                group_cost = cost[batch_id, start:start + group_size, :num_gt]
+                group_inds = assigned_gt_inds[batch_id,
+                                              start:start + group_size]
+                rows, cols = linear_sum_assignment(group_cost.numpy())
+                matched = torch.nonzero(group_inds >= 0).squeeze(1)
+                assert len(matched) == len(rows)
+                assert np.isclose(
+                    group_cost[matched, group_inds[matched]].sum().item(),
+                    group_cost.numpy()[rows, cols].sum())
+                start += group_size
+
+    # pairs above max_cost are left unmatched
+    cost = torch.tensor([[[0.1, 5.0], [5.0, 5.0], [5.0, 0.2]],
+                         [[5.0, 5.0], [5.0, 5.0], [0.3, float('nan')]]])
+    for solver in ['dense', 'sparse']:
+        assigned_gt_inds = batch_linear_assignment(
+            cost, [2, 2], solver=solver, max_cost=1.0)
+        assert torch.equal(assigned_gt_inds,
+                           torch.tensor([[0, -1, 1], [-1, -1, 0]]))
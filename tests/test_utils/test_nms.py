@@ -72,3 +72,38 @@ def test_circle_nms():
     keep = circle_nms(boxes.numpy(), 0.175)
     expected_keep = [1, 2, 3, 4, 5, 6, 7, 8, 9]
     assert np.all(keep == expected_keep)
+
+
+def test_batched_circle_nms():
+    from mmdet3d.core.post_processing import batched_circle_nms, circle_nms
+    np.random.seed(0)
+    num_boxes = 200
+    centers = np.random.rand(num_boxes, 2) * 3
+    scores = np.random.rand(num_boxes)
+    labels = np.random.randint(0, 3, num_boxes)
+    batch_ids = np.random.randint(0, 2, num_boxes)
+    class_thresh = [0.35, 0.1, -1]
+
+    expected_keep = np.zeros(num_boxes, dtype=np.bool_)
+    for batch_id in range(2):
+        for label, thresh in enumerate(class_thresh):
+            inds = np.where((batch_ids == batch_id) & (labels == label))[0]
+            if thresh <= 0:
+                expected_keep[inds] = True
+                continue
+            dets = np.concatenate([centers[inds], scores[inds, None]], axis=1)
+            keep = circle_nms(dets, thresh, post_max_size=10)
+            expected_keep[inds[np.array(keep, dtype=np.int64)]] = True
+
+    devices = ['cpu']
+    if torch.cuda.is_available():
+        devices.append('cuda')
+    for device in devices:
+        keep = batched_circle_nms(
+            torch.tensor(centers, device=device),
+            torch.tensor(scores, device=device),
+            torch.tensor(labels, device=device),
+            class_thresh,
+            batch_ids=torch.tensor(batch_ids, device=device),
+            post_max_size=10)
+        assert np.all(keep.cpu().numpy() == expected_keep)
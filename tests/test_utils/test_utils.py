@@ -1,6 +1,10 @@
+import numpy as np
 import torch
 
-from mmdet3d.core import draw_heatmap_gaussian
+from mmdet3d.core import (draw_heatmap_gaussian, draw_heatmap_gaussian_batch,
+                          rasterize_sparse_depth, sample_global_transforms,
+                          transform_points_batch)
+from mmdet3d.models.utils import topk_indices
 
 
 def test_gaussian():
@@ -9,3 +13,90 @@ def test_gaussian():
     radius = 2
     draw_heatmap_gaussian(heatmap, ct_int, radius)
     assert torch.isclose(torch.sum(heatmap), torch.tensor(4.3505), atol=1e-3)
+
+
+def test_draw_heatmap_gaussian_batch():
+    generator = torch.Generator().manual_seed(0)
+    num_objs = 30
+    map_ids = torch.randint(0, 3, (num_objs, ), generator=generator)
+    # some of the gaussians overlap each other and the map borders
+    centers = torch.randint(-4, 36, (num_objs, 2), generator=generator)
+    radii = torch.randint(0, 6, (num_objs, ), generator=generator)
+
+    expected_heatmap = torch.zeros((3, 24, 32))
+    for map_id, center, radius in zip(map_ids, centers, radii):
+        draw_heatmap_gaussian(expected_heatmap[map_id],
+                              center.to(torch.int32), int(radius))
+    heatmap = draw_heatmap_gaussian_batch(
+        torch.zeros((3, 24, 32)), map_ids, centers, radii)
+    assert torch.allclose(heatmap, expected_heatmap)
+
+
+def test_rasterize_sparse_depth():
+    # identity projection, so points are given as (u * z, v * z, z)
+    lidar2img = torch.eye(4).repeat(1, 2, 1, 1)
+    valid_shapes = torch.tensor([[[16, 16], [8, 8]]])
+    points = torch.tensor([[5.5 * 2, 6.5 * 2, 2.], [5.2 * 3, 6.1 * 3, 3.],
+                           [9.5 * 4, 9.5 * 4, 4.], [1.5 * 5, 1.5 * 5, 5.]])
+
+    depth, mask = rasterize_sparse_depth([points], lidar2img, valid_shapes,
+                                         (16, 16), [1, 2])
+    assert depth.shape == mask.shape == torch.Size([1, 2, 2, 16, 16])
+    # the nearest point wins, the third one is outside the second view
+    assert depth[0, 0, 0, 6, 5] == 2 and depth[0, 0, 1, 3, 2] == 2
+    assert depth[0, 0, 0, 9, 9] == 4 and depth[0, 1, 0, 9, 9] == 0
+    assert depth[0, 1, 0, 1, 1] == 5
+    assert mask.sum() == 10
+    assert torch.equal(depth > 0, mask)
+
+    depth, mask = rasterize_sparse_depth([points], lidar2img, valid_shapes,
+                                         (16, 16), [1, 2], exp_time=1)
+    assert depth[0, 0, 0, 5, 5] == 2 and depth[0, 0, 0, 6, 4] == 2
+    assert depth[0, 0, 0, 5, 4] == 0
+    assert depth[0, 1, 0, 1, 2] == 5 and depth[0, 1, 0, 0, 1] == 5
+
+
+def test_transform_points_batch():
+    torch.manual_seed(0)
+    params = sample_global_transforms(
+        3,
+        rot_range=0.785,
+        scale_ratio_range=[0.9, 1.1],
+        translation_std=0.5,
+        flip_ratio_bev_horizontal=0.5,
+        flip_ratio_bev_vertical=0.5)
+    transforms = params['transform']
+    assert transforms.shape == torch.Size([3, 4, 4])
+    # a rotation and flip scaled by the scale factor
+    linear = transforms[:, :3, :3] / params['scale'][:, None, None]
+    assert torch.allclose(
+        linear @ linear.transpose(1, 2), torch.eye(3).expand(3, 3, 3),
+        atol=1e-6)
+
+    points = [torch.rand(n, 5) * 100 - 50 for n in [10, 0, 20]]
+    results = transform_points_batch([pts.clone() for pts in points],
+                                     transforms)
+    for pts, res, transform in zip(points, results, transforms):
+        expected = pts[:, :3] @ transform[:3, :3].T + transform[:3, 3]
+        assert torch.allclose(res[:, :3], expected, atol=1e-4)
+        assert torch.equal(res[:, 3:], pts[:, 3:])
+
+    point_cloud_range = [-30, -30, -30, 30, 30, 30]
+    filtered = transform_points_batch(points, transforms, point_cloud_range)
+    for res, pts in zip(results, filtered):
+        mask = (res[:, :3].abs() < 30).all(1)
+        assert torch.allclose(pts, res[mask])
+
+
+def test_topk_indices():
+    torch.manual_seed(0)
+    # heavy ties, and sparse scores as left by the local max filtering
+    heatmaps = [
+        torch.randint(0, 5, (3, 200)).float(),
+        torch.rand(3, 200) * (torch.rand(3, 200) > 0.9)
+    ]
+    for heatmap in heatmaps:
+        expected = torch.from_numpy(
+            np.argsort(-heatmap.numpy(), axis=-1, kind='stable'))
+        for k in [1, 10, 50, 200]:
+            assert torch.equal(topk_indices(heatmap, k), expected[:, :k])
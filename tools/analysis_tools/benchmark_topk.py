@@ -0,0 +1,74 @@
+import argparse
+import time
+import torch
+
+from mmdet3d.models.utils import topk_indices
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the heatmap proposal selection')
+    parser.add_argument(
+        '--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--num-classes', type=int, default=10)
+    parser.add_argument(
+        '--bev-size', type=int, nargs=2, default=[180, 180],
+        help='size of the LiDAR heatmap')
+    parser.add_argument('--num-views', type=int, default=6)
+    parser.add_argument(
+        '--img-size', type=int, nargs=2, default=[112, 200],
+        help='size of the first level of the camera heatmap')
+    parser.add_argument('--level-num', type=int, default=4)
+    parser.add_argument('--num-proposals', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+    return args
+
+
+def make_heatmap(batch_size, num_entries, device):
+    # sparse scores, as left by the local max filtering of the heads
+    heatmap = torch.rand(batch_size, num_entries, device=device)
+    return heatmap * (torch.rand_like(heatmap) > 0.9)
+
+
+def timeit(func, heatmap, repeat, device):
+    for _ in range(5):
+        func(heatmap)
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(heatmap)
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    args = parse_args()
+    img_entries = sum(
+        (args.img_size[0] // 2**lvl) * (args.img_size[1] // 2**lvl)
+        for lvl in range(args.level_num)) * args.num_views
+    heatmaps = dict(
+        lidar=args.num_classes * args.bev_size[0] * args.bev_size[1],
+        camera=args.num_classes * img_entries)
+    k = args.num_proposals
+
+    def argsort(heatmap):
+        return heatmap.argsort(dim=-1, descending=True)[..., :k]
+
+    def topk(heatmap):
+        return topk_indices(heatmap, k)
+
+    for name, num_entries in heatmaps.items():
+        heatmap = make_heatmap(args.batch_size, num_entries, args.device)
+        argsort_time = timeit(argsort, heatmap, args.repeat, args.device)
+        topk_time = timeit(topk, heatmap, args.repeat, args.device)
+        print(f'{name} heatmap ({num_entries} entries): '
+              f'argsort {argsort_time:.3f} ms, topk {topk_time:.3f} ms, '
+              f'speedup {argsort_time / topk_time:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
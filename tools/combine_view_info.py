@@ -1,9 +1,12 @@
 import os
 import pickle
 import json
+import shutil
+import hashlib
 import numpy as np
 import torch
 import argparse
+from multiprocessing import Pool
 from mmdet3d.core import Box3DMode, LiDARInstance3DBoxes
 
 from mmdet3d.core.bbox.structures.utils import limit_period
@@ -31,69 +34,52 @@ def project_to_image(points, cam_int, cam_ext, img_h, img_w):
     return pts_2d, pts_cam_4d, fov_inds
 
 
-def combine_data(data_root, info_file, coco_file, output_file):
-    info_path = os.path.join(data_root, info_file)
-    coco_file_path = os.path.join(data_root, coco_file)
+def project_corners_to_bboxes(corners, cam_int, cam_ext, img_h, img_w):
+    # corners: (N, 8, 3), all boxes of a view are projected at once
+    num_boxes = corners.shape[0]
+    corners_2d, _, _ = project_to_image(corners.reshape(-1, 3), cam_int, cam_ext, img_h, img_w)
+    corners_2d = corners_2d.reshape(num_boxes, 8, -1)
+    coord_min = np.min(corners_2d, axis=1)
+    coord_max = np.max(corners_2d, axis=1)
 
-    with open(info_path, "rb") as file:
-        info = pickle.load(file, encoding="bytes")
+    x1 = np.maximum(coord_min[:, 0], 0)
+    y1 = np.maximum(coord_min[:, 1], 0)
+    x2 = np.minimum(coord_max[:, 0], img_w)
+    y2 = np.minimum(coord_max[:, 1], img_h)
+    return np.stack([x1, y1, x2 - x1, y2 - y1], axis=1)  # (N, 4), x1 y1 w h
 
-    with open(coco_file_path, "r") as file:
-        coco = json.load(file)
 
-    id2image = {}
-    for image in coco["images"]:
-        image_id = image['id']
-        if image_id not in id2image:
-            id2image[image_id] = image
-    print("Generate new info file")
-    all_depths = []
-
-    for info_id, info_dict in enumerate(info['infos']):
-        if info_id % 1000 == 1:
-            print(info_id, "/", len(info['infos']))
-        valid_flag = info_dict['num_lidar_pts'] > 0
-
-        gt_visible_3d = np.zeros((info_dict['gt_boxes'].shape[0], ), dtype=np.int32)
-
-        gt_boxes_3d_tensor = info_dict['gt_boxes'][valid_flag]
-
-        gt_names_3d = info_dict['gt_names'][valid_flag]
-        gt_vel_2d = info_dict['gt_velocity'][valid_flag]
-        gt_vel_3d = np.concatenate([gt_vel_2d, np.zeros_like(gt_vel_2d[:,:1])], axis=1)
-        gt_visible_3d_valid = np.zeros((gt_boxes_3d_tensor.shape[0], ), dtype=np.int32)
-
-        if gt_boxes_3d_tensor.shape[0] == 0:
-            info_dict['gt_bboxes2d_view'] = np.zeros((0, 4))
-            info_dict['gt_names2d_view'] = []
-            info_dict['gt_viewsIDs'] = np.zeros(0)
-            info_dict['gt_pts_centers_view'] = np.zeros((0, 3))
-            info_dict['gt_img_centers_view'] = np.zeros((0, 3))
-            info_dict['gt_bboxes_cam_view'] = np.zeros((0, 7))
-            info_dict['gt_velocity_cam_view'] = np.zeros((0, 2))
-            info_dict['gt_visible'] = gt_visible_3d
-            info_dict['gt_bboxes_lidar_view'] = np.zeros((0, 7))
-            info_dict['gt_velocity_lidar_view'] = np.zeros((0, 2))
-            continue
+def add_view_info(info_dict, image_sizes):
+    valid_flag = info_dict['num_lidar_pts'] > 0
 
-        gt_boxes_3d = LiDARInstance3DBoxes(gt_boxes_3d_tensor, box_dim=7, origin=(0.5, 0.5, 0.5)).convert_to(Box3DMode.LIDAR)
+    gt_visible_3d = np.zeros((info_dict['gt_boxes'].shape[0], ), dtype=np.int32)
 
-        corners = gt_boxes_3d.corners
-        centers = gt_boxes_3d.gravity_center
-        dims = gt_boxes_3d.dims
-        yaws = gt_boxes_3d.yaw[:,None]
+    gt_boxes_3d_tensor = info_dict['gt_boxes'][valid_flag]
+
+    gt_names_3d = info_dict['gt_names'][valid_flag]
+    gt_vel_2d = info_dict['gt_velocity'][valid_flag]
+    gt_vel_3d = np.concatenate([gt_vel_2d, np.zeros_like(gt_vel_2d[:,:1])], axis=1)
+    gt_visible_3d_valid = np.zeros((gt_boxes_3d_tensor.shape[0], ), dtype=np.int32)
+
+    view_ids = []
+    bboxes = []
+    gt_names = []
+    pts_centers = []
+    img_centers = []
+
+    bboxes_cam_3d = []
+    vel_cam = []
 
-        view_ids = []
-        bboxes = []
-        gt_names = []
-        pts_centers = []
-        img_centers = []
+    bboxes_lidar = []
+    vels_lidar = []
 
-        bboxes_cam_3d = []
-        vel_cam = []
+    if gt_boxes_3d_tensor.shape[0] > 0:
+        gt_boxes_3d = LiDARInstance3DBoxes(gt_boxes_3d_tensor, box_dim=7, origin=(0.5, 0.5, 0.5)).convert_to(Box3DMode.LIDAR)
 
-        bboxes_lidar = []
-        vels_lidar = []
+        corners = gt_boxes_3d.corners.cpu().numpy()
+        centers = gt_boxes_3d.gravity_center.cpu().numpy()
+        dims = gt_boxes_3d.dims.cpu().numpy()
+        yaws = gt_boxes_3d.yaw[:,None]
 
         for view_id, cam in enumerate(cam_orders):
             cam_info = info_dict['cams'][cam]
@@ -102,38 +88,21 @@ def combine_data(data_root, info_file, coco_file, output_file):
             lidar2cam_rt = np.eye(4)
             lidar2cam_rt[:3, :3] = lidar2cam_r.T
             lidar2cam_rt[3, :3] = -lidar2cam_t
-            
-            # print (cam_info.keys())
+
             intrinsic = cam_info['cam_intrinsic']
             viewpad = np.eye(4)
             viewpad[:intrinsic.shape[0], :intrinsic.shape[1]] = intrinsic
-            lidar2img_rt = (viewpad @ lidar2cam_rt.T)
 
-            image_token = cam_info['sample_data_token']
-            image_info = id2image[image_token]
-            img_h = image_info['height']
-            img_w = image_info['width']
+            img_h, img_w = image_sizes[cam_info['sample_data_token']]
 
             centers_2d, center_cam_3d, view_mask = project_to_image(centers, viewpad, lidar2cam_rt.T, img_h, img_w)
-            centers_2d = centers_2d[..., :3]
-            center_cam_3d = center_cam_3d[..., :3]
-
-            corners_view = corners[view_mask].cpu().numpy()
-            names_view = gt_names_3d[view_mask]
-            centers_view = centers[view_mask].cpu().numpy()
-            centers_2d_view = centers_2d[view_mask]
-            dims_view = dims[view_mask].cpu().numpy()
-            yaw_view = -yaws[view_mask] - np.pi / 2
-            center_cam_3d_view = center_cam_3d[view_mask]
-            vel_3d_view = gt_vel_3d[view_mask]
-
-            boxes_lidar_view = gt_boxes_3d_tensor[view_mask]
-            vels_lidar_view = gt_vel_2d[view_mask]
-
-            vel_cam_3d_view = vel_3d_view @ lidar2cam_r.T
-            vel_cam_view = vel_cam_3d_view[:, [0, 2]]
+            ann_num = view_mask.sum()
+            if ann_num == 0:
+                continue
 
-            dims_view = dims_view[:, [1, 2, 0]]
+            yaw_view = -yaws[view_mask] - np.pi / 2
+            vel_cam_3d_view = gt_vel_3d[view_mask] @ lidar2cam_r.T
+            dims_view = dims[view_mask][:, [1, 2, 0]]
 
             rot_dir_view = torch.cat([torch.cos(yaw_view), torch.sin(yaw_view), torch.zeros_like(yaw_view)], dim=1)
             rot_dir_view = rot_dir_view @ lidar2cam_r.T
@@ -142,72 +111,126 @@ def combine_data(data_root, info_file, coco_file, output_file):
             yaw_view = -torch.atan2(rot_dir_view[:, 1:2], rot_dir_view[:, 0:1])
             yaw_view = limit_period(yaw_view, period=2*np.pi).cpu().numpy()
 
-            bboxes_cam_3d_view = np.concatenate([center_cam_3d_view, dims_view, yaw_view], axis=1)
+            bboxes.append(project_corners_to_bboxes(corners[view_mask], viewpad, lidar2cam_rt.T, img_h, img_w))
+            view_ids.append(np.full(ann_num, view_id))
+            gt_names.extend(gt_names_3d[view_mask])
+            pts_centers.append(centers[view_mask])
+            img_centers.append(centers_2d[view_mask, :3])
+            bboxes_cam_3d.append(np.concatenate([center_cam_3d[view_mask, :3], dims_view, yaw_view], axis=1))
+            vel_cam.append(vel_cam_3d_view[:, [0, 2]])
+            bboxes_lidar.append(gt_boxes_3d_tensor[view_mask])
+            vels_lidar.append(gt_vel_2d[view_mask])
 
-            gt_visible_3d_valid_view = np.zeros((view_mask.sum(),), dtype=np.int32)
+            gt_visible_3d_valid[view_mask] = 1
+
+    def stack(arrays, shape):
+        return np.concatenate(arrays, axis=0) if len(arrays) > 0 else np.zeros(shape)
+
+    gt_visible_3d[valid_flag] = gt_visible_3d_valid
+
+    info_dict['gt_bboxes2d_view'] = stack(bboxes, (0, 4))
+    info_dict['gt_names2d_view'] = gt_names
+    info_dict['gt_viewsIDs'] = stack(view_ids, 0)
+    info_dict['gt_pts_centers_view'] = stack(pts_centers, (0, 3))
+    info_dict['gt_img_centers_view'] = stack(img_centers, (0, 3))
+
+    info_dict['gt_bboxes_cam_view'] = stack(bboxes_cam_3d, (0, 7))
+    info_dict['gt_velocity_cam_view'] = stack(vel_cam, (0, 2))
+    info_dict['gt_visible'] = gt_visible_3d
+
+    info_dict['gt_bboxes_lidar_view'] = stack(bboxes_lidar, (0, 7))
+    info_dict['gt_velocity_lidar_view'] = stack(vels_lidar, (0, 2))
+    return info_dict
+
+
+_image_sizes = None
+
+
+def init_worker(image_sizes):
+    global _image_sizes
+    _image_sizes = image_sizes
+    # one process per core already, avoid oversubscribing with intra-op threads
+    torch.set_num_threads(1)
 
-            ann_num = corners_view.shape[0]
-            if ann_num == 0:
-                continue
 
-            for ann_id in range(ann_num):
-                corner_2d, _, _ = project_to_image(corners_view[ann_id], viewpad, lidar2cam_rt.T, img_h, img_w)  # (8, 2)
-                coord_min = np.min(corner_2d, axis=0)
-                coord_max = np.max(corner_2d, axis=0)
-
-                x1, y1 = coord_min[0], coord_min[1]
-                x2, y2 = coord_max[0], coord_max[1]
-
-                x1 = max(x1, 0)
-                y1 = max(y1, 0)
-                x2 = min(x2, img_w)
-                y2 = min(y2, img_h)
-                w = x2 - x1
-                h = y2 - y1
-
-                bboxes.append([x1, y1, w, h])
-                view_ids.append(view_id)
-                gt_names.append(names_view[ann_id])
-                pts_centers.append(centers_view[ann_id])
-                img_centers.append(centers_2d_view[ann_id])
-                all_depths.append(centers_2d_view[ann_id][2])
-                bboxes_cam_3d.append(bboxes_cam_3d_view[ann_id])
-                vel_cam.append(vel_cam_view[ann_id])
-                bboxes_lidar.append(boxes_lidar_view[ann_id])
-                vels_lidar.append(vels_lidar_view[ann_id])
-                gt_visible_3d_valid_view[ann_id] = 1
-
-            gt_visible_3d_valid[view_mask] = gt_visible_3d_valid_view
-
-
-        view_ids = np.array(view_ids)
-        bboxes = np.array(bboxes).reshape(-1, 4)
-        pts_centers = np.array(pts_centers).reshape(-1, 3)
-        img_centers = np.array(img_centers).reshape(-1, 3)
-        bboxes_cam_3d = np.vstack(bboxes_cam_3d)
-        vel_cam = np.vstack(vel_cam)
-
-        bboxes_lidar = np.vstack(bboxes_lidar)
-        vels_lidar = np.vstack(vels_lidar)
-
-        gt_visible_3d[valid_flag] = gt_visible_3d_valid
-
-        info_dict['gt_bboxes2d_view'] = bboxes
-        info_dict['gt_names2d_view'] = gt_names
-        info_dict['gt_viewsIDs'] = view_ids
-        info_dict['gt_pts_centers_view'] = pts_centers
-        info_dict['gt_img_centers_view'] = img_centers
-
-        info_dict['gt_bboxes_cam_view'] = bboxes_cam_3d
-        info_dict['gt_velocity_cam_view'] = vel_cam
-        info_dict['gt_visible'] = gt_visible_3d
-
-        info_dict['gt_bboxes_lidar_view'] = bboxes_lidar
-        info_dict['gt_velocity_lidar_view'] = vels_lidar
+def process_shard(shard):
+    shard_path, infos = shard
+    infos = [add_view_info(info_dict, _image_sizes) for info_dict in infos]
+    # write to a temporary file first so that an interrupted run never leaves a partial shard
+    with open(shard_path + ".tmp", "wb") as file:
+        pickle.dump(infos, file)
+    os.replace(shard_path + ".tmp", shard_path)
+    return shard_path
+
+
+def combine_data(data_root, info_file, coco_file, output_file, num_workers=8, shard_size=1000):
+    info_path = os.path.join(data_root, info_file)
+    coco_file_path = os.path.join(data_root, coco_file)
+
+    with open(info_path, "rb") as file:
+        info_bytes = file.read()
+    info = pickle.loads(info_bytes, encoding="bytes")
+
+    with open(coco_file_path, "rb") as file:
+        coco_bytes = file.read()
+    coco = json.loads(coco_bytes)
+
+    image_sizes = {}
+    for image in coco["images"]:
+        if image['id'] not in image_sizes:
+            image_sizes[image['id']] = (image['height'], image['width'])
+    print("Generate new info file")
 
+    # every shard is written on its own, shards left by an interrupted run are reused
+    # only if they were made from the same inputs with the same shard size
+    digest = hashlib.sha1()
+    for data in [info_bytes, coco_bytes, str(shard_size).encode()]:
+        digest.update(hashlib.sha1(data).digest())
+    digest = digest.hexdigest()
     output_path = os.path.join(data_root, output_file)
-    with open(output_path, "wb") as file:
+    shard_dir = output_path + ".shards"
+    manifest_path = os.path.join(shard_dir, "manifest.txt")
+    if os.path.isdir(shard_dir):
+        manifest = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                manifest = file.read().strip()
+        if manifest != digest:
+            print("Remove the stale shards in %s" % shard_dir)
+            shutil.rmtree(shard_dir)
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+        with open(manifest_path, "w") as file:
+            file.write(digest)
+    num_infos = len(info['infos'])
+    shard_paths = []
+    todo = []
+    for shard_id, start in enumerate(range(0, num_infos, shard_size)):
+        shard_path = os.path.join(shard_dir, "shard_%05d.pkl" % shard_id)
+        shard_paths.append(shard_path)
+        if not os.path.exists(shard_path):
+            todo.append((shard_path, info['infos'][start:start + shard_size]))
+    print("%d / %d shards to process" % (len(todo), len(shard_paths)))
+
+    if num_workers > 0:
+        with Pool(num_workers, initializer=init_worker, initargs=(image_sizes, )) as pool:
+            for done, shard_path in enumerate(pool.imap_unordered(process_shard, todo)):
+                print(done + 1, "/", len(todo), shard_path)
+    else:
+        init_worker(image_sizes)
+        for done, shard_path in enumerate(map(process_shard, todo)):
+            print(done + 1, "/", len(todo), shard_path)
+
+    infos = []
+    for shard_path in shard_paths:
+        with open(shard_path, "rb") as file:
+            infos.extend(pickle.load(file))
+    info['infos'] = infos
+
+    with open(output_path + ".tmp", "wb") as file:
         pickle.dump(info, file)
+    os.replace(output_path + ".tmp", output_path)
+    shutil.rmtree(shard_dir)
 
 
 if __name__ == "__main__":
@@ -216,6 +239,8 @@ if __name__ == "__main__":
     parser.add_argument('--info_tag', type=str, default='nuscenes_infos', help='data info filename prefix')
     parser.add_argument('--output_tag', type=str, default='nuscenes_infos_w_views', help='output filename prefix')
     parser.add_argument('--output_file', type=str, default='./data/nuscenes/', help='root path of dataset')
+    parser.add_argument('--num_workers', type=int, default=8, help='number of worker processes, 0 to run in the main process')
+    parser.add_argument('--shard_size', type=int, default=1000, help='number of samples written per shard')
     args = parser.parse_args()
 
     for split in ["train", "val"]:
@@ -224,4 +249,4 @@ if __name__ == "__main__":
         output_file = args.output_tag + "_%s.pkl"%split
 
         print("Processing %s data"%split)
-        combine_data(args.data_root, info_file, coco_file, output_file)
+        combine_data(args.data_root, info_file, coco_file, output_file, args.num_workers, args.shard_size)
@@ -118,7 +118,8 @@ def create_groundtruth_database(dataset_class_name,
                                 lidar_only=False,
                                 bev_only=False,
                                 coors_range=None,
-                                with_mask=False):
+                                with_mask=False,
+                                packed=False):
     """Given the raw data, generate the ground truth database.
 
     Args:
@@ -139,6 +140,11 @@ def create_groundtruth_database(dataset_class_name,
             Default: True.
         with_mask (bool): Whether to use mask.
             Default: False.
+        packed (bool): Whether to save the points of all objects in one
+            packed file, ``{info_prefix}_gt_database.bin``, instead of one
+            file per object. The db_infos then record the row of the first
+            point of each object in ``points_offset``.
+            Default: False.
     """
     print(f'Create GT Database of {dataset_class_name}')
     dataset_cfg = dict(
@@ -231,6 +237,11 @@ def create_groundtruth_database(dataset_class_name,
             info = coco.loadImgs([i])[0]
             file2id.update({info['file_name']: i})
 
+    if packed:
+        packed_filename = f'{info_prefix}_gt_database.bin'
+        packed_file = open(osp.join(data_path, packed_filename), 'wb')
+        num_packed_points = 0
+
     group_counter = 0
     for j in track_iter_progress(list(range(len(dataset)))):
         input_dict = dataset.get_data_info(j)
@@ -302,8 +313,14 @@ def create_groundtruth_database(dataset_class_name,
                 mmcv.imwrite(object_img_patches[i], img_patch_path)
                 mmcv.imwrite(object_masks[i], mask_patch_path)
 
-            with open(abs_filepath, 'w') as f:
-                gt_points.tofile(f)
+            if packed:
+                gt_points.tofile(packed_file)
+                rel_filepath = packed_filename
+                points_offset = num_packed_points
+                num_packed_points += gt_points.shape[0]
+            else:
+                with open(abs_filepath, 'w') as f:
+                    gt_points.tofile(f)
 
             if (used_classes is None) or names[i] in used_classes:
                 db_info = {
@@ -315,6 +332,8 @@ def create_groundtruth_database(dataset_class_name,
                     'num_points_in_gt': gt_points.shape[0],
                     'difficulty': difficulty[i],
                 }
+                if packed:
+                    db_info['points_offset'] = points_offset
                 local_group_id = group_ids[i]
                 # if local_group_id >= 0:
                 if local_group_id not in group_dict:
@@ -330,6 +349,9 @@ def create_groundtruth_database(dataset_class_name,
                 else:
                     all_db_infos[names[i]] = [db_info]
 
+    if packed:
+        packed_file.close()
+
     for k, v in all_db_infos.items():
         print(f'load {len(v)} {k} database infos')
 
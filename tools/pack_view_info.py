@@ -0,0 +1,20 @@
+import argparse
+import mmcv
+import os
+
+from mmdet3d.datasets import NuScenesDataset
+from mmdet3d.datasets.info_store import pack_infos
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack the ann files into memory-mapped info stores')
+    parser.add_argument('--data_root', type=str, default='./data/nuscenes/', help='root path of dataset')
+    parser.add_argument('--info_tag', type=str, default='nuscenes_infos_w_views', help='data info filename prefix')
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val'], help='splits to pack')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        info_file = os.path.join(args.data_root, args.info_tag + "_%s.pkl" % split)
+        out_dir = os.path.join(args.data_root, args.info_tag + "_%s" % split)
+
+        print("Packing %s into %s" % (info_file, out_dir))
+        pack_infos(mmcv.load(info_file), out_dir, classes=NuScenesDataset.CLASSES)